@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks dos caminhos quentes do pipeline de mensagens
+
+Roda contra o mongomock (padrão, `pip install mongomock`) ou um mongod local (--mongo-uri),
+com o cliente Groq substituído por um stub de resposta imediata, então mede só o nosso código.
+
+Uso:
+    python benchmarks/run_benchmarks.py                      # compara com benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --profile full       # 1k quadras, 100k reservas, 500 mensagens
+    python benchmarks/run_benchmarks.py --save-baseline      # grava a linha de base do perfil
+
+A execução falha (código 1) se a mediana de algum benchmark ficar mais de --threshold
+(padrão 30%) acima da linha de base gravada para o mesmo perfil.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+PROFILES = {
+    # mongomock varre as coleções em Python: o perfil "quick" mantém a rodada em segundos
+    "quick": {"establishments": 20, "courts": 200, "reservations": 5000, "history": 500},
+    "full": {"establishments": 100, "courts": 1000, "reservations": 100000, "history": 500},
+}
+
+SAMPLE_MESSAGES = [
+    "oi, tudo bem?",
+    "quero reservar a quadra 2 amanhã às 19h por 2 horas",
+    "minhas reservas",
+    "qual o endereço da Arena 3?",
+    "tem horário livre sábado de manhã?",
+    "sim",
+    "cancelar",
+    "toda terça 19h pelas próximas 8 semanas",
+    "obrigado, até mais",
+    "dia 15/03 às 9h na arena 7",
+]
+
+
+class StubGroqClient:
+    """Imita chat.completions.create do SDK do Groq com uma resposta fixa, sem rede"""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    @staticmethod
+    def _create(**kwargs):
+        prompt = sum(len(m.get("content") or "") for m in kwargs.get("messages", []))
+        message = SimpleNamespace(content="Claro! Qual quadra e horário você prefere?", tool_calls=None)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=message)],
+            usage=SimpleNamespace(prompt_tokens=prompt // 4, completion_tokens=12)
+        )
+
+
+def load_app(mongo_uri):
+    """Importa o app com configuração de benchmark e conecta ao banco escolhido"""
+    os.environ.update({
+        "MONGODB_URI": mongo_uri or "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=50",
+        "MONGODB_DB": "genia_benchmark",
+        "GROQ_API_KEY": "",
+        "REMINDER_ENABLED": "false",
+        "OUTBOUND_SENDER": "local",
+        "RATE_LIMIT_MESSAGES_PER_MINUTE": "1000000",
+        "RATE_LIMIT_MESSAGES_BURST": "1000000",
+        "RATE_LIMIT_LLM_PER_MINUTE": "1000000",
+        "RATE_LIMIT_LLM_BURST": "1000000",
+        "SUMMARY_TRIGGER_MESSAGES": "1000000",
+    })
+    import logging
+    logging.disable(logging.CRITICAL)
+    sys.path.insert(0, ROOT)
+    import main_flask_single as app
+
+    if mongo_uri:
+        app.mongodb.client.drop_database("genia_benchmark")
+    else:
+        import mongomock
+        app.mongodb.client = mongomock.MongoClient()
+        app.mongodb.db = app.mongodb.client["genia_benchmark"]
+    app.ensure_indexes()
+    app.llm_gateway.client = StubGroqClient()
+    return app
+
+
+def seed(app, sizes, rng):
+    """Catálogo, reservas e um histórico longo nos tamanhos do perfil"""
+    started = time.perf_counter()
+    per_establishment = max(1, sizes["courts"] // sizes["establishments"])
+    app.catalog_importer.import_items([
+        {
+            "nome": f"Arena {i}",
+            "endereco": {"logradouro": f"Rua {i}, {i * 10}", "bairro": "Centro", "cidade": f"Cidade {i % 7}"},
+            "telefone": f"+55519999{i:05d}",
+            "quadras": [{"nome": f"Quadra {j}", "valor_hora": 60 + 10 * (j % 5)} for j in range(per_establishment)]
+        }
+        for i in range(sizes["establishments"])
+    ])
+    courts = app.court_repo.get_all()
+
+    base = datetime.now().replace(minute=0, second=0, microsecond=0)
+    batch = []
+    for n in range(sizes["reservations"]):
+        court = courts[n % len(courts)]
+        start = base + timedelta(days=rng.randint(-180, 60), hours=rng.randint(6, 22) - base.hour)
+        batch.append(app.Reservation(
+            usuario=app.User(nome="Cliente", telefone=f"+55119{n % 50000:08d}"),
+            establishment_id=court.establishment_id,
+            court_id=court._id,
+            data_reserva=start,
+            quantidade_horas=rng.choice([1, 1, 2]),
+            status=rng.choice(["confirmada", "confirmada", "confirmada", "cancelada"])
+        ).to_dict())
+        if len(batch) == 5000:
+            app.reservation_repo.get_collection().insert_many(batch)
+            batch = []
+    if batch:
+        app.reservation_repo.get_collection().insert_many(batch)
+
+    phone = "+5511988887777"
+    now = datetime.now()
+    app.history_repo.get_collection().insert_one({
+        "phone": phone,
+        "messages": [
+            app.ConversationMessage(
+                role="user" if i % 2 == 0 else "assistant",
+                content=SAMPLE_MESSAGES[i % len(SAMPLE_MESSAGES)],
+                timestamp=now - timedelta(seconds=sizes["history"] - i)
+            ).to_dict()
+            for i in range(sizes["history"])
+        ],
+        "last_activity": now.isoformat(),
+        "session_start": (now - timedelta(minutes=20)).isoformat()
+    })
+    print(f"Dados de teste criados em {time.perf_counter() - started:.1f}s: "
+          f"{len(courts)} quadras, {sizes['reservations']} reservas, {sizes['history']} mensagens")
+    return courts, phone
+
+
+def measure(func, min_time=0.5, min_rounds=20, max_rounds=100000):
+    """Executa func até min_time segundos (e min_rounds vezes); retorna estatísticas em µs"""
+    func()  # aquecimento
+    timings = []
+    deadline = time.perf_counter() + min_time
+    while len(timings) < max_rounds and (len(timings) < min_rounds or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1e6)
+    timings.sort()
+    return {
+        "rounds": len(timings),
+        "median_us": round(statistics.median(timings), 2),
+        "p95_us": round(timings[int(len(timings) * 0.95) - 1], 2),
+    }
+
+
+def build_benchmarks(app, courts, phone, rng):
+    messages = iter(SAMPLE_MESSAGES * 1000000)
+    court_ids = [c._id for c in courts]
+    day = datetime.now().replace(hour=19, minute=0, second=0, microsecond=0) + timedelta(days=3)
+    turn_phones = iter(f"+55219{n:08d}" for n in range(10 ** 8))
+    buffer_phones = itertools.cycle([f"+55319{n:08d}" for n in range(100)])
+
+    return {
+        "intent_from_text": lambda: app.intent_from_text(next(messages), None),
+        "parse_date": lambda: app.parse_date(next(messages)),
+        "parse_time": lambda: app.parse_time(next(messages)),
+        "parse_hours_qty": lambda: app.parse_hours_qty(next(messages)),
+        "extract_establishment_from_text": lambda: app.extract_establishment_from_text(next(messages)),
+        "validate_court_availability": lambda: app.validate_court_availability(rng.choice(court_ids), day, 2),
+        # Telefones próprios (um conjunto fixo, para não multiplicar documentos no histórico): com o
+        # write-behind o append é barato e incharia o histórico medido abaixo
+        "history_add_message": lambda: app.history_repo.add_message(
+            next(buffer_phones), app.ConversationMessage(role="user", content=next(messages))),
+        "history_get_conversation_context": lambda: app.history_repo.get_conversation_context(phone),
+        "process_message_nlu_turn": lambda: app.process_message(next(turn_phones), "minhas reservas"),
+        "process_message_llm_turn": lambda: app.process_message(phone, "e no fim de semana, tem algo melhor?"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks do pipeline de mensagens")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="quick")
+    parser.add_argument("--mongo-uri", help="Usa um mongod (ex.: mongodb://localhost:27017) em vez do mongomock")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Grava os resultados como linha de base")
+    parser.add_argument("--threshold", type=float, default=0.30, help="Piora tolerada da mediana (0.30 = 30%%)")
+    parser.add_argument("--min-time", type=float, default=0.5, help="Segundos por benchmark")
+    parser.add_argument("--only", help="Roda apenas benchmarks cujo nome contém este texto")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    app = load_app(args.mongo_uri)
+    courts, phone = seed(app, PROFILES[args.profile], rng)
+    backend = "mongod" if args.mongo_uri else "mongomock"
+    profile_key = f"{args.profile}/{backend}"
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    baseline = baselines.get(profile_key, {})
+
+    results, regressions = {}, []
+    print(f"\n{'benchmark':<36}{'mediana':>12}{'p95':>12}{'base':>12}{'var':>8}")
+    for name, func in build_benchmarks(app, courts, phone, rng).items():
+        if args.only and args.only not in name:
+            continue
+        result = measure(func, min_time=args.min_time)
+        # Esvazia o buffer de histórico: o flush do que este benchmark enfileirou não pode cair na medição seguinte
+        app.history_repo.buffer.flush()
+        results[name] = result
+        reference = baseline.get(name, {}).get("median_us")
+        change = (result["median_us"] / reference - 1) if reference else None
+        if change is not None and change > args.threshold:
+            regressions.append(name)
+        print(f"{name:<36}{result['median_us']:>10.1f}µs{result['p95_us']:>10.1f}µs"
+              f"{(f'{reference:.1f}µs' if reference else '-'):>12}"
+              f"{(f'{change:+.0%}' if change is not None else ''):>8}{'  <-- REGRESSÃO' if name in regressions else ''}")
+
+    if args.save_baseline:
+        baselines[profile_key] = {**baseline, **results}
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nLinha de base '{profile_key}' gravada em {args.baseline}")
+        return 0
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) acima de +{args.threshold:.0%} da linha de base: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
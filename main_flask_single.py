@@ -2,16 +2,44 @@
 Aplicação Flask simples para o Agente de Reservas de Quadras
 Versão com MongoDB integrado - Arquivo único para evitar problemas de import
 """
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 import logging
 import os
-from datetime import datetime, timedelta
-from pymongo import MongoClient
+import sys
+import json
+import gzip
+import zlib
+import csv
+import io
+import math
+import unicodedata
+import time
+import heapq
+import itertools
+import queue
+import threading
+import uuid
+import hashlib
+import hmac
+import base64
+import atexit
+from collections import OrderedDict, Counter, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from pymongo import MongoClient, ReturnDocument, UpdateOne, UpdateMany, DeleteMany, WriteConcern, ReadPreference, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from bson import ObjectId
-from typing import Optional, List, Tuple
+from bson.errors import InvalidId
+from typing import Optional, List, Tuple, Dict
 import re
+import random
+import httpx
 from twilio.twiml.messaging_response import MessagingResponse
-from groq import Groq
+import groq
+from groq import Groq, DefaultHttpxClient
 
 # Configuração de logging
 logging.basicConfig(
@@ -33,23 +61,443 @@ class SimpleSettings:
     USE_LLM = os.getenv("USE_LLM", "true").lower() == "true"
     DEBUG = os.getenv("DEBUG", "false").lower() == "true"
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    # Envio ativo (Twilio REST) e lembretes de reserva
+    OUTBOUND_SENDER = os.getenv("OUTBOUND_SENDER", "twilio" if os.getenv("TWILIO_ACCOUNT_SID") else "local")
+    OUTBOUND_RATE_PER_SECOND = float(os.getenv("OUTBOUND_RATE_PER_SECOND", "1"))
+    OUTBOUND_BURST = int(os.getenv("OUTBOUND_BURST", "5"))
+    OUTBOUND_BATCH_SIZE = int(os.getenv("OUTBOUND_BATCH_SIZE", "20"))
+    REMINDER_ENABLED = os.getenv("REMINDER_ENABLED", "true").lower() == "true"
+    REMINDER_HOURS_BEFORE = int(os.getenv("REMINDER_HOURS_BEFORE", "2"))
+    REMINDER_LOOKAHEAD_HOURS = int(os.getenv("REMINDER_LOOKAHEAD_HOURS", "6"))
+    REMINDER_LOAD_INTERVAL_SECONDS = int(os.getenv("REMINDER_LOAD_INTERVAL_SECONDS", "300"))
+    # Particionamento por estabelecimento ("shared" ou "establishment")
+    PARTITION_MODE = os.getenv("PARTITION_MODE", "shared")
+    OWNED_ESTABLISHMENTS = [e.strip() for e in os.getenv("OWNED_ESTABLISHMENTS", "").split(",") if e.strip()]
+    PARTITION_ROUTES = os.getenv("PARTITION_ROUTES", "")  # "whatsapp:+5511...=<establishment_id>,..."
+    PARTITION_CACHE_SIZE = int(os.getenv("PARTITION_CACHE_SIZE", "1000"))
+    CATALOG_VERSION_TTL_SECONDS = float(os.getenv("CATALOG_VERSION_TTL_SECONDS", "5"))
+    # Gateway do LLM (pool HTTP, concorrência, retentativas e circuit breaker)
+    LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "15"))
+    LLM_POOL_CONNECTIONS = int(os.getenv("LLM_POOL_CONNECTIONS", "20"))
+    LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "8"))
+    LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "5"))
+    LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+    LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "0.5"))
+    LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+    LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+    # Roteamento por complexidade: modelo rápido para turnos simples, grande só quando necessário
+    GROQ_FAST_MODEL = os.getenv("GROQ_FAST_MODEL", GROQ_MODEL)
+    GROQ_LARGE_MODEL = os.getenv("GROQ_LARGE_MODEL", "llama-3.3-70b-versatile")
+    LLM_FAST_MAX_TOKENS = int(os.getenv("LLM_FAST_MAX_TOKENS", "150"))
+    LLM_FAST_TEMPERATURE = float(os.getenv("LLM_FAST_TEMPERATURE", "0.3"))
+    LLM_LARGE_MAX_TOKENS = int(os.getenv("LLM_LARGE_MAX_TOKENS", "300"))
+    LLM_LARGE_TEMPERATURE = float(os.getenv("LLM_LARGE_TEMPERATURE", "0.5"))
+    LLM_ROUTER_THRESHOLD = float(os.getenv("LLM_ROUTER_THRESHOLD", "3"))
+    # Classificador de intenções local
+    INTENT_MODEL_PATH = os.getenv("INTENT_MODEL_PATH", "intent_model.json.gz")
+    INTENT_CONFIDENCE_THRESHOLD = float(os.getenv("INTENT_CONFIDENCE_THRESHOLD", "0.75"))
+    LLM_MAX_TOOL_ROUNDS = int(os.getenv("LLM_MAX_TOOL_ROUNDS", "3"))
+    # Reservas
+    MAX_BOOKING_HOURS = int(os.getenv("MAX_BOOKING_HOURS", "6"))
+    RECURRENCE_MAX_OCCURRENCES = int(os.getenv("RECURRENCE_MAX_OCCURRENCES", "26"))
+    WAITLIST_HOLD_MINUTES = int(os.getenv("WAITLIST_HOLD_MINUTES", "10"))
+    EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+    EXPORT_TOKEN = os.getenv("EXPORT_TOKEN", "")  # vazio: exportação desativada
+    IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+    # Busca por localização (mensagens de localização do WhatsApp)
+    GEO_CELL_KM = float(os.getenv("GEO_CELL_KM", "5"))
+    GEO_MAX_DISTANCE_KM = float(os.getenv("GEO_MAX_DISTANCE_KM", "30"))
+    GEO_NEAREST_LIMIT = int(os.getenv("GEO_NEAREST_LIMIT", "3"))
+    # Controle de admissão do webhook
+    ADMISSION_DEGRADE_IN_FLIGHT = int(os.getenv("ADMISSION_DEGRADE_IN_FLIGHT", "16"))
+    ADMISSION_SHED_IN_FLIGHT = int(os.getenv("ADMISSION_SHED_IN_FLIGHT", "64"))
+    ADMISSION_DEGRADE_QUEUE = int(os.getenv("ADMISSION_DEGRADE_QUEUE", "8"))
+    ADMISSION_DEGRADE_LATENCY_SECONDS = float(os.getenv("ADMISSION_DEGRADE_LATENCY_SECONDS", "8"))
+    ADMISSION_LATENCY_WINDOW_SECONDS = float(os.getenv("ADMISSION_LATENCY_WINDOW_SECONDS", "30"))
+    # Limite por telefone: mensagens (qualquer turno) e turnos que chamam o LLM, por minuto
+    RATE_LIMIT_MESSAGES_PER_MINUTE = int(os.getenv("RATE_LIMIT_MESSAGES_PER_MINUTE", "20"))
+    RATE_LIMIT_MESSAGES_BURST = int(os.getenv("RATE_LIMIT_MESSAGES_BURST", "8"))
+    RATE_LIMIT_LLM_PER_MINUTE = int(os.getenv("RATE_LIMIT_LLM_PER_MINUTE", "6"))
+    RATE_LIMIT_LLM_BURST = int(os.getenv("RATE_LIMIT_LLM_BURST", "3"))
+    RATE_LIMIT_SHARED = os.getenv("RATE_LIMIT_SHARED", "false").lower() == "true"
+    # Faixas de execução: turnos com LLM em pool próprio, resposta enviada pela API do Twilio
+    TURN_LANES_ENABLED = os.getenv("TURN_LANES_ENABLED", "true" if OUTBOUND_SENDER == "twilio" else "false").lower() == "true"
+    LLM_LANE_WORKERS = int(os.getenv("LLM_LANE_WORKERS", os.getenv("LLM_MAX_IN_FLIGHT", "8")))
+    LLM_LANE_QUEUE_MAX = int(os.getenv("LLM_LANE_QUEUE_MAX", "64"))
+    # Resumo contínuo da conversa
+    SUMMARY_TRIGGER_MESSAGES = int(os.getenv("SUMMARY_TRIGGER_MESSAGES", "12"))
+    SUMMARY_KEEP_RAW_MESSAGES = int(os.getenv("SUMMARY_KEEP_RAW_MESSAGES", "4"))
+    SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "600"))
+    SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "1"))
+    # FAQ local: confiança mínima (0 a 1) para responder sem o LLM
+    FAQ_MIN_SCORE = float(os.getenv("FAQ_MIN_SCORE", "0.6"))
+    # Rastreamento de comandos do MongoDB
+    MONGO_TRACE_ENABLED = os.getenv("MONGO_TRACE_ENABLED", "true").lower() == "true"
+    MONGO_SLOW_QUERY_MS = float(os.getenv("MONGO_SLOW_QUERY_MS", "100"))
+    MONGO_TRACE_RECENT = int(os.getenv("MONGO_TRACE_RECENT", "50"))
+    # Perfis de durabilidade/leitura por coleção ("w=...,j=...,wtimeout=...,read=...")
+    MONGO_PROFILE_HISTORY = os.getenv("MONGO_PROFILE_HISTORY", "w=1,j=false")
+    MONGO_PROFILE_RESERVATIONS = os.getenv("MONGO_PROFILE_RESERVATIONS", "w=majority,j=true,wtimeout=5000,read=primary")
+    MONGO_PROFILE_CATALOG = os.getenv("MONGO_PROFILE_CATALOG", "w=majority,read=secondaryPreferred")
+    # Resumo de disponibilidade por quadra injetado no prompt do LLM
+    AVAILABILITY_DIGEST_DAYS = int(os.getenv("AVAILABILITY_DIGEST_DAYS", "3"))
+    AVAILABILITY_DIGEST_MAX_TOKENS = int(os.getenv("AVAILABILITY_DIGEST_MAX_TOKENS", "350"))
+    AVAILABILITY_DIGEST_TTL_SECONDS = float(os.getenv("AVAILABILITY_DIGEST_TTL_SECONDS", "60"))
+    # Feeds iCalendar (/calendar/...)
+    CALENDAR_TOKEN_SECRET = os.getenv("CALENDAR_TOKEN_SECRET", "")
+    CALENDAR_TIMEZONE = os.getenv("CALENDAR_TIMEZONE", "America/Sao_Paulo")
+    CALENDAR_PAST_DAYS = int(os.getenv("CALENDAR_PAST_DAYS", "30"))
+    CALENDAR_CACHE_SIZE = int(os.getenv("CALENDAR_CACHE_SIZE", "1000"))
+    CALENDAR_CACHE_TTL_SECONDS = float(os.getenv("CALENDAR_CACHE_TTL_SECONDS", "300"))
+    PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+    # Histórico com escrita adiada (write-behind)
+    HISTORY_WRITE_BEHIND = os.getenv("HISTORY_WRITE_BEHIND", "true").lower() == "true"
+    HISTORY_FLUSH_INTERVAL_MS = float(os.getenv("HISTORY_FLUSH_INTERVAL_MS", "50"))
+    HISTORY_FLUSH_BATCH = int(os.getenv("HISTORY_FLUSH_BATCH", "200"))
 
 settings = SimpleSettings()
 
-# Cliente Groq (opcional)
-groq_client = None
-if settings.USE_LLM and settings.GROQ_API_KEY:
+# ===== MÉTRICAS =====
+class MetricsRegistry:
+    """Registro simples de métricas (contadores, gauges e resumos) exportado em /metrics"""
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._summaries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = float(value)
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            count, total, maximum = self._summaries.get(key, (0, 0.0, 0.0))
+            self._summaries[key] = (count + 1, total + value, max(maximum, value))
+
+    def get(self, name: str, **labels) -> float:
+        key = self._key(name, labels)
+        with self._lock:
+            return self._counters.get(key, self._gauges.get(key, 0.0))
+
+    @staticmethod
+    def _format(name: str, labels: tuple, value: float) -> str:
+        if labels:
+            rendered = ",".join(f'{k}="{v}"' for k, v in labels)
+            return f"{name}{{{rendered}}} {value}"
+        return f"{name} {value}"
+
+    def render(self) -> str:
+        """Exporta no formato texto do Prometheus"""
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(self._format(name, labels, value))
+            for (name, labels), value in sorted(self._gauges.items()):
+                lines.append(self._format(name, labels, value))
+            for (name, labels), (count, total, maximum) in sorted(self._summaries.items()):
+                lines.append(self._format(f"{name}_count", labels, count))
+                lines.append(self._format(f"{name}_sum", labels, round(total, 6)))
+                lines.append(self._format(f"{name}_max", labels, round(maximum, 6)))
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+# ===== GATEWAY LLM =====
+class LLMUnavailableError(Exception):
+    """LLM indisponível: desabilitado, circuito aberto, fila cheia ou falha após retentativas"""
+
+class CircuitBreaker:
+    """Circuit breaker: abre após N falhas seguidas e libera uma sondagem após o cooldown"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        metrics.set_gauge("llm_circuit_state", 0)
+
+    def _transition(self, state: str):
+        if state != self.state:
+            logger.warning(f"[LLM-CIRCUITO] {self.state} -> {state}")
+            self.state = state
+            metrics.set_gauge("llm_circuit_state", self.STATE_VALUES[state])
+            metrics.inc("llm_circuit_transitions_total", to=state)
+
+    def is_open(self) -> bool:
+        """Aberto e ainda no cooldown; passado o cooldown a próxima chamada vira a sondagem do half-open"""
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_seconds
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_seconds:
+                    return False
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def release_probe(self):
+        """Libera a sondagem do half-open sem registrar resultado (a chamada nem chegou ao LLM)"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probe_in_flight = False
+            self._transition(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._transition(self.OPEN)
+
+class LLMGateway:
+    """Acesso ao Groq com pool HTTP keep-alive, limite de concorrência, retentativas com jitter e circuit breaker"""
+
+    def __init__(self, client, max_in_flight: int, queue_timeout_seconds: float,
+                 max_retries: int, retry_base_seconds: float, breaker: CircuitBreaker):
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.breaker = breaker
+        self.waiting = 0
+        self.in_flight = 0
+        self.latency_ewma = 0.0
+        self.latency_updated_at = 0.0
+        self._semaphore = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        """Há cliente configurado e o circuito não está aberto (ou já cumpriu o cooldown)"""
+        return self.client is not None and not self.breaker.is_open()
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        if isinstance(error, (groq.RateLimitError, groq.APIConnectionError)):
+            return True
+        return isinstance(error, groq.APIStatusError) and error.status_code >= 500
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        # Respeita Retry-After em 429; senão backoff exponencial com jitter completo
+        if isinstance(error, groq.RateLimitError):
+            retry_after = error.response.headers.get("retry-after")
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.queue_timeout_seconds)
+                except ValueError:
+                    pass
+        return random.uniform(0, self.retry_base_seconds * (2 ** attempt))
+
+    def _set_gauges(self):
+        metrics.set_gauge("llm_queue_waiting", self.waiting)
+        metrics.set_gauge("llm_in_flight", self.in_flight)
+
+    def chat(self, **kwargs):
+        """Executa chat.completions.create protegido; levanta LLMUnavailableError se não for possível"""
+        if self.client is None:
+            raise LLMUnavailableError("LLM desabilitado")
+        if not self.breaker.allow():
+            metrics.inc("llm_rejected_total", reason="circuit_open")
+            raise LLMUnavailableError("Circuito do LLM aberto")
+
+        wait_start = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+            self._set_gauges()
+        acquired = self._semaphore.acquire(timeout=self.queue_timeout_seconds)
+        with self._lock:
+            self.waiting -= 1
+            self._set_gauges()
+        metrics.observe("llm_queue_wait_seconds", time.monotonic() - wait_start)
+        if not acquired:
+            metrics.inc("llm_rejected_total", reason="queue_timeout")
+            self.breaker.release_probe()
+            raise LLMUnavailableError("Fila do LLM cheia")
+
+        with self._lock:
+            self.in_flight += 1
+            self._set_gauges()
+        try:
+            return self._call_with_retries(kwargs)
+        finally:
+            self._semaphore.release()
+            with self._lock:
+                self.in_flight -= 1
+                self._set_gauges()
+
+    def _call_with_retries(self, kwargs: dict):
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            try:
+                response = self.client.chat.completions.create(**kwargs)
+                elapsed = time.monotonic() - start
+                self.latency_ewma = elapsed if not self.latency_ewma else 0.8 * self.latency_ewma + 0.2 * elapsed
+                self.latency_updated_at = time.monotonic()
+                model = kwargs.get("model", "")
+                metrics.observe("llm_request_seconds", elapsed, model=model)
+                usage = getattr(response, "usage", None)
+                if usage is not None:
+                    metrics.observe("llm_prompt_tokens", usage.prompt_tokens, model=model)
+                    metrics.observe("llm_completion_tokens", usage.completion_tokens, model=model)
+                self.breaker.record_success()
+                return response
+            except Exception as e:
+                metrics.inc("llm_errors_total", kind=type(e).__name__)
+                if not self._is_retryable(e):
+                    # Erro do pedido (ex.: 400), não do serviço: não conta para o circuito,
+                    # nem como sucesso (só libera a sondagem do half-open)
+                    self.breaker.release_probe()
+                    raise LLMUnavailableError(str(e)) from e
+                if attempt == self.max_retries:
+                    self.breaker.record_failure()
+                    raise LLMUnavailableError(str(e)) from e
+                delay = self._retry_delay(e, attempt)
+                metrics.inc("llm_retries_total")
+                logger.warning(f"[LLM-RETRY] Tentativa {attempt + 1} falhou ({type(e).__name__}); nova tentativa em {delay:.2f}s")
+                time.sleep(delay)
+
+def build_groq_client():
+    """Cria o cliente Groq com pool HTTP keep-alive (None se o LLM estiver desabilitado)"""
+    if not (settings.USE_LLM and settings.GROQ_API_KEY):
+        return None
     try:
-        groq_client = Groq(api_key=settings.GROQ_API_KEY)
+        http_client = DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=settings.LLM_POOL_CONNECTIONS,
+                max_keepalive_connections=settings.LLM_POOL_CONNECTIONS,
+                keepalive_expiry=60
+            ),
+            timeout=settings.LLM_TIMEOUT_SECONDS
+        )
+        client = Groq(api_key=settings.GROQ_API_KEY, http_client=http_client,
+                      timeout=settings.LLM_TIMEOUT_SECONDS, max_retries=0)
         logger.info("Groq LLM habilitado.")
+        return client
     except Exception as e:
         logger.error(f"Falha ao inicializar Groq: {e}")
-        groq_client = None
+        return None
+
+class ModelRouter:
+    """
+    Escolhe o modelo de cada turno do LLM pela complexidade da mensagem: tamanho, número de
+    entidades (data, hora, duração, quadra, estabelecimento, recorrência), sinais de
+    negociação ("ou", "mais barato"...), estado pendente e profundidade do histórico.
+    Abaixo de LLM_ROUTER_THRESHOLD vai para o modelo rápido; acima, para o grande.
+    Cada rota tem seus próprios max_tokens e temperatura.
+    """
+    FAST = "rapido"
+    LARGE = "grande"
+    NEGOTIATION_PATTERN = re.compile(
+        r"\b(ou|mas|porem|entao|caso|se nao|mais barat\w*|melhor|diferenc\w*|compar\w*|troc\w*|mud\w*|em vez)\b"
+    )
+
+    def __init__(self, routes: Dict[str, dict], threshold: float):
+        self.routes = routes
+        self.threshold = threshold
+
+    def score(self, text: str, pending: Optional[dict], history_depth: int) -> float:
+        normalized = normalize_text(text)
+        words = len(normalized.split())
+        score = 0.0
+        if words > 12:
+            score += 1
+        if words > 30:
+            score += 1
+        courts = catalog_cache.get_courts()
+        entities = sum([
+            parse_date(text) is not None,
+            parse_time(text) is not None,
+            bool(HOURS_QTY_PATTERN.search(text)),
+            any(c.nome.lower() in text.lower() for c in courts),
+            extract_establishment_from_text(text) is not None,
+        ])
+        # Uma entidade isolada é um complemento ("e amanhã?"); várias juntas são restrições a combinar
+        score += max(0, entities - 1)
+        if parse_recurrence(text):
+            score += 2
+        score += min(2, len(self.NEGOTIATION_PATTERN.findall(normalized)))
+        if text.count("?") > 1:
+            score += 1
+        if pending and pending.get("awaiting"):
+            score += 1
+        if history_depth >= 8:
+            score += 1
+        return score
+
+    def route(self, text: str, pending: Optional[dict] = None, history_depth: int = 0) -> dict:
+        """{"route", "model", "max_tokens", "temperature", "score"} para o turno"""
+        score = self.score(text, pending, history_depth)
+        name = self.LARGE if score >= self.threshold else self.FAST
+        metrics.inc("llm_route_total", route=name)
+        return {"route": name, "score": score, **self.routes[name]}
+
+model_router = ModelRouter(
+    {
+        ModelRouter.FAST: {"model": settings.GROQ_FAST_MODEL, "max_tokens": settings.LLM_FAST_MAX_TOKENS,
+                           "temperature": settings.LLM_FAST_TEMPERATURE},
+        ModelRouter.LARGE: {"model": settings.GROQ_LARGE_MODEL, "max_tokens": settings.LLM_LARGE_MAX_TOKENS,
+                            "temperature": settings.LLM_LARGE_TEMPERATURE},
+    },
+    threshold=settings.LLM_ROUTER_THRESHOLD
+)
+
+# Cliente Groq (opcional), sempre acessado através do gateway
+llm_gateway = LLMGateway(
+    build_groq_client(),
+    max_in_flight=settings.LLM_MAX_IN_FLIGHT,
+    queue_timeout_seconds=settings.LLM_QUEUE_TIMEOUT_SECONDS,
+    max_retries=settings.LLM_MAX_RETRIES,
+    retry_base_seconds=settings.LLM_RETRY_BASE_SECONDS,
+    breaker=CircuitBreaker(settings.LLM_BREAKER_FAILURE_THRESHOLD, settings.LLM_BREAKER_RESET_SECONDS)
+)
 
 # Criação da aplicação Flask
 app = Flask(__name__)
 
 # ===== MODELOS =====
+def normalize_phone(phone: str) -> str:
+    """
+    Identidade canônica do usuário em E.164 (ex.: "whatsapp:+55 11 99999-9999" -> "+5511999999999").
+
+    Aplicada uma vez na entrada de cada mensagem; usuários, reservas, estados e histórico
+    usam sempre essa forma.
+    """
+    digits = re.sub(r'\D', '', phone or "")
+    if not digits:
+        return ""
+    if not (phone or "").replace("whatsapp:", "").strip().startswith('+') and not digits.startswith('55'):
+        digits = '55' + digits
+    return '+' + digits
+
 class User:
     """Modelo para Usuário"""
     
@@ -61,15 +509,7 @@ class User:
     
     def _validate_phone(self, phone: str) -> str:
         """Valida formato do telefone"""
-        telefone_limpo = re.sub(r'[^\d+]', '', phone)
-        
-        if not telefone_limpo.startswith('+'):
-            if telefone_limpo.startswith('55'):
-                telefone_limpo = '+' + telefone_limpo
-            else:
-                telefone_limpo = '+55' + telefone_limpo
-        
-        return telefone_limpo
+        return normalize_phone(phone)
     
     def to_dict(self):
         """Converte para dicionário (omitindo _id quando None)"""
@@ -92,11 +532,22 @@ class User:
             criado_em=data.get("criado_em")
         )
 
+def geo_point(latitude, longitude) -> dict:
+    """Ponto GeoJSON (coordenadas em [longitude, latitude], como o índice 2dsphere espera)"""
+    try:
+        lat, lng = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        raise ValueError("latitude/longitude devem ser numéricas")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("latitude/longitude fora do intervalo válido")
+    return {"type": "Point", "coordinates": [lng, lat]}
+
 class Establishment:
     """Modelo para Estabelecimento"""
     
     def __init__(self, nome: str, endereco: dict, telefone: str, email: str = "", 
-                 ativo: bool = True, criado_em: Optional[datetime] = None, _id: Optional[str] = None):
+                 ativo: bool = True, criado_em: Optional[datetime] = None, _id: Optional[str] = None,
+                 localizacao: Optional[dict] = None):
         self._id = _id
         self.nome = nome
         self.endereco = endereco
@@ -104,6 +555,15 @@ class Establishment:
         self.email = email
         self.ativo = ativo
         self.criado_em = criado_em or datetime.now()
+        self.localizacao = localizacao  # Ponto GeoJSON (ver geo_point)
+
+    @property
+    def latitude(self) -> Optional[float]:
+        return self.localizacao["coordinates"][1] if self.localizacao else None
+
+    @property
+    def longitude(self) -> Optional[float]:
+        return self.localizacao["coordinates"][0] if self.localizacao else None
     
     def to_dict(self):
         """Converte para dicionário (omitindo _id quando None)"""
@@ -115,6 +575,8 @@ class Establishment:
             "ativo": self.ativo,
             "criado_em": self.criado_em.isoformat()
         }
+        if self.localizacao:
+            data["localizacao"] = self.localizacao
         if self._id:
             data["_id"] = self._id
         return data
@@ -129,7 +591,8 @@ class Establishment:
             telefone=data.get("telefone", ""),
             email=data.get("email", ""),
             ativo=data.get("ativo", True),
-            criado_em=datetime.fromisoformat(data.get("criado_em")) if data.get("criado_em") else datetime.now()
+            criado_em=datetime.fromisoformat(data.get("criado_em")) if data.get("criado_em") else datetime.now(),
+            localizacao=data.get("localizacao")
         )
 
 class Court:
@@ -175,13 +638,163 @@ class Court:
             criado_em=datetime.fromisoformat(data.get("criado_em")) if data.get("criado_em") else datetime.now()
         )
 
+# ===== RASTREAMENTO DO MONGODB =====
+current_request_id: ContextVar[Optional[str]] = ContextVar("current_request_id", default=None)
+
+FILTER_FIELDS = {"find": "filter", "count": "query", "findAndModify": "query", "distinct": "query"}
+WRITE_FIELDS = {"update": ("updates", "q"), "delete": ("deletes", "q")}
+
+def filter_shape(value):
+    """Forma do filtro sem os valores (ex.: {"court_id": "?", "data_reserva": {"$gte": "?"}})"""
+    if isinstance(value, dict):
+        return {key: filter_shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [filter_shape(value[0])] if value and isinstance(value[0], (dict, list)) else "?"
+    return "?"
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """
+    Listener de comandos do pymongo: marca cada comando com o ID da requisição em andamento,
+    agrega contagem e duração por (coleção, operação) em cada turno, registra as consultas
+    lentas com a forma do filtro e guarda os últimos N rastros para o /debug/db.
+    """
+
+    def __init__(self, slow_query_ms: float, keep_recent: int):
+        self.slow_query_ms = slow_query_ms
+        self._started = {}
+        self._traces = {}
+        self.recent = deque(maxlen=keep_recent)
+        self.slow_queries = deque(maxlen=keep_recent)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _describe(event) -> Tuple[str, dict]:
+        command = event.command
+        collection = command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = command.get("collection")
+        if not isinstance(collection, str):
+            collection = "-"
+        if event.command_name in FILTER_FIELDS:
+            shape = filter_shape(command.get(FILTER_FIELDS[event.command_name]) or {})
+        elif event.command_name in WRITE_FIELDS:
+            field, key = WRITE_FIELDS[event.command_name]
+            statements = command.get(field) or [{}]
+            shape = filter_shape(statements[0].get(key) or {})
+        elif event.command_name == "aggregate":
+            shape = filter_shape(next((stage["$match"] for stage in command.get("pipeline", []) if "$match" in stage), {}))
+        else:
+            shape = {}
+        return collection, shape
+
+    def start_request(self, request_id: str, path: str):
+        with self._lock:
+            self._traces[request_id] = {"request_id": request_id, "path": path,
+                                        "inicio": datetime.now().isoformat(), "comandos": {}}
+
+    def end_request(self, request_id: str, duration_ms: float):
+        with self._lock:
+            trace = self._traces.pop(request_id, None)
+        if trace is None:
+            return
+        total = sum(entry["count"] for entry in trace["comandos"].values())
+        trace["total_comandos"] = total
+        trace["total_ms"] = round(sum(entry["ms"] for entry in trace["comandos"].values()), 2)
+        trace["duracao_ms"] = round(duration_ms, 2)
+        trace["comandos"] = [{"colecao_operacao": key, **entry} for key, entry in trace["comandos"].items()]
+        self.recent.append(trace)
+        metrics.observe("mongo_commands_per_request", total)
+
+    def started(self, event):
+        collection, shape = self._describe(event)
+        self._started[event.request_id] = (current_request_id.get(), collection, shape)
+
+    def succeeded(self, event):
+        self._finish(event, ok=True)
+
+    def failed(self, event):
+        self._finish(event, ok=False)
+
+    def _finish(self, event, ok: bool):
+        info = self._started.pop(event.request_id, None)
+        if info is None:
+            return
+        request_id, collection, shape = info
+        duration_ms = event.duration_micros / 1000.0
+        metrics.observe("mongo_command_seconds", duration_ms / 1000.0, collection=collection, op=event.command_name)
+        if not ok:
+            metrics.inc("mongo_command_errors_total", collection=collection, op=event.command_name)
+        if duration_ms >= self.slow_query_ms:
+            entry = {"request_id": request_id, "colecao": collection, "operacao": event.command_name,
+                     "filtro": shape, "ms": round(duration_ms, 2), "em": datetime.now().isoformat()}
+            self.slow_queries.append(entry)
+            logger.warning(f"[MONGO-LENTO] {collection}.{event.command_name} {duration_ms:.1f}ms "
+                           f"filtro={json.dumps(shape)} request={request_id}")
+        if request_id is None:
+            return
+        with self._lock:
+            trace = self._traces.get(request_id)
+            if trace is not None:
+                entry = trace["comandos"].setdefault(f"{collection}.{event.command_name}", {"count": 0, "ms": 0.0})
+                entry["count"] += 1
+                entry["ms"] = round(entry["ms"] + duration_ms, 3)
+
+    def stats(self) -> dict:
+        return {"recentes": list(self.recent), "lentas": list(self.slow_queries),
+                "limite_lento_ms": self.slow_query_ms}
+
+mongo_tracer = MongoCommandTracer(settings.MONGO_SLOW_QUERY_MS, settings.MONGO_TRACE_RECENT)
+
 # ===== CONEXÃO MONGODB =====
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+def parse_mongo_profile(spec: str) -> dict:
+    """
+    Converte "w=majority,j=true,wtimeout=5000,read=secondaryPreferred" nas opções de
+    Collection.with_options (write_concern e read_preference); chaves ausentes mantêm o padrão.
+    """
+    write_concern, options = {}, {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        key, value = (part.strip() for part in item.split("=", 1))
+        if key == "w":
+            write_concern["w"] = int(value) if value.isdigit() else value
+        elif key == "j":
+            write_concern["j"] = value.lower() == "true"
+        elif key == "wtimeout":
+            write_concern["wtimeout"] = int(value)
+        elif key == "read":
+            options["read_preference"] = READ_PREFERENCES[value]
+        else:
+            raise ValueError(f"Opção de perfil do MongoDB desconhecida: {key}")
+    if write_concern:
+        options["write_concern"] = WriteConcern(**write_concern)
+    return options
+
 class MongoDBConnection:
     """Classe para gerenciar conexão MongoDB"""
+    # Perfis por repositório: histórico barato de gravar, reservas duráveis, catálogo lido das secundárias
+    # (exceto onde é preciso ler a própria escrita: ver primary_reads)
+    HISTORY = "historico"
+    RESERVATIONS = "reservas"
+    CATALOG = "catalogo"
     
     def __init__(self):
         self.client = None
         self.db = None
+        self.profiles = {
+            self.HISTORY: parse_mongo_profile(settings.MONGO_PROFILE_HISTORY),
+            self.RESERVATIONS: parse_mongo_profile(settings.MONGO_PROFILE_RESERVATIONS),
+            self.CATALOG: parse_mongo_profile(settings.MONGO_PROFILE_CATALOG),
+        }
+        self._profiled = {}
         
     def connect_sync(self):
         """Conecta ao MongoDB de forma síncrona (para Flask)"""
@@ -189,7 +802,8 @@ class MongoDBConnection:
             mongodb_uri = settings.MONGODB_URI
             mongodb_db = settings.MONGODB_DB
             
-            self.client = MongoClient(mongodb_uri)
+            listeners = [mongo_tracer] if settings.MONGO_TRACE_ENABLED else []
+            self.client = MongoClient(mongodb_uri, event_listeners=listeners)
             self.db = self.client[mongodb_db]
             
             # Testa a conexão
@@ -206,15 +820,105 @@ class MongoDBConnection:
             self.client.close()
             logger.info("Conexão MongoDB fechada")
     
-    def get_collection(self, collection_name: str):
-        """Retorna uma coleção MongoDB"""
+    def get_collection(self, collection_name: str, profile: Optional[str] = None):
+        """
+        Retorna uma coleção MongoDB, com o write concern/read preference do perfil (se houver).
+        Dentro de primary_reads() a leitura vai sempre para a primária, mantendo o write concern.
+        """
         if self.db is None:
             raise RuntimeError("Database não foi inicializada. Chame connect_sync() primeiro.")
-        return self.db[collection_name]
+        options = self.profiles.get(profile)
+        if not options:
+            return self.db[collection_name]
+        primary = reading_from_primary.get() and options.get("read_preference", ReadPreference.PRIMARY) != ReadPreference.PRIMARY
+        if primary:
+            options = {**options, "read_preference": ReadPreference.PRIMARY}
+        # with_options cria um novo objeto: guarda um por (coleção, perfil) enquanto o banco for o mesmo
+        key = (collection_name, profile, primary)
+        cached = self._profiled.get(key)
+        if cached is None or cached.database is not self.db:
+            cached = self._profiled[key] = self.db[collection_name].with_options(**options)
+        return cached
 
 # Instância global
 mongodb = MongoDBConnection()
 
+# Leituras que precisam ver a própria escrita (read-after-write) não podem ir para uma secundária atrasada
+reading_from_primary: ContextVar[bool] = ContextVar("reading_from_primary", default=False)
+
+@contextmanager
+def primary_reads():
+    """Força leitura na primária para as coleções obtidas enquanto o bloco executa"""
+    token = reading_from_primary.set(True)
+    try:
+        yield
+    finally:
+        reading_from_primary.reset(token)
+
+# ===== PARTICIONAMENTO POR ESTABELECIMENTO =====
+# Estabelecimento da partição que está processando a requisição atual
+current_establishment: ContextVar[Optional[str]] = ContextVar("current_establishment", default=None)
+
+def current_scope(establishment_id: Optional[str] = None) -> Optional[str]:
+    """Retorna o estabelecimento da partição ativa (explícito ou do contexto da requisição)"""
+    if establishment_id:
+        return establishment_id
+    if settings.PARTITION_MODE == "establishment":
+        return current_establishment.get()
+    return None
+
+@contextmanager
+def partition_scope(establishment_id: Optional[str]):
+    """Define a partição ativa enquanto o bloco executa"""
+    token = current_establishment.set(establishment_id)
+    try:
+        yield
+    finally:
+        current_establishment.reset(token)
+
+class PartitionedCache:
+    """Cache LRU particionado por estabelecimento, com capacidade própria por partição"""
+    SHARED = "_shared"
+
+    def __init__(self, capacity_per_partition: int):
+        self.capacity_per_partition = capacity_per_partition
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def get(self, partition: Optional[str], key, default=None):
+        with self._lock:
+            entries = self._partitions.get(partition or self.SHARED)
+            if entries is None or key not in entries:
+                return default
+            entries.move_to_end(key)
+            return entries[key]
+
+    def set(self, partition: Optional[str], key, value):
+        with self._lock:
+            entries = self._partitions.setdefault(partition or self.SHARED, OrderedDict())
+            entries[key] = value
+            entries.move_to_end(key)
+            while len(entries) > self.capacity_per_partition:
+                entries.popitem(last=False)
+
+    def delete(self, partition: Optional[str], key):
+        with self._lock:
+            entries = self._partitions.get(partition or self.SHARED)
+            if entries is not None:
+                entries.pop(key, None)
+
+    def invalidate_partition(self, partition: Optional[str]):
+        with self._lock:
+            self._partitions.pop(partition or self.SHARED, None)
+
+    def clear(self):
+        with self._lock:
+            self._partitions.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {partition: len(entries) for partition, entries in self._partitions.items()}
+
 # ===== REPOSITÓRIOS =====
 class UserRepository:
     """Repositório para operações de usuários"""
@@ -250,27 +954,135 @@ class UserRepository:
             raise
     
     def find_or_create_by_phone(self, phone: str, name: str = "Usuário") -> User:
-        """Busca ou cria usuário por telefone"""
+        """Busca ou cria usuário por telefone em uma única ida ao banco (upsert pelo telefone canônico)"""
+        new_user = User(nome=name, telefone=phone)
         try:
-            user = self.get_by_phone(phone)
-            if not user:
-                user = User(nome=name, telefone=phone)
-                user_id = self.create(user)
-                user._id = user_id
-            return user
+            user_data = self.get_collection().find_one_and_update(
+                {"telefone": new_user.telefone},
+                {"$setOnInsert": {"nome": new_user.nome, "criado_em": new_user.criado_em}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Dois upserts concorrentes para o mesmo telefone: o outro venceu, basta ler
+            user_data = self.get_collection().find_one({"telefone": new_user.telefone})
         except Exception as e:
             logger.error(f"Erro ao buscar/criar usuário: {e}")
             raise
+        return User.from_dict(user_data)
+
+    def set_calendar_token(self, phone: str, token: str):
+        """Grava o token do feed de calendário do usuário (no-op se já for o mesmo)"""
+        self.get_collection().update_one(
+            {"telefone": phone, "calendar_token": {"$ne": token}},
+            {"$set": {"calendar_token": token}}
+        )
+
+    def get_phone_by_calendar_token(self, token: str) -> Optional[str]:
+        doc = self.get_collection().find_one(
+            {"$or": [{"calendar_token": token}, {"calendar_tokens_anteriores": token}]}, {"telefone": 1})
+        return doc.get("telefone") if doc else None
+
+    def dedup(self) -> dict:
+        """
+        Migração: unifica usuários duplicados pelo telefone canônico e normaliza o telefone
+        nas coleções que o usam como chave (reservas, histórico, estados e lista de espera).
+
+        Fica o usuário mais antigo do grupo; as reservas dos removidos passam a apontar para ele
+        e os tokens de calendário deles continuam válidos (calendar_tokens_anteriores).
+        Rode com o tráfego parado: até o índice único ser criado no final, um upsert de
+        find_or_create_by_phone no meio da migração pode criar outra duplicata.
+        """
+        report = {"usuarios_removidos": 0, "usuarios_normalizados": 0, "reservas_reapontadas": 0}
+        groups = {}
+        for doc in self.get_collection().find({}, {"telefone": 1, "nome": 1, "criado_em": 1, "calendar_token": 1}):
+            groups.setdefault(normalize_phone(doc.get("telefone", "")), []).append(doc)
+        operations, repoints, duplicates = [], [], []
+        for phone, docs in groups.items():
+            docs.sort(key=lambda d: d.get("criado_em", ""))
+            keeper = docs[0]
+            nome = next((d["nome"] for d in docs if d.get("nome") and d["nome"] != "Usuário"), keeper.get("nome"))
+            tokens = [d["calendar_token"] for d in docs[1:] if d.get("calendar_token")]
+            if keeper.get("telefone") != phone or keeper.get("nome") != nome or tokens:
+                update = {"$set": {"telefone": phone, "nome": nome}}
+                if tokens and not keeper.get("calendar_token"):
+                    update["$set"]["calendar_token"] = tokens.pop(0)
+                if tokens:
+                    update["$addToSet"] = {"calendar_tokens_anteriores": {"$each": tokens}}
+                operations.append(UpdateOne({"_id": keeper["_id"]}, update))
+            removed = [d["_id"] for d in docs[1:]]
+            if removed:
+                # usuario._id embutido na reserva é a string do ObjectId (User.from_dict)
+                repoints.append(UpdateMany(
+                    {"usuario._id": {"$in": removed + [str(_id) for _id in removed]}},
+                    {"$set": {"usuario._id": str(keeper["_id"])}}
+                ))
+            duplicates.extend(removed)
+        if repoints:
+            report["reservas_reapontadas"] = mongodb.get_collection("reservas").bulk_write(repoints, ordered=False).modified_count
+        if duplicates:
+            # Remove antes de normalizar o sobrevivente para não violar o índice único
+            report["usuarios_removidos"] = self.get_collection().delete_many({"_id": {"$in": duplicates}}).deleted_count
+        if operations:
+            report["usuarios_normalizados"] = self.get_collection().bulk_write(operations, ordered=False).modified_count
+
+        for collection_name, field in (("reservas", "usuario.telefone"), ("lista_espera", "phone")):
+            collection = mongodb.get_collection(collection_name)
+            operations = [
+                UpdateMany({field: raw}, {"$set": {field: normalize_phone(raw)}})
+                for raw in collection.distinct(field) if raw and raw != normalize_phone(raw)
+            ]
+            report[collection_name] = collection.bulk_write(operations, ordered=False).modified_count if operations else 0
+        report["conversation_history"] = self._merge_histories()
+        # Estados de conversa são efêmeros: os de telefone não canônico são descartados
+        states = mongodb.get_collection("estados_conversa")
+        stale = [raw for raw in states.distinct("phone") if raw != normalize_phone(raw)]
+        report["estados_conversa"] = states.delete_many({"phone": {"$in": stale}}).deleted_count if stale else 0
+
+        self.get_collection().create_index("telefone", unique=True)
+        return report
+
+    @staticmethod
+    def _merge_histories() -> int:
+        """
+        Histórico tem um documento por telefone: documentos cujo telefone canônico coincide
+        são fundidos no mais recente (mensagens intercaladas por horário), e os demais removidos.
+        """
+        history = mongodb.get_collection("conversation_history")
+        groups = {}
+        for doc in history.find({}, {"phone": 1}):
+            if doc.get("phone"):
+                groups.setdefault(normalize_phone(doc["phone"]), []).append(doc)
+        operations = []
+        for phone, docs in groups.items():
+            if len(docs) == 1:
+                if docs[0]["phone"] != phone:
+                    operations.append(UpdateOne({"_id": docs[0]["_id"]}, {"$set": {"phone": phone}}))
+                continue
+            full = sorted(history.find({"_id": {"$in": [d["_id"] for d in docs]}}),
+                          key=lambda d: d.get("last_activity") or "")
+            keeper = full[-1]
+            messages = sorted((m for d in full for m in d.get("messages", [])), key=lambda m: m.get("timestamp", ""))
+            operations.append(DeleteMany({"_id": {"$in": [d["_id"] for d in full[:-1]]}}))
+            operations.append(UpdateOne({"_id": keeper["_id"]}, {"$set": {"phone": phone, "messages": messages}}))
+        if operations:
+            history.bulk_write(operations, ordered=True)
+        return len(operations)
 
 class EstablishmentRepository:
     """Repositório para operações de estabelecimentos"""
     
-    def __init__(self):
+    def __init__(self, establishment_id: Optional[str] = None):
         self.collection_name = "establishments"
+        self.establishment_id = establishment_id
+    
+    def scoped(self, establishment_id: str) -> "EstablishmentRepository":
+        """Retorna o repositório restrito a um estabelecimento"""
+        return EstablishmentRepository(establishment_id)
     
     def get_collection(self):
         """Retorna a coleção de estabelecimentos"""
-        return mongodb.get_collection(self.collection_name)
+        return mongodb.get_collection(self.collection_name, MongoDBConnection.CATALOG)
     
     def create(self, establishment: Establishment) -> str:
         """Cria um novo estabelecimento"""
@@ -278,17 +1090,82 @@ class EstablishmentRepository:
             collection = self.get_collection()
             result = collection.insert_one(establishment.to_dict())
             logger.info(f"Estabelecimento criado com ID: {result.inserted_id}")
+            catalog_cache.bump()
             return str(result.inserted_id)
         except Exception as e:
             logger.error(f"Erro ao criar estabelecimento: {e}")
             raise
+
+    @staticmethod
+    def natural_key(establishment: Establishment) -> dict:
+        """Chave natural usada na importação: nome + cidade"""
+        return {"nome": establishment.nome, "endereco.cidade": establishment.endereco.get("cidade", "")}
+
+    def bulk_upsert(self, establishments: List[Establishment]) -> Tuple[Dict[int, str], dict, List[dict]]:
+        """
+        Insere/atualiza estabelecimentos pela chave natural em um único bulk_write (não ordenado).
+        Não incrementa a versão do catálogo: quem importa faz isso uma vez ao final.
+
+        Retorna ({índice: _id}, contagens, erros por índice).
+        """
+        operations = []
+        for establishment in establishments:
+            data = establishment.to_dict()
+            fields = {f"endereco.{key}": value for key, value in data.pop("endereco").items()}
+            fields.update({key: data[key] for key in ("telefone", "email", "ativo")})
+            if "localizacao" in data:
+                fields["localizacao"] = data["localizacao"]
+            operations.append(UpdateOne(
+                self.natural_key(establishment),
+                {"$set": fields, "$setOnInsert": {"criado_em": data["criado_em"]}},
+                upsert=True
+            ))
+        counts, errors = bulk_write_report(self.get_collection(), operations)
+        failed = {error["indice"] for error in errors}
+        keys = [self.natural_key(e) for i, e in enumerate(establishments) if i not in failed]
+        ids_by_key = {}
+        if keys:
+            # Os _id recém-inseridos só existem com certeza na primária
+            with primary_reads():
+                docs = list(self.get_collection().find({"$or": keys}, {"nome": 1, "endereco.cidade": 1}))
+            for doc in docs:
+                ids_by_key[(doc["nome"], doc.get("endereco", {}).get("cidade", ""))] = str(doc["_id"])
+        ids = {}
+        for index, establishment in enumerate(establishments):
+            key = (establishment.nome, establishment.endereco.get("cidade", ""))
+            if index not in failed and key in ids_by_key:
+                ids[index] = ids_by_key[key]
+        return ids, counts, errors
     
+    def find_near(self, latitude: float, longitude: float, max_km: float, limit: int) -> List[Tuple[Establishment, float]]:
+        """Estabelecimentos ativos mais próximos do ponto (via índice 2dsphere), com a distância em km"""
+        query = {"ativo": True}
+        scope = current_scope(self.establishment_id)
+        if scope:
+            query["_id"] = ObjectId(scope)
+        pipeline = [
+            {"$geoNear": {
+                "near": geo_point(latitude, longitude),
+                "distanceField": "distancia_m",
+                "maxDistance": max_km * 1000,
+                "spherical": True,
+                "query": query
+            }},
+            {"$limit": limit}
+        ]
+        return [(Establishment.from_dict(doc), doc["distancia_m"] / 1000)
+                for doc in self.get_collection().aggregate(pipeline)]
+
     def get_all(self) -> List[Establishment]:
         """Busca todos os estabelecimentos ativos"""
         try:
             collection = self.get_collection()
+            query = {"ativo": True}
+            scope = current_scope(self.establishment_id)
+            if scope:
+                query["_id"] = ObjectId(scope)
             establishments = []
-            for establishment_data in collection.find({"ativo": True}):
+            for establishment_data in collection.find(query):
                 establishments.append(Establishment.from_dict(establishment_data))
             return establishments
         except Exception as e:
@@ -307,15 +1184,35 @@ class EstablishmentRepository:
             logger.error(f"Erro ao buscar estabelecimento por ID: {e}")
             raise
 
+def bulk_write_report(collection, operations: list) -> Tuple[dict, List[dict]]:
+    """Executa um bulk_write não ordenado e devolve contagens e erros por índice da operação"""
+    if not operations:
+        return {"inseridos": 0, "atualizados": 0}, []
+    try:
+        result = collection.bulk_write(operations, ordered=False)
+        details = result.bulk_api_result
+        errors = []
+    except BulkWriteError as e:
+        details = e.details
+        errors = [{"indice": error["index"], "erro": error.get("errmsg", "erro de escrita")}
+                  for error in details.get("writeErrors", [])]
+    counts = {"inseridos": details.get("nUpserted", 0), "atualizados": details.get("nModified", 0)}
+    return counts, errors
+
 class CourtRepository:
     """Repositório para operações de quadras"""
     
-    def __init__(self):
+    def __init__(self, establishment_id: Optional[str] = None):
         self.collection_name = "courts"
+        self.establishment_id = establishment_id
+    
+    def scoped(self, establishment_id: str) -> "CourtRepository":
+        """Retorna o repositório restrito a um estabelecimento"""
+        return CourtRepository(establishment_id)
     
     def get_collection(self):
         """Retorna a coleção de quadras"""
-        return mongodb.get_collection(self.collection_name)
+        return mongodb.get_collection(self.collection_name, MongoDBConnection.CATALOG)
     
     def create(self, court: Court) -> str:
         """Cria uma nova quadra"""
@@ -323,23 +1220,57 @@ class CourtRepository:
             collection = self.get_collection()
             result = collection.insert_one(court.to_dict())
             logger.info(f"Quadra criada com ID: {result.inserted_id}")
+            catalog_cache.bump()
             return str(result.inserted_id)
         except Exception as e:
             logger.error(f"Erro ao criar quadra: {e}")
             raise
     
+    def bulk_upsert(self, courts: List[Court]) -> Tuple[dict, List[dict]]:
+        """Insere/atualiza quadras pela chave natural (establishment_id + nome) em um único bulk_write"""
+        operations = []
+        for court in courts:
+            data = court.to_dict()
+            criado_em = data.pop("criado_em")
+            operations.append(UpdateOne(
+                {"establishment_id": court.establishment_id, "nome": court.nome},
+                {"$set": data, "$setOnInsert": {"criado_em": criado_em}},
+                upsert=True
+            ))
+        return bulk_write_report(self.get_collection(), operations)
+
     def get_all(self) -> List[Court]:
         """Busca todas as quadras ativas"""
         try:
             collection = self.get_collection()
+            query = {"ativo": True}
+            scope = current_scope(self.establishment_id)
+            if scope:
+                query["establishment_id"] = scope
             courts = []
-            for court_data in collection.find({"ativo": True}):
+            for court_data in collection.find(query):
                 courts.append(Court.from_dict(court_data))
             return courts
         except Exception as e:
             logger.error(f"Erro ao buscar quadras: {e}")
             raise
     
+    def get_page(self, after_id: Optional[str] = None, limit: int = 100) -> Tuple[List[Court], Optional[str]]:
+        """Página de quadras ativas ordenadas por _id; retorna (quadras, cursor da próxima página)"""
+        try:
+            query = {"ativo": True}
+            scope = current_scope(self.establishment_id)
+            if scope:
+                query["establishment_id"] = scope
+            if after_id:
+                query["_id"] = {"$gt": ObjectId(after_id)}
+            docs = list(self.get_collection().find(query).sort("_id", 1).limit(limit + 1))
+            next_cursor = str(docs[limit - 1]["_id"]) if len(docs) > limit else None
+            return [Court.from_dict(doc) for doc in docs[:limit]], next_cursor
+        except Exception as e:
+            logger.error(f"Erro ao paginar quadras: {e}")
+            raise
+
     def get_by_establishment(self, establishment_id: str) -> List[Court]:
         """Busca quadras por estabelecimento"""
         try:
@@ -369,12 +1300,94 @@ user_repo = UserRepository()
 establishment_repo = EstablishmentRepository()
 court_repo = CourtRepository()
 
+class CatalogCache:
+    """
+    Cache do catálogo (estabelecimentos e quadras) particionado por estabelecimento.
+
+    A versão do catálogo fica no documento `catalog_meta` e é relida no máximo a cada
+    CATALOG_VERSION_TTL_SECONDS; qualquer mudança de versão descarta o cache local.
+    As cargas do cache leem da primária (uma por versão); só a navegação direta no
+    catálogo usa o read preference do perfil.
+    """
+    META_ID = "catalog"
+
+    def __init__(self, version_ttl_seconds: float, capacity_per_partition: int = 16):
+        self.version_ttl_seconds = version_ttl_seconds
+        self._cache = PartitionedCache(capacity_per_partition)
+        self._version = 0
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_meta_collection(self):
+        return mongodb.get_collection("catalog_meta")
+
+    def _set_version(self, version: int):
+        with self._lock:
+            if version != self._version:
+                self._cache.clear()
+                self._version = version
+            self._checked_at = time.monotonic()
+
+    def version(self) -> int:
+        """Versão atual do catálogo (relida do MongoDB apenas quando o TTL expira)"""
+        if time.monotonic() - self._checked_at > self.version_ttl_seconds:
+            try:
+                doc = self.get_meta_collection().find_one({"_id": self.META_ID})
+                self._set_version(doc.get("version", 0) if doc else 0)
+            except Exception as e:
+                logger.error(f"Erro ao ler versão do catálogo: {e}")
+        return self._version
+
+    def bump(self) -> int:
+        """Incrementa a versão do catálogo e invalida o cache local"""
+        try:
+            doc = self.get_meta_collection().find_one_and_update(
+                {"_id": self.META_ID},
+                {"$inc": {"version": 1}, "$set": {"atualizado_em": datetime.now().isoformat()}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            self._set_version(doc["version"])
+        except Exception as e:
+            logger.error(f"Erro ao atualizar versão do catálogo: {e}")
+            self._cache.clear()
+        return self._version
+
+    def _get_or_load(self, key: str, loader):
+        scope = current_scope()
+        version = self.version()
+        cached = self._cache.get(scope, key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        # A versão nova pode ter acabado de ser gravada (bump): uma secundária atrasada
+        # devolveria o catálogo antigo, que ficaria em cache sob a versão nova
+        with primary_reads():
+            value = loader()
+        self._cache.set(scope, key, (version, value))
+        return value
+
+    def get_establishments(self) -> List[Establishment]:
+        return self._get_or_load("establishments", establishment_repo.get_all)
+
+    def get_courts(self) -> List[Court]:
+        return self._get_or_load("courts", court_repo.get_all)
+
+    def get_cached(self, key, loader):
+        """Valor derivado do catálogo (ex.: resposta serializada), válido até a próxima versão"""
+        return self._get_or_load(key, loader)
+
+    def stats(self) -> dict:
+        return {"version": self._version, "partitions": self._cache.stats()}
+
+catalog_cache = CatalogCache(settings.CATALOG_VERSION_TTL_SECONDS)
+
 class Reservation:
     """Modelo para Reserva"""
 
     def __init__(self, usuario: User, establishment_id: str, court_id: str, data_reserva: datetime,
                  quantidade_horas: int = 1, status: str = "pendente",
-                 criado_em: Optional[datetime] = None, _id: Optional[str] = None):
+                 criado_em: Optional[datetime] = None, _id: Optional[str] = None,
+                 recorrencia: Optional[dict] = None, valor_hora: Optional[float] = None):
         self._id = _id
         self.usuario = usuario
         self.establishment_id = establishment_id
@@ -383,6 +1396,10 @@ class Reservation:
         self.quantidade_horas = quantidade_horas
         self.status = status
         self.criado_em = criado_em or datetime.now()
+        # Regra da série recorrente: {"serie_id", "frequencia": "semanal"|"diaria", "ocorrencias", "indice"}
+        self.recorrencia = recorrencia
+        # Preço da hora no momento da reserva (os agregados de receita desfazem por ele)
+        self.valor_hora = valor_hora
 
     def to_dict(self):
         data = {
@@ -394,6 +1411,10 @@ class Reservation:
             "status": self.status,
             "criado_em": self.criado_em.isoformat()
         }
+        if self.recorrencia:
+            data["recorrencia"] = self.recorrencia
+        if self.valor_hora is not None:
+            data["valor_hora"] = self.valor_hora
         if self._id:
             data["_id"] = self._id
         return data
@@ -409,28 +1430,74 @@ class Reservation:
             data_reserva=datetime.fromisoformat(data.get("data_reserva")),
             quantidade_horas=data.get("quantidade_horas", 1),
             status=data.get("status", "pendente"),
-            criado_em=datetime.fromisoformat(data.get("criado_em")) if data.get("criado_em") else datetime.now()
+            criado_em=datetime.fromisoformat(data.get("criado_em")) if data.get("criado_em") else datetime.now(),
+            recorrencia=data.get("recorrencia"),
+            valor_hora=data.get("valor_hora")
         )
 
-class ReservationRepository:
+class ReservationEvents:
+    """Publica eventos de criação/cancelamento de reservas para os interessados"""
+
     def __init__(self):
+        self._subscribers = {"created": [], "cancelled": []}
+
+    def subscribe(self, event: str, callback):
+        self._subscribers[event].append(callback)
+
+    def publish(self, event: str, reservation: dict):
+        for callback in self._subscribers.get(event, []):
+            try:
+                callback(reservation)
+            except Exception as e:
+                logger.error(f"Erro ao processar evento de reserva '{event}': {e}")
+
+reservation_events = ReservationEvents()
+
+class ReservationRepository:
+    def __init__(self, establishment_id: Optional[str] = None):
         self.collection_name = "reservas"
+        self.establishment_id = establishment_id
+
+    def scoped(self, establishment_id: str) -> "ReservationRepository":
+        return ReservationRepository(establishment_id)
 
     def get_collection(self):
-        return mongodb.get_collection(self.collection_name)
+        return mongodb.get_collection(self.collection_name, MongoDBConnection.RESERVATIONS)
 
     def create(self, reservation: Reservation) -> str:
         try:
-            result = self.get_collection().insert_one(reservation.to_dict())
+            data = reservation.to_dict()
+            result = self.get_collection().insert_one(data)
+            reservation_events.publish("created", data)
             return str(result.inserted_id)
         except Exception as e:
             logger.error(f"Erro ao criar reserva: {e}")
             raise
 
+    def create_many(self, reservations: List[Reservation]) -> List[str]:
+        """Insere uma série de reservas de uma vez; se alguma falhar, remove as já inseridas"""
+        documents = [reservation.to_dict() for reservation in reservations]
+        try:
+            result = self.get_collection().insert_many(documents, ordered=True)
+        except Exception as e:
+            logger.error(f"Erro ao criar reservas em lote: {e}")
+            inserted_ids = [doc["_id"] for doc in documents if "_id" in doc]
+            if inserted_ids:
+                self.get_collection().delete_many({"_id": {"$in": inserted_ids}})
+            raise
+        for doc in documents:
+            reservation_events.publish("created", doc)
+        return [str(inserted_id) for inserted_id in result.inserted_ids]
+
     def get_by_user_phone(self, phone: str) -> List[dict]:
         try:
+            # Retenções da lista de espera não são reservas do usuário até ele confirmar
+            query = {"usuario.telefone": phone, "status": {"$nin": ["retida", "expirada"]}}
+            scope = current_scope(self.establishment_id)
+            if scope:
+                query["establishment_id"] = scope
             items = []
-            for doc in self.get_collection().find({"usuario.telefone": phone}).sort("data_reserva", 1):
+            for doc in self.get_collection().find(query).sort("data_reserva", 1):
                 # Adiciona campos calculados para compatibilidade
                 doc["quantidade_horas"] = doc.get("quantidade_horas", 1)
                 doc["valor_total"] = doc.get("valor_total", 0.0)
@@ -440,35 +1507,233 @@ class ReservationRepository:
             logger.error(f"Erro ao buscar reservas do usuário: {e}")
             raise
 
+    EXPORT_PROJECTION = {
+        "establishment_id": 1, "court_id": 1, "data_reserva": 1, "quantidade_horas": 1,
+        "status": 1, "criado_em": 1, "usuario.nome": 1, "usuario.telefone": 1
+    }
+
+    def iter_for_export(self, establishment_id: Optional[str] = None, court_id: Optional[str] = None,
+                        start_iso: Optional[str] = None, end_iso: Optional[str] = None,
+                        batch_size: int = 1000):
+        """Percorre as reservas via cursor (sem materializar a lista), só com os campos exportados"""
+        query = {}
+        scope = current_scope(establishment_id or self.establishment_id)
+        if scope:
+            query["establishment_id"] = scope
+        if court_id:
+            query["court_id"] = court_id
+        if start_iso or end_iso:
+            query["data_reserva"] = {}
+            if start_iso:
+                query["data_reserva"]["$gte"] = start_iso
+            if end_iso:
+                query["data_reserva"]["$lte"] = end_iso
+        cursor = self.get_collection().find(query, self.EXPORT_PROJECTION).sort("data_reserva", 1)
+        return cursor.batch_size(batch_size)
+
+    CALENDAR_PROJECTION = {
+        "establishment_id": 1, "court_id": 1, "data_reserva": 1, "quantidade_horas": 1,
+        "criado_em": 1, "usuario.nome": 1
+    }
+
+    def get_for_calendar(self, since_iso: str, court_id: Optional[str] = None,
+                         phone: Optional[str] = None) -> List[dict]:
+        """Reservas confirmadas de uma quadra ou de um usuário com início a partir de since_iso"""
+        query = {"status": "confirmada", "data_reserva": {"$gte": since_iso}}
+        if court_id:
+            query["court_id"] = court_id
+        if phone:
+            query["usuario.telefone"] = phone
+        return list(self.get_collection().find(query, self.CALENDAR_PROJECTION).sort("data_reserva", 1))
+
+    def get_confirmed_by_court_between(self, court_id: str, start_iso: str, end_iso: str) -> List[dict]:
+        """Busca reservas confirmadas (e retenções) de uma quadra com início no intervalo [start_iso, end_iso]"""
+        try:
+            return list(self.get_collection().find(
+                {
+                    "court_id": court_id,
+                    "status": {"$in": ["confirmada", "retida"]},
+                    "data_reserva": {"$gte": start_iso, "$lte": end_iso}
+                },
+                {"data_reserva": 1, "quantidade_horas": 1, "status": 1, "hold_expira_em": 1}
+            ))
+        except Exception as e:
+            logger.error(f"Erro ao buscar reservas da quadra: {e}")
+            raise
+
+    def get_confirmed_by_courts_between(self, court_ids: List[str], start_iso: str, end_iso: str) -> List[dict]:
+        """Reservas confirmadas (e retenções) de várias quadras com início em [start_iso, end_iso], em uma consulta"""
+        try:
+            return list(self.get_collection().find(
+                {
+                    "court_id": {"$in": court_ids},
+                    "status": {"$in": ["confirmada", "retida"]},
+                    "data_reserva": {"$gte": start_iso, "$lte": end_iso}
+                },
+                {"court_id": 1, "data_reserva": 1, "quantidade_horas": 1, "status": 1, "hold_expira_em": 1}
+            ))
+        except Exception as e:
+            logger.error(f"Erro ao buscar reservas das quadras: {e}")
+            raise
+
+    def get_confirmed_by_court_on_days(self, court_id: str, days: List[datetime]) -> List[dict]:
+        """Busca em uma única consulta as reservas confirmadas de uma quadra em vários dias"""
+        try:
+            ranges = []
+            for day in days:
+                day_start = day.replace(hour=0, minute=0, second=0, microsecond=0)
+                ranges.append({"data_reserva": {
+                    "$gte": day_start.isoformat(),
+                    "$lte": day_start.replace(hour=23, minute=59, second=59).isoformat()
+                }})
+            if not ranges:
+                return []
+            return list(self.get_collection().find(
+                {"court_id": court_id, "status": {"$in": ["confirmada", "retida"]}, "$or": ranges},
+                {"data_reserva": 1, "quantidade_horas": 1, "status": 1, "hold_expira_em": 1}
+            ))
+        except Exception as e:
+            logger.error(f"Erro ao buscar reservas da quadra por dias: {e}")
+            raise
+
+    def get_pending_reminders(self, start_iso: str, end_iso: str,
+                              establishment_ids: Optional[List[str]] = None) -> List[dict]:
+        """Busca reservas confirmadas sem lembrete com início no intervalo [start_iso, end_iso]"""
+        try:
+            query = {
+                "status": "confirmada",
+                "data_reserva": {"$gte": start_iso, "$lte": end_iso},
+                "lembrete_enviado": {"$ne": True}
+            }
+            if establishment_ids:
+                query["establishment_id"] = {"$in": establishment_ids}
+            cursor = self.get_collection().find(query, {"data_reserva": 1}).sort("data_reserva", 1)
+            return list(cursor)
+        except Exception as e:
+            logger.error(f"Erro ao buscar reservas confirmadas no intervalo: {e}")
+            raise
+
+    def claim_reminder(self, reservation_id: str) -> Optional[dict]:
+        """Marca o lembrete como enviado de forma atômica; retorna a reserva se ainda estiver confirmada"""
+        try:
+            return self.get_collection().find_one_and_update(
+                {"_id": ObjectId(reservation_id), "status": "confirmada", "lembrete_enviado": {"$ne": True}},
+                {"$set": {"lembrete_enviado": True, "lembrete_enviado_em": datetime.now().isoformat()}},
+                return_document=ReturnDocument.AFTER
+            )
+        except Exception as e:
+            logger.error(f"Erro ao marcar lembrete da reserva: {e}")
+            raise
+
+    def create_hold(self, reservation: Reservation, expires_at: datetime) -> str:
+        """Cria uma retenção temporária (status "retida") que bloqueia o horário até expirar"""
+        data = reservation.to_dict()
+        data["status"] = "retida"
+        data["hold_expira_em"] = expires_at.isoformat()
+        result = self.get_collection().insert_one(data)
+        return str(result.inserted_id)
+
+    def get_open_holds(self, establishment_ids: Optional[List[str]] = None) -> List[dict]:
+        """Retenções ainda "retida" (para reagendar a expiração após um reinício)"""
+        query = {"status": "retida"}
+        if establishment_ids:
+            query["establishment_id"] = {"$in": establishment_ids}
+        return list(self.get_collection().find(query, {"hold_expira_em": 1}))
+
+    def confirm_hold(self, hold_id: str) -> Optional[dict]:
+        """Converte a retenção em reserva confirmada se ainda estiver no prazo"""
+        doc = self.get_collection().find_one_and_update(
+            {"_id": ObjectId(hold_id), "status": "retida", "hold_expira_em": {"$gt": datetime.now().isoformat()}},
+            {"$set": {"status": "confirmada"}, "$unset": {"hold_expira_em": ""}},
+            return_document=ReturnDocument.AFTER
+        )
+        if doc:
+            reservation_events.publish("created", doc)
+        return doc
+
+    def expire_hold(self, hold_id: str) -> Optional[dict]:
+        """Expira a retenção não confirmada, liberando o horário"""
+        doc = self.get_collection().find_one_and_update(
+            {"_id": ObjectId(hold_id), "status": "retida"},
+            {"$set": {"status": "expirada"}},
+            return_document=ReturnDocument.BEFORE
+        )
+        if doc:
+            doc["status_anterior"], doc["status"] = doc.get("status"), "expirada"
+            reservation_events.publish("cancelled", doc)
+        return doc
+
     def cancel_by_id(self, reservation_id: str) -> bool:
         try:
             # Atualiza status para cancelada
-            res = self.get_collection().update_one({"_id": ObjectId(reservation_id)}, {"$set": {"status": "cancelada"}})
+            doc = self.get_collection().find_one_and_update(
+                {"_id": ObjectId(reservation_id), "status": {"$ne": "cancelada"}},
+                {"$set": {"status": "cancelada"}},
+                return_document=ReturnDocument.BEFORE
+            )
             
-            if res.modified_count > 0:
+            if doc:
                 logger.info(f"Reserva {reservation_id} cancelada com sucesso")
+                doc["status_anterior"], doc["status"] = doc.get("status"), "cancelada"
+                reservation_events.publish("cancelled", doc)
             
-            return res.modified_count > 0
+            return doc is not None
         except Exception as e:
             logger.error(f"Erro ao cancelar reserva: {e}")
             raise
 
 class ConversationStateRepository:
-    def __init__(self):
+    def __init__(self, establishment_id: Optional[str] = None):
         self.collection_name = "estados_conversa"
+        self.establishment_id = establishment_id
+        # O cache só é seguro com um único escritor por partição: vale apenas para os
+        # estabelecimentos listados em OWNED_ESTABLISHMENTS (listas disjuntas entre workers,
+        # um processo por lista). Partições não listadas sempre leem do MongoDB.
+        self.cache = PartitionedCache(settings.PARTITION_CACHE_SIZE) if settings.PARTITION_MODE == "establishment" else None
+
+    def scoped(self, establishment_id: str) -> "ConversationStateRepository":
+        return ConversationStateRepository(establishment_id)
 
     def get_collection(self):
         return mongodb.get_collection(self.collection_name)
 
+    def _state_filter(self, phone: str, scope: Optional[str]) -> dict:
+        query = {"phone": phone}
+        if scope:
+            query["establishment_id"] = scope
+        return query
+
+    def _cache_for(self, scope: Optional[str]) -> Optional[PartitionedCache]:
+        return self.cache if scope and scope in settings.OWNED_ESTABLISHMENTS else None
+
     def get_state(self, phone: str) -> Optional[dict]:
-        return self.get_collection().find_one({"phone": phone})
+        scope = current_scope(self.establishment_id)
+        cache = self._cache_for(scope)
+        if cache is not None:
+            cached = cache.get(scope, phone)
+            if cached is not None:
+                return cached or None
+        state = self.get_collection().find_one(self._state_filter(phone, scope))
+        if cache is not None:
+            cache.set(scope, phone, state or {})
+        return state
 
     def set_state(self, phone: str, state: dict):
+        scope = current_scope(self.establishment_id)
         state["phone"] = phone
-        self.get_collection().update_one({"phone": phone}, {"$set": state}, upsert=True)
+        if scope:
+            state["establishment_id"] = scope
+        self.get_collection().update_one(self._state_filter(phone, scope), {"$set": state}, upsert=True)
+        cache = self._cache_for(scope)
+        if cache is not None:
+            cache.delete(scope, phone)
 
     def clear_state(self, phone: str):
-        self.get_collection().delete_one({"phone": phone})
+        scope = current_scope(self.establishment_id)
+        self.get_collection().delete_one(self._state_filter(phone, scope))
+        cache = self._cache_for(scope)
+        if cache is not None:
+            cache.set(scope, phone, {})
 
 # ===== FUNÇÕES DE VALIDAÇÃO DE DISPONIBILIDADE =====
 
@@ -521,24 +1786,12 @@ def validate_court_availability(court_id: str, data_reserva: datetime, quantidad
         data_inicio = data_reserva.replace(hour=0, minute=0, second=0, microsecond=0)
         data_fim = data_inicio.replace(hour=23, minute=59, second=59)
         
-        reservations_collection = mongodb.get_collection("reservations")
-        reservas_confirmadas = list(reservations_collection.find({
-            "court_id": court_id,
-            "data_reserva": {
-                "$gte": data_inicio.isoformat(),
-                "$lte": data_fim.isoformat()
-            },
-            "status": "confirmada"
-        }))
+        reservas_confirmadas = reservation_repo.get_confirmed_by_court_between(
+            court_id, data_inicio.isoformat(), data_fim.isoformat()
+        )
         
         # Calcula horários ocupados
-        horarios_ocupados = set()
-        for reserva in reservas_confirmadas:
-            reserva_dt = datetime.fromisoformat(reserva["data_reserva"])
-            reserva_hora_inicio = reserva_dt.hour
-            reserva_horas = reserva.get("quantidade_horas", 1)
-            reserva_horarios = list(range(reserva_hora_inicio, reserva_hora_inicio + reserva_horas))
-            horarios_ocupados.update(reserva_horarios)
+        horarios_ocupados = occupied_hours_by_day(reservas_confirmadas).get(data_inicio.date().isoformat(), set())
         
         # Verifica se algum horário necessário está ocupado
         horarios_conflito = [h for h in horarios_necessarios if h in horarios_ocupados]
@@ -567,97 +1820,352 @@ def validate_court_availability(court_id: str, data_reserva: datetime, quantidad
             "mensagem": f"Erro ao verificar disponibilidade: {str(e)}"
         }
 
+def occupied_hours_by_day(reservas: List[dict]) -> Dict[str, set]:
+    """Agrupa as horas ocupadas por dia (AAAA-MM-DD) a partir de documentos de reserva"""
+    ocupados = {}
+    now_iso = datetime.now().isoformat()
+    for reserva in reservas:
+        # Retenções da lista de espera só bloqueiam o horário enquanto não expiram
+        if reserva.get("status") == "retida" and reserva.get("hold_expira_em", "") <= now_iso:
+            continue
+        reserva_dt = datetime.fromisoformat(reserva["data_reserva"])
+        reserva_horas = reserva.get("quantidade_horas", 1)
+        ocupados.setdefault(reserva_dt.date().isoformat(), set()).update(
+            range(reserva_dt.hour, reserva_dt.hour + reserva_horas)
+        )
+    return ocupados
+
+def hour_ranges(hours: List[int]) -> str:
+    """Compacta horas de início livres em faixas: [8, 9, 10, 14] -> 8h-11h, 14h-15h"""
+    ranges = []
+    for hour in sorted(hours):
+        if ranges and ranges[-1][1] == hour:
+            ranges[-1][1] = hour + 1
+        else:
+            ranges.append([hour, hour + 1])
+    return ", ".join(f"{start}h-{end}h" for start, end in ranges)
+
+class AvailabilityDigest:
+    """
+    Resumo compacto das horas livres de cada quadra para hoje e os próximos dias
+    (AVAILABILITY_DIGEST_DAYS), usado no prompt do LLM para que ele sugira horários reais.
+
+    Cada quadra fica em cache até uma reserva dela ser criada ou cancelada, a hora virar
+    (as horas passadas de hoje saem do resumo) ou AVAILABILITY_DIGEST_TTL_SECONDS expirar
+    (retenções da lista de espera e reservas feitas por outros workers não geram evento aqui).
+    As quadras sem cache são carregadas juntas, em uma única consulta.
+    """
+    WEEKDAYS = ["seg", "ter", "qua", "qui", "sex", "sáb", "dom"]
+
+    def __init__(self, days: int, ttl_seconds: float):
+        self.days = days
+        self.ttl_seconds = ttl_seconds
+        self._cache = {}  # court_id -> (hora de referência, criado_em, {dia: [horas livres]})
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        reservation_events.subscribe("created", self._invalidate)
+        reservation_events.subscribe("cancelled", self._invalidate)
+
+    def _invalidate(self, reservation: dict):
+        with self._lock:
+            self._epoch += 1
+            self._cache.pop(reservation.get("court_id"), None)
+
+    def free_hours(self, courts: List[Court]) -> Dict[str, Dict[str, List[int]]]:
+        """Horas de início livres por quadra e dia (AAAA-MM-DD), de agora até o fim do período"""
+        now = datetime.now()
+        reference = now.replace(minute=0, second=0, microsecond=0)
+        result, missing = {}, []
+        with self._lock:
+            epoch = self._epoch
+            for court in courts:
+                cached = self._cache.get(court._id)
+                if cached and cached[0] == reference and time.monotonic() - cached[1] < self.ttl_seconds:
+                    result[court._id] = cached[2]
+                else:
+                    missing.append(court)
+        metrics.inc("availability_digest_courts_total", len(result), result="hit")
+        if not missing:
+            return result
+        metrics.inc("availability_digest_courts_total", len(missing), result="miss")
+
+        today = reference.replace(hour=0)
+        days = [today + timedelta(days=offset) for offset in range(self.days)]
+        reservas = reservation_repo.get_confirmed_by_courts_between(
+            [court._id for court in missing], today.isoformat(),
+            (days[-1] + timedelta(hours=23, minutes=59, seconds=59)).isoformat()
+        )
+        by_court = {}
+        for reserva in reservas:
+            by_court.setdefault(reserva["court_id"], []).append(reserva)
+        loaded_at = time.monotonic()
+        for court in missing:
+            ocupados = occupied_hours_by_day(by_court.get(court._id, []))
+            free = {}
+            for day in days:
+                day_key = day.date().isoformat()
+                free[day_key] = [h for h in sorted(court.horarios_funcionamento)
+                                 if h not in ocupados.get(day_key, set()) and (day > today or h > now.hour)]
+            result[court._id] = free
+        with self._lock:
+            # Reserva criada/cancelada durante a consulta: o resultado vale para este turno, mas não é guardado
+            if self._epoch == epoch:
+                for court in missing:
+                    self._cache[court._id] = (reference, loaded_at, result[court._id])
+        return result
+
+    def day_label(self, day_key: str) -> str:
+        day = datetime.fromisoformat(day_key).date()
+        offset = (day - datetime.now().date()).days
+        if offset == 0:
+            return "hoje"
+        if offset == 1:
+            return "amanhã"
+        return f"{self.WEEKDAYS[day.weekday()]} {day.strftime('%d/%m')}"
+
+    def render(self, courts: List[Court], max_tokens: int) -> str:
+        """Linhas "- Quadra [id]: hoje 18h-22h | amanhã ..." até o orçamento de tokens"""
+        free = self.free_hours(courts)
+        lines, used = [], 0
+        for index, court in enumerate(courts):
+            days = " | ".join(
+                f"{self.day_label(day_key)} {hour_ranges(hours) if hours else 'lotada'}"
+                for day_key, hours in free[court._id].items()
+            )
+            line = f"- {court.nome} [id: {court._id}]: {days}"
+            if used + estimate_tokens(line) > max_tokens:
+                lines.append(f"(+{len(courts) - index} quadras: use check_availability)")
+                break
+            lines.append(line)
+            used += estimate_tokens(line)
+        return "\n".join(lines)
+
+availability_digest = AvailabilityDigest(settings.AVAILABILITY_DIGEST_DAYS, settings.AVAILABILITY_DIGEST_TTL_SECONDS)
+
+def validate_series_availability(court: Court, occurrences: List[datetime], quantidade_horas: int) -> dict:
+    """
+    Valida todas as ocorrências de uma série com uma única consulta por quadra.
+
+    Returns:
+        dict: {"disponiveis": List[datetime], "conflitos": List[datetime], "mensagem": str}
+    """
+    hora_inicio = occurrences[0].hour if occurrences else 0
+    horarios_necessarios = list(range(hora_inicio, hora_inicio + quantidade_horas))
+    fora = [h for h in horarios_necessarios if h not in court.horarios_funcionamento]
+    if fora:
+        return {
+            "disponiveis": [],
+            "conflitos": list(occurrences),
+            "mensagem": f"Horários {fora} estão fora do horário de funcionamento."
+        }
+    ocupados = occupied_hours_by_day(reservation_repo.get_confirmed_by_court_on_days(court._id, occurrences))
+    disponiveis, conflitos = [], []
+    for occurrence in occurrences:
+        dia_ocupado = ocupados.get(occurrence.date().isoformat(), set())
+        (conflitos if dia_ocupado.intersection(horarios_necessarios) else disponiveis).append(occurrence)
+    mensagem = "Todas as datas estão disponíveis."
+    if conflitos:
+        mensagem = "Datas ocupadas: " + ", ".join(dt.strftime("%d/%m") for dt in conflitos) + "."
+    return {"disponiveis": disponiveis, "conflitos": conflitos, "mensagem": mensagem}
+
+def estimate_tokens(text: str) -> int:
+    """Estimativa barata de tokens (~4 caracteres por token em português)"""
+    return (len(text) + 3) // 4
+
 class ConversationMessage:
     """Modelo para mensagem individual da conversa"""
-    def __init__(self, role: str, content: str, timestamp: Optional[datetime] = None):
+    def __init__(self, role: str, content: str, timestamp: Optional[datetime] = None,
+                 intent: Optional[str] = None, intent_origem: Optional[str] = None):
         self.role = role  # "user" ou "assistant"
         self.content = content
         self.timestamp = timestamp or datetime.now()
+        # Rótulo de intenção confirmado pelo fluxo que tratou a mensagem (usado para treinar o classificador)
+        self.intent = intent
+        self.intent_origem = intent_origem
 
     def to_dict(self):
-        return {
+        data = {
             "role": self.role,
             "content": self.content,
             "timestamp": self.timestamp.isoformat()
         }
+        if self.intent:
+            data["intent"] = self.intent
+            data["intent_origem"] = self.intent_origem
+        return data
 
     @classmethod
     def from_dict(cls, data: dict):
         return cls(
             role=data.get("role", "user"),
             content=data.get("content", ""),
-            timestamp=datetime.fromisoformat(data.get("timestamp")) if data.get("timestamp") else datetime.now()
+            timestamp=datetime.fromisoformat(data.get("timestamp")) if data.get("timestamp") else datetime.now(),
+            intent=data.get("intent"),
+            intent_origem=data.get("intent_origem")
         )
 
+class HistoryWriteBuffer:
+    """
+    Buffer write-behind do histórico: as mensagens ficam em memória por telefone e uma thread
+    as grava a cada HISTORY_FLUSH_INTERVAL_MS (ou ao acumular HISTORY_FLUSH_BATCH) em um único
+    bulk_write, com um update em pipeline por telefone que também trata início de sessão e
+    retenção. A janela de perda em caso de queda é o intervalo de flush; no desligamento
+    normal o buffer é esvaziado.
+    """
+
+    def __init__(self, get_collection, flush_interval_seconds: float, max_batch: int,
+                 session_timeout_minutes: int, retention_hours: int = 24):
+        self.get_collection = get_collection
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_batch = max_batch
+        self.session_timeout_minutes = session_timeout_minutes
+        self.retention_hours = retention_hours
+        self._pending = OrderedDict()
+        self._flushing = {}
+        self._count = 0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                self._thread.start()
+
+    def append(self, phone: str, message: dict):
+        self.start()
+        with self._cond:
+            self._pending.setdefault(phone, []).append(message)
+            self._count += 1
+            if self._count >= self.max_batch:
+                self._cond.notify()
+        metrics.set_gauge("history_buffer_pending", self._count)
+
+    def pending_for(self, phone: str) -> List[dict]:
+        """Mensagens ainda não gravadas (inclusive as do flush em andamento)"""
+        with self._cond:
+            return list(self._flushing.get(phone, ())) + list(self._pending.get(phone, ()))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._count >= self.max_batch, timeout=self.flush_interval_seconds)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Erro no flush do histórico: {e}")
+
+    def _pipeline(self, messages: List[dict]) -> list:
+        first = datetime.fromisoformat(messages[0]["timestamp"])
+        last = datetime.fromisoformat(messages[-1]["timestamp"])
+        session_cutoff = (first - timedelta(minutes=self.session_timeout_minutes)).isoformat()
+        retention_cutoff = (last - timedelta(hours=self.retention_hours)).isoformat()
+        new_session = {"$lt": [{"$ifNull": ["$last_activity", ""]}, session_cutoff]}
+        kept = {"$filter": {"input": {"$ifNull": ["$messages", []]},
+                            "cond": {"$gte": ["$$this.timestamp", retention_cutoff]}}}
+        # Só o que é mais novo que last_activity: reaplicar um lote já gravado não duplica mensagens
+        new_messages = {"$filter": {"input": {"$literal": messages},
+                                    "cond": {"$gt": ["$$this.timestamp", {"$ifNull": ["$last_activity", ""]}]}}}
+        return [{"$set": {
+            "messages": {"$cond": [new_session, new_messages, {"$concatArrays": [kept, new_messages]}]},
+            "session_start": {"$cond": [new_session, messages[0]["timestamp"], "$session_start"]},
+            # Nova sessão descarta o resumo da anterior (null em vez de $$REMOVE: o mongomock não o suporta)
+            "resumo": {"$cond": [new_session, None, "$resumo"]},
+            "resumo_ate": {"$cond": [new_session, None, "$resumo_ate"]},
+            "last_activity": messages[-1]["timestamp"]
+        }}]
+
+    def flush(self) -> int:
+        """Grava tudo que está pendente em um bulk_write; devolve o número de mensagens gravadas"""
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, OrderedDict()
+                self._flushing, count, self._count = batch, self._count, 0
+            if not batch:
+                return 0
+            started = time.perf_counter()
+            operations = [UpdateOne({"phone": phone}, self._pipeline(messages), upsert=True)
+                          for phone, messages in batch.items()]
+            try:
+                self.get_collection().bulk_write(operations, ordered=False)
+            except Exception as e:
+                # Devolve ao buffer para a próxima tentativa, antes das mensagens mais novas. Num
+                # BulkWriteError só os telefones com erro voltam; nos demais casos o lote inteiro
+                # volta e o filtro por last_activity do pipeline evita duplicar o que já foi gravado
+                failed = batch
+                if isinstance(e, BulkWriteError):
+                    phones = list(batch)
+                    failed = {phones[error["index"]]: batch[phones[error["index"]]]
+                              for error in e.details.get("writeErrors", [])}
+                requeued = sum(len(messages) for messages in failed.values())
+                logger.error(f"Erro ao gravar histórico em lote ({requeued} de {count} mensagens voltam ao buffer): {e}")
+                with self._cond:
+                    for phone, messages in failed.items():
+                        self._pending[phone] = messages + self._pending.get(phone, [])
+                    self._count += requeued
+                return count - requeued
+            finally:
+                with self._cond:
+                    self._flushing = {}
+            metrics.observe("history_flush_messages", count)
+            metrics.observe("history_flush_seconds", time.perf_counter() - started)
+            metrics.set_gauge("history_buffer_pending", self._count)
+            return count
+
 class ConversationHistoryRepository:
     """Repositório para histórico de conversas com sessões"""
     def __init__(self):
         self.collection_name = "conversation_history"
         self.session_timeout_minutes = 30  # Timeout de sessão
+        self.buffer = HistoryWriteBuffer(
+            self.get_collection,
+            flush_interval_seconds=settings.HISTORY_FLUSH_INTERVAL_MS / 1000.0,
+            max_batch=settings.HISTORY_FLUSH_BATCH,
+            session_timeout_minutes=self.session_timeout_minutes
+        )
 
     def get_collection(self):
-        return mongodb.get_collection(self.collection_name)
+        return mongodb.get_collection(self.collection_name, MongoDBConnection.HISTORY)
 
     def add_message(self, phone: str, message: ConversationMessage):
-        """Adiciona mensagem ao histórico do usuário"""
+        """
+        Adiciona mensagem ao histórico do usuário.
+
+        Com HISTORY_WRITE_BEHIND a gravação é adiada para o próximo flush do buffer (fora do
+        caminho da resposta); sem ele, grava imediatamente pelo mesmo pipeline.
+        """
         try:
-            # Busca documento do usuário
-            user_doc = self.get_collection().find_one({"phone": phone})
-            current_time = datetime.now()
-            
-            # Verifica se precisa iniciar nova sessão
-            if user_doc:
-                last_activity = datetime.fromisoformat(user_doc.get("last_activity", current_time.isoformat()))
-                time_diff = current_time - last_activity
-                
-                # Se passou mais de 30 minutos, inicia nova sessão
-                if time_diff.total_seconds() > (self.session_timeout_minutes * 60):
-                    logger.info(f"[NOVA-SESSAO] Usuário {phone}: Iniciando nova sessão após {time_diff.total_seconds()/60:.1f}min de inatividade")
-                    # Cria nova sessão (limpa mensagens antigas)
-                    user_doc = {
-                        "phone": phone,
-                        "messages": [],
-                        "last_activity": current_time.isoformat(),
-                        "session_start": current_time.isoformat()
-                    }
-                    self.get_collection().update_one(
-                        {"phone": phone},
-                        {"$set": user_doc},
-                        upsert=True
-                    )
-                else:
-                    # Continua sessão atual
-                    messages = user_doc.get("messages", [])
-                    messages.append(message.to_dict())
-                    
-                    self.get_collection().update_one(
-                        {"phone": phone},
-                        {
-                            "$set": {
-                                "messages": messages,
-                                "last_activity": current_time.isoformat()
-                            }
-                        }
-                    )
-            else:
-                # Primeira mensagem do usuário
-                logger.info(f"[PRIMEIRA-SESSAO] Usuário {phone}: Iniciando primeira sessão")
-                user_doc = {
-                    "phone": phone,
-                    "messages": [message.to_dict()],
-                    "last_activity": current_time.isoformat(),
-                    "session_start": current_time.isoformat()
-                }
-                self.get_collection().insert_one(user_doc)
-                
+            self.buffer.append(phone, message.to_dict())
+            if not settings.HISTORY_WRITE_BEHIND:
+                self.buffer.flush()
         except Exception as e:
             logger.error(f"Erro ao adicionar mensagem ao histórico: {e}")
 
+    def _load(self, phone: str) -> Optional[dict]:
+        """Documento do histórico com as mensagens ainda não gravadas do buffer já incorporadas"""
+        # Buffer antes do banco: um flush que termine entre as duas leituras aparece no documento
+        # (e é deduplicado abaixo) em vez de sumir das duas
+        pending = self.buffer.pending_for(phone)
+        user_doc = self.get_collection().find_one({"phone": phone})
+        if not pending:
+            return user_doc
+        if user_doc is None or user_doc.get("last_activity", "") < (
+                datetime.fromisoformat(pending[0]["timestamp"]) - timedelta(minutes=self.session_timeout_minutes)).isoformat():
+            # O flush pendente vai abrir uma nova sessão
+            return {"phone": phone, "messages": pending, "session_start": pending[0]["timestamp"]}
+        messages = user_doc.get("messages", [])
+        last_saved = messages[-1].get("timestamp", "") if messages else ""
+        user_doc["messages"] = messages + [m for m in pending if m["timestamp"] > last_saved]
+        return user_doc
+
     def get_recent_messages(self, phone: str, hours: int = 24) -> List[ConversationMessage]:
         """Recupera mensagens das últimas N horas"""
         try:
             cutoff_time = datetime.now() - timedelta(hours=hours)
-            user_doc = self.get_collection().find_one({"phone": phone})
+            user_doc = self._load(phone)
             if not user_doc:
                 return []
             
@@ -673,50 +2181,800 @@ class ConversationHistoryRepository:
             return []
 
     def clear_old_messages(self, phone: str, hours: int = 24):
-        """Remove mensagens mais antigas que N horas"""
+        """Remove mensagens mais antigas que N horas (o flush do buffer já aplica a retenção de 24h)"""
         try:
-            cutoff_time = datetime.now() - timedelta(hours=hours)
-            user_doc = self.get_collection().find_one({"phone": phone})
-            if not user_doc:
-                return
-            
-            messages = []
-            for msg_data in user_doc.get("messages", []):
-                msg = ConversationMessage.from_dict(msg_data)
-                if msg.timestamp >= cutoff_time:
-                    messages.append(msg_data)
-            
+            cutoff = (datetime.now() - timedelta(hours=hours)).isoformat()
             self.get_collection().update_one(
                 {"phone": phone},
-                {"$set": {"messages": messages}}
+                {"$pull": {"messages": {"timestamp": {"$lt": cutoff}}}}
             )
         except Exception as e:
             logger.error(f"Erro ao limpar histórico antigo: {e}")
 
+    def save_summary(self, phone: str, session_start: str, summary: str, summarized_until: str) -> bool:
+        """Grava o resumo da sessão (ignorado se a sessão foi reiniciada nesse meio tempo)"""
+        result = self.get_collection().update_one(
+            {"phone": phone, "session_start": session_start},
+            {"$set": {"resumo": summary, "resumo_ate": summarized_until}}
+        )
+        return result.modified_count > 0
+
+    @staticmethod
+    def _format_lines(messages: List[ConversationMessage]) -> str:
+        return "\n".join(
+            f"{'Usuário' if msg.role == 'user' else 'Assistente'}: {msg.content}" for msg in messages
+        )
+
     def get_conversation_context(self, phone: str, max_messages: int = 10) -> str:
         """Retorna contexto da conversa como string para LLM"""
-        messages = self.get_recent_messages(phone, hours=24)
+        return self.get_context_window(phone, max_messages)[0]
+
+    def get_context_window(self, phone: str, max_messages: int = 10) -> Tuple[str, int]:
+        """
+        Contexto para o LLM: o resumo da sessão (se houver) seguido das mensagens ainda não
+        resumidas, até max_messages. Retorna também quantas mensagens ainda não foram resumidas.
+        """
+        try:
+            user_doc = self._load(phone)
+        except Exception as e:
+            logger.error(f"Erro ao buscar histórico: {e}")
+            return "", 0
+        if not user_doc:
+            return "", 0
+        cutoff_time = datetime.now() - timedelta(hours=24)
+        messages = [m for m in (ConversationMessage.from_dict(d) for d in user_doc.get("messages", []))
+                    if m.timestamp >= cutoff_time]
         if not messages:
-            return ""
+            return "", 0
         
-        # Pega as últimas N mensagens
-        recent = messages[-max_messages:] if len(messages) > max_messages else messages
+        summary = user_doc.get("resumo")
+        summarized_until = user_doc.get("resumo_ate") or ""
+        raw = [m for m in messages if m.timestamp.isoformat() > summarized_until] if summary else messages
+        context = self._format_lines(raw[-max_messages:])
+        if summary:
+            context = f"Resumo da conversa até aqui: {summary}\n{context}"
         
-        context_lines = []
-        for msg in recent:
-            role_label = "Usuário" if msg.role == "user" else "Assistente"
-            context_lines.append(f"{role_label}: {msg.content}")
-        
-        return "\n".join(context_lines)
+        # Tamanho do contexto antes (últimas N mensagens brutas) e depois do resumo
+        metrics.observe("llm_context_tokens", estimate_tokens(self._format_lines(messages[-max_messages:])), kind="bruto")
+        metrics.observe("llm_context_tokens", estimate_tokens(context), kind="resumido")
+        return context, len(raw)
 
 reservation_repo = ReservationRepository()
 state_repo = ConversationStateRepository()
 history_repo = ConversationHistoryRepository()
 
+# ===== ESTATÍSTICAS DE OCUPAÇÃO =====
+class OccupancyRollups:
+    """
+    Agregados de ocupação e receita por (quadra, dia, hora) na coleção `ocupacao_horaria`.
+
+    Mantidos incrementalmente com $inc a cada reserva confirmada/cancelada, para que o
+    /stats responda a partir dos agregados sem varrer `reservas`. A receita usa o
+    `valor_hora` gravado na reserva, então mudar o preço da quadra não distorce o cancelamento.
+
+    O backfill (comando `backfill-stats`, outro processo) marca `ocupacao_controle`; enquanto
+    a marca existe, os eventos do escopo vão para `ocupacao_pendentes` em vez do $inc e, ao
+    final, só são aplicados os que a varredura não refletiu (ver _replay_pending).
+    A marca é relida no máximo a cada control_ttl_seconds (não a cada evento); o backfill
+    espera settle_seconds (maior que o TTL) ao criar e ao remover a marca.
+    """
+    GROUP_FIELDS = {"court": "court_id", "day": "data", "hour": "hora"}
+    BACKFILL_ID = "backfill"
+    EVENT_FIELDS = ("_id", "court_id", "establishment_id", "data_reserva", "quantidade_horas", "valor_hora")
+
+    def __init__(self, batch_size: int = 1000, settle_seconds: float = 1.0, stale_minutes: int = 60,
+                 control_ttl_seconds: float = 0.5):
+        self.batch_size = batch_size
+        # Tempo para eventos que leram a marca (ou o cache dela) antes da troca terminarem de gravar
+        self.settle_seconds = max(settle_seconds, control_ttl_seconds)
+        self.stale_minutes = stale_minutes
+        self.control_ttl_seconds = control_ttl_seconds
+        self._control = None
+        self._control_checked_at = float("-inf")
+
+    def get_collection(self):
+        return mongodb.get_collection("ocupacao_horaria")
+
+    def get_control_collection(self):
+        return mongodb.get_collection("ocupacao_controle")
+
+    def get_pending_collection(self):
+        return mongodb.get_collection("ocupacao_pendentes")
+
+    def start(self):
+        reservation_events.subscribe("created", self._on_created)
+        reservation_events.subscribe("cancelled", self._on_cancelled)
+
+    def _on_created(self, reservation: dict):
+        if reservation.get("status") == "confirmada":
+            self._handle(reservation, 1)
+
+    def _on_cancelled(self, reservation: dict):
+        if reservation.get("status_anterior") == "confirmada":
+            self._handle(reservation, -1)
+
+    def _active_backfill(self) -> Optional[dict]:
+        """Marca do backfill em andamento (ou None), relida do MongoDB apenas quando o TTL expira"""
+        if time.monotonic() - self._control_checked_at > self.control_ttl_seconds:
+            self._control = self.get_control_collection().find_one({"_id": self.BACKFILL_ID})
+            self._control_checked_at = time.monotonic()
+        return self._control
+
+    def _handle(self, reservation: dict, sign: int):
+        try:
+            control = self._active_backfill()
+            if control and (not control.get("escopo") or control["escopo"] == reservation.get("establishment_id")):
+                self.get_pending_collection().insert_one({
+                    "reserva": {field: reservation.get(field) for field in self.EVENT_FIELDS},
+                    "sinal": sign,
+                    "criado_em": datetime.now().isoformat()
+                })
+                return
+        except Exception as e:
+            logger.error(f"Erro ao verificar backfill de ocupação: {e}")
+        self.apply(reservation, sign)
+
+    def _court_price(self, court_id: str, establishment_id: str) -> float:
+        with partition_scope(establishment_id or None):
+            for court in catalog_cache.get_courts():
+                if court._id == court_id:
+                    return court.valor_hora
+        court = court_repo.get_by_id(court_id)
+        return court.valor_hora if court else 0.0
+
+    def _hour_keys(self, reservation: dict):
+        start_dt = datetime.fromisoformat(reservation["data_reserva"])
+        for offset in range(reservation.get("quantidade_horas", 1)):
+            slot = start_dt + timedelta(hours=offset)
+            yield slot.date().isoformat(), slot.hour
+
+    def apply(self, reservation: dict, sign: int):
+        """Aplica (+1) ou desfaz (-1) as horas de uma reserva nos agregados, em um único bulk_write"""
+        court_id = reservation.get("court_id")
+        establishment_id = reservation.get("establishment_id", "")
+        price = reservation.get("valor_hora")
+        if price is None:
+            price = self._court_price(court_id, establishment_id)
+        operations = [
+            UpdateOne(
+                {"court_id": court_id, "data": data, "hora": hora},
+                {
+                    "$inc": {"horas_reservadas": sign, "receita": sign * price},
+                    "$setOnInsert": {"establishment_id": establishment_id}
+                },
+                upsert=True
+            )
+            for data, hora in self._hour_keys(reservation)
+        ]
+        try:
+            self.get_collection().bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.error(f"Erro ao atualizar agregados de ocupação: {e}")
+
+    def backfill(self, establishment_id: Optional[str] = None) -> int:
+        """Recalcula os agregados a partir de `reservas` (idempotente: grava valores absolutos)"""
+        now = datetime.now()
+        try:
+            # Marca com mais de stale_minutes é de um backfill interrompido e pode ser retomada
+            self.get_control_collection().update_one(
+                {"_id": self.BACKFILL_ID,
+                 "iniciado_em": {"$lt": (now - timedelta(minutes=self.stale_minutes)).isoformat()}},
+                {"$set": {"escopo": establishment_id or "", "iniciado_em": now.isoformat()}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            raise RuntimeError("Backfill de ocupação já em andamento")
+        self._control_checked_at = float("-inf")
+        counted = set()
+        try:
+            time.sleep(self.settle_seconds)
+            query = {"status": "confirmada"}
+            if establishment_id:
+                query["establishment_id"] = establishment_id
+            totals = {}
+            prices = {}
+            cursor = reservation_repo.get_collection().find(
+                query, {"court_id": 1, "establishment_id": 1, "data_reserva": 1, "quantidade_horas": 1, "valor_hora": 1}
+            ).batch_size(self.batch_size)
+            for reservation in cursor:
+                counted.add(str(reservation["_id"]))
+                court_id = reservation.get("court_id")
+                price = reservation.get("valor_hora")
+                if price is None:
+                    if court_id not in prices:
+                        prices[court_id] = self._court_price(court_id, reservation.get("establishment_id", ""))
+                    price = prices[court_id]
+                for data, hora in self._hour_keys(reservation):
+                    key = (court_id, data, hora)
+                    horas, receita, _ = totals.get(key, (0, 0.0, None))
+                    totals[key] = (horas + 1, receita + price, reservation.get("establishment_id", ""))
+
+            collection = self.get_collection()
+            collection.delete_many({"establishment_id": establishment_id} if establishment_id else {})
+            operations = []
+            for (court_id, data, hora), (horas, receita, est_id) in totals.items():
+                operations.append(UpdateOne(
+                    {"court_id": court_id, "data": data, "hora": hora},
+                    {"$set": {"horas_reservadas": horas, "receita": receita, "establishment_id": est_id}},
+                    upsert=True
+                ))
+                if len(operations) >= self.batch_size:
+                    collection.bulk_write(operations, ordered=False)
+                    operations = []
+            if operations:
+                collection.bulk_write(operations, ordered=False)
+            return len(totals)
+        finally:
+            self.get_control_collection().delete_one({"_id": self.BACKFILL_ID})
+            self._control_checked_at = float("-inf")
+            time.sleep(self.settle_seconds)
+            self._replay_pending(counted)
+
+    def _replay_pending(self, counted: set):
+        """
+        Aplica os eventos retidos durante o backfill que a varredura não refletiu: uma criação
+        já contada é ignorada, e um cancelamento só desfaz reservas contadas (ou criadas depois).
+        """
+        applied = set(counted)
+        pending = self.get_pending_collection()
+        events = list(pending.find().sort("criado_em", 1))
+        for event in events:
+            reservation, sign = event["reserva"], event["sinal"]
+            reservation_id = str(reservation.get("_id"))
+            if sign > 0 and reservation_id not in applied:
+                applied.add(reservation_id)
+                self.apply(reservation, 1)
+            elif sign < 0 and reservation_id in applied:
+                applied.discard(reservation_id)
+                self.apply(reservation, -1)
+        if events:
+            pending.delete_many({"_id": {"$in": [event["_id"] for event in events]}})
+            logger.info(f"[OCUPACAO] {len(events)} eventos retidos durante o backfill reaplicados")
+
+    def query(self, start_day: str, end_day: str, group_by: str = "court",
+              establishment_id: Optional[str] = None, court_id: Optional[str] = None) -> dict:
+        """Ocupação (%) e receita agrupadas por quadra, dia ou hora no intervalo de dias [start_day, end_day]"""
+        field = self.GROUP_FIELDS[group_by]
+        match = {"data": {"$gte": start_day, "$lte": end_day}}
+        if establishment_id:
+            match["establishment_id"] = establishment_id
+        if court_id:
+            match["court_id"] = court_id
+        rows = list(self.get_collection().aggregate([
+            {"$match": match},
+            {"$group": {"_id": f"${field}", "horas_reservadas": {"$sum": "$horas_reservadas"}, "receita": {"$sum": "$receita"}}},
+            {"$sort": {"_id": 1}}
+        ]))
+
+        # Capacidade (horas disponíveis) calculada a partir do catálogo em memória
+        with partition_scope(establishment_id):
+            courts = [c for c in catalog_cache.get_courts()
+                      if (not establishment_id or c.establishment_id == establishment_id)
+                      and (not court_id or c._id == court_id)]
+        days = (datetime.fromisoformat(end_day) - datetime.fromisoformat(start_day)).days + 1
+
+        def capacity(key) -> int:
+            if group_by == "court":
+                return days * sum(len(c.horarios_funcionamento) for c in courts if c._id == key)
+            if group_by == "day":
+                return sum(len(c.horarios_funcionamento) for c in courts)
+            return days * sum(1 for c in courts if key in c.horarios_funcionamento)
+
+        items = []
+        for row in rows:
+            cap = capacity(row["_id"])
+            items.append({
+                group_by: row["_id"],
+                "horas_reservadas": row["horas_reservadas"],
+                "receita": round(row["receita"], 2),
+                "ocupacao_pct": round(100.0 * row["horas_reservadas"] / cap, 1) if cap else None
+            })
+        total_capacity = days * sum(len(c.horarios_funcionamento) for c in courts)
+        total_hours = sum(item["horas_reservadas"] for item in items)
+        return {
+            "inicio": start_day,
+            "fim": end_day,
+            "agrupar": group_by,
+            "itens": items,
+            "total": {
+                "horas_reservadas": total_hours,
+                "receita": round(sum(item["receita"] for item in items), 2),
+                "ocupacao_pct": round(100.0 * total_hours / total_capacity, 1) if total_capacity else None
+            }
+        }
+
+occupancy_rollups = OccupancyRollups()
+
+# ===== CALENDÁRIO (iCalendar) =====
+def ics_escape(text: str) -> str:
+    return (text or "").replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def ics_fold(line: str) -> str:
+    """Quebra linhas com mais de 75 octetos (RFC 5545, seção 3.1)"""
+    data = line.encode("utf-8")
+    if len(data) <= 75:
+        return line
+    parts, current = [], b""
+    for char in line:
+        encoded = char.encode("utf-8")
+        if len(current) + len(encoded) > (75 if not parts else 74):
+            parts.append(current.decode("utf-8"))
+            current = b""
+        current += encoded
+    parts.append(current.decode("utf-8"))
+    return "\r\n ".join(parts)
+
+def ics_utc(dt: datetime, tz: Optional[str] = None) -> str:
+    """Data em UTC (sufixo Z); datetimes sem fuso são lidos em `tz` ou, sem ele, no fuso do servidor"""
+    if tz and dt.tzinfo is None:
+        dt = dt.replace(tzinfo=ZoneInfo(tz))
+    return dt.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+def render_ics(calendar_name: str, events: List[dict]) -> bytes:
+    """
+    Monta um VCALENDAR com um VEVENT por item de `events` ({uid, inicio, fim, criado_em,
+    titulo, local}). Início e fim estão no horário local de CALENDAR_TIMEZONE e são gravados
+    em UTC: um TZID exigiria o VTIMEZONE correspondente (RFC 5545), que o Outlook não infere.
+    """
+    tz = settings.CALENDAR_TIMEZONE
+    lines = [
+        "BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//VaiTerPlay//Reservas//PT-BR", "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH", f"X-WR-CALNAME:{ics_escape(calendar_name)}", f"X-WR-TIMEZONE:{tz}"
+    ]
+    for event in events:
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{event['uid']}",
+            f"DTSTAMP:{ics_utc(event['criado_em'])}",
+            f"DTSTART:{ics_utc(event['inicio'], tz)}",
+            f"DTEND:{ics_utc(event['fim'], tz)}",
+            f"SUMMARY:{ics_escape(event['titulo'])}",
+        ]
+        if event.get("local"):
+            lines.append(f"LOCATION:{ics_escape(event['local'])}")
+        lines += ["STATUS:CONFIRMED", "END:VEVENT"]
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(ics_fold(line) for line in lines) + "\r\n").encode("utf-8")
+
+class CalendarFeeds:
+    """
+    Feeds iCalendar por quadra e por usuário, renderizados uma vez e servidos do cache.
+
+    Cada feed fica em cache (LRU) até uma reserva da quadra/usuário ser criada ou cancelada,
+    a versão do catálogo mudar ou CALENDAR_CACHE_TTL_SECONDS expirar (os eventos de reserva
+    são locais ao processo; o TTL limita a defasagem entre workers). O ETag é o hash do
+    conteúdo, então polls com If-None-Match recebem 304 sem tocar no MongoDB.
+
+    O feed do usuário é endereçado por um token HMAC do telefone (CALENDAR_TOKEN_SECRET);
+    trocar o segredo revoga todos os links.
+    """
+
+    def __init__(self, capacity: int, ttl_seconds: float):
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self._cache = OrderedDict()
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        reservation_events.subscribe("created", self._invalidate)
+        reservation_events.subscribe("cancelled", self._invalidate)
+
+    def enabled_for_users(self) -> bool:
+        return bool(settings.CALENDAR_TOKEN_SECRET)
+
+    def token_for(self, phone: str) -> str:
+        digest = hmac.new(settings.CALENDAR_TOKEN_SECRET.encode("utf-8"), phone.encode("utf-8"), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:18]).decode("ascii")
+
+    def user_link(self, phone: str) -> Optional[str]:
+        """URL pública do feed do usuário (None se PUBLIC_BASE_URL ou o segredo não estiverem configurados)"""
+        if not (self.enabled_for_users() and settings.PUBLIC_BASE_URL):
+            return None
+        token = self.token_for(phone)
+        user_repo.set_calendar_token(phone, token)
+        return f"{settings.PUBLIC_BASE_URL}/calendar/user/{token}.ics"
+
+    def _invalidate(self, reservation: dict):
+        keys = [("court", reservation.get("court_id"))]
+        phone = reservation.get("usuario", {}).get("telefone")
+        if phone and self.enabled_for_users():
+            keys.append(("user", self.token_for(phone)))
+        with self._lock:
+            self._epoch += 1
+            for key in keys:
+                self._cache.pop(key, None)
+
+    def _get_or_render(self, key, render) -> Optional[Tuple[str, bytes]]:
+        version = catalog_cache.version()
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and cached[0] == version and now - cached[1] < self.ttl_seconds:
+                self._cache.move_to_end(key)
+                metrics.inc("calendar_feed_requests_total", kind=key[0], result="hit")
+                return cached[2], cached[3]
+            epoch = self._epoch
+        metrics.inc("calendar_feed_requests_total", kind=key[0], result="miss")
+        body = render()
+        if body is None:
+            return None
+        etag = hashlib.sha1(body).hexdigest()[:20]
+        with self._lock:
+            # Uma reserva criada/cancelada durante a renderização torna o resultado suspeito: não guarda
+            if self._epoch == epoch:
+                self._cache[key] = (version, now, etag, body)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.capacity:
+                    self._cache.popitem(last=False)
+        return etag, body
+
+    def _since_iso(self) -> str:
+        return (datetime.now() - timedelta(days=settings.CALENDAR_PAST_DAYS)).replace(
+            hour=0, minute=0, second=0, microsecond=0).isoformat()
+
+    @staticmethod
+    def _event(reservation: dict, title: str, location: str) -> dict:
+        start_dt = datetime.fromisoformat(reservation["data_reserva"])
+        created = reservation.get("criado_em")
+        return {
+            "uid": f"{reservation['_id']}@vaiterplay",
+            "inicio": start_dt,
+            "fim": start_dt + timedelta(hours=reservation.get("quantidade_horas", 1)),
+            "criado_em": datetime.fromisoformat(created) if created else start_dt,
+            "titulo": title,
+            "local": location
+        }
+
+    @staticmethod
+    def _location(establishment: Optional[Establishment]) -> str:
+        if not establishment:
+            return ""
+        endereco = establishment.endereco or {}
+        parts = [establishment.nome, endereco.get("logradouro"), endereco.get("bairro"), endereco.get("cidade")]
+        return ", ".join(p for p in parts if p)
+
+    def _catalog(self, establishment_id: Optional[str] = None):
+        with partition_scope(establishment_id):
+            courts = {c._id: c for c in catalog_cache.get_courts()}
+            establishments = {e._id: e for e in catalog_cache.get_establishments()}
+        return courts, establishments
+
+    def court_feed(self, court_id: str) -> Optional[Tuple[str, bytes]]:
+        """(etag, corpo) do feed da quadra, ou None se a quadra não existir"""
+        def render():
+            court = court_repo.get_by_id(court_id)
+            if not court:
+                return None
+            _, establishments = self._catalog(court.establishment_id)
+            establishment = establishments.get(court.establishment_id)
+            location = self._location(establishment)
+            events = []
+            for r in reservation_repo.get_for_calendar(self._since_iso(), court_id=court_id):
+                # Feed da quadra é compartilhável: só o primeiro nome de quem reservou
+                first_name = (r.get("usuario", {}).get("nome") or "").split(" ")[0]
+                title = f"Reservado ({first_name})" if first_name and first_name != "Usuário" else "Reservado"
+                events.append(self._event(r, title, location))
+            name = f"{court.nome} - {establishment.nome}" if establishment else court.nome
+            return render_ics(name, events)
+        return self._get_or_render(("court", court_id), render)
+
+    def user_feed(self, token: str) -> Optional[Tuple[str, bytes]]:
+        """(etag, corpo) do feed do usuário dono do token, ou None se o token for inválido"""
+        if not self.enabled_for_users():
+            return None
+
+        def render():
+            phone = user_repo.get_phone_by_calendar_token(token)
+            if not phone or not hmac.compare_digest(self.token_for(phone), token):
+                return None
+            courts, establishments = self._catalog()
+            events = []
+            for r in reservation_repo.get_for_calendar(self._since_iso(), phone=phone):
+                court = courts.get(r.get("court_id"))
+                establishment = establishments.get(r.get("establishment_id"))
+                title = f"Beach Tennis - {court.nome if court else 'Quadra'}"
+                events.append(self._event(r, title, self._location(establishment)))
+            return render_ics("Minhas reservas", events)
+        return self._get_or_render(("user", token), render)
+
+calendar_feeds = CalendarFeeds(settings.CALENDAR_CACHE_SIZE, settings.CALENDAR_CACHE_TTL_SECONDS)
+
+# ===== IMPORTAÇÃO DO CATÁLOGO =====
+CSV_IMPORT_COLUMNS = ["estabelecimento", "cidade", "bairro", "logradouro", "telefone", "email",
+                      "quadra", "valor_hora", "hora_abertura", "hora_fechamento", "latitude", "longitude"]
+
+class CatalogImporter:
+    """
+    Importa estabelecimentos e quadras em lote (JSON ou CSV).
+
+    Cada lote é validado em memória e gravado com bulk_write(ordered=False) por chave natural,
+    de modo que reimportar o mesmo arquivo atualiza em vez de duplicar. Linhas inválidas são
+    reportadas sem interromper as demais, e a versão do catálogo é incrementada uma única vez.
+    """
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+
+    @staticmethod
+    def parse_json(payload) -> List[dict]:
+        """Aceita {"establishments": [...]} ou uma lista; cada item pode trazer "quadras" aninhadas"""
+        items = payload.get("establishments", []) if isinstance(payload, dict) else payload
+        if not isinstance(items, list):
+            raise ValueError("JSON deve ser uma lista ou conter a chave 'establishments'")
+        return [dict(item, linha=index + 1) for index, item in enumerate(items)]
+
+    @staticmethod
+    def parse_csv(text: str) -> List[dict]:
+        """Uma linha por quadra (colunas CSV_IMPORT_COLUMNS); linhas do mesmo estabelecimento são agrupadas"""
+        grouped = OrderedDict()
+        for index, row in enumerate(csv.DictReader(io.StringIO(text)), start=2):
+            row = {key.strip(): (value or "").strip() for key, value in row.items() if key}
+            key = (row.get("estabelecimento", ""), row.get("cidade", ""))
+            item = grouped.setdefault(key, {
+                "linha": index,
+                "nome": row.get("estabelecimento", ""),
+                "endereco": {k: row.get(k, "") for k in ("logradouro", "bairro", "cidade")},
+                "telefone": row.get("telefone", ""),
+                "email": row.get("email", ""),
+                "latitude": row.get("latitude") or None,
+                "longitude": row.get("longitude") or None,
+                "quadras": []
+            })
+            if row.get("quadra"):
+                court = {"linha": index, "nome": row["quadra"], "valor_hora": row.get("valor_hora")}
+                if row.get("hora_abertura") or row.get("hora_fechamento"):
+                    court["hora_abertura"] = row.get("hora_abertura")
+                    court["hora_fechamento"] = row.get("hora_fechamento")
+                item["quadras"].append(court)
+        return list(grouped.values())
+
+    @staticmethod
+    def _build_establishment(item: dict) -> Establishment:
+        nome = (item.get("nome") or "").strip()
+        endereco = item.get("endereco") or {}
+        if not nome:
+            raise ValueError("nome do estabelecimento é obrigatório")
+        if not isinstance(endereco, dict) or not endereco.get("cidade"):
+            raise ValueError("endereco.cidade é obrigatório")
+        localizacao = item.get("localizacao")
+        if localizacao:
+            coordinates = localizacao.get("coordinates") if isinstance(localizacao, dict) else None
+            if not coordinates or len(coordinates) != 2:
+                raise ValueError("localizacao deve ser um ponto GeoJSON")
+            localizacao = geo_point(coordinates[1], coordinates[0])
+        elif item.get("latitude") is not None or item.get("longitude") is not None:
+            localizacao = geo_point(item.get("latitude"), item.get("longitude"))
+        return Establishment(nome=nome, endereco=endereco, telefone=str(item.get("telefone") or ""),
+                             email=item.get("email") or "", ativo=bool(item.get("ativo", True)),
+                             localizacao=localizacao)
+
+    @staticmethod
+    def _build_court(item: dict, establishment_id: str) -> Court:
+        nome = (item.get("nome") or "").strip()
+        if not nome:
+            raise ValueError("nome da quadra é obrigatório")
+        try:
+            valor_hora = float(item.get("valor_hora"))
+        except (TypeError, ValueError):
+            raise ValueError("valor_hora deve ser numérico")
+        if valor_hora <= 0:
+            raise ValueError("valor_hora deve ser positivo")
+        horarios = item.get("horarios_funcionamento")
+        if horarios is None and item.get("hora_abertura") not in (None, ""):
+            try:
+                horarios = list(range(int(item["hora_abertura"]), int(item["hora_fechamento"])))
+            except (TypeError, ValueError, KeyError):
+                raise ValueError("hora_abertura/hora_fechamento devem ser inteiros")
+        if horarios is not None:
+            if not horarios or any(not isinstance(h, int) or not 0 <= h <= 23 for h in horarios):
+                raise ValueError("horarios_funcionamento deve conter horas entre 0 e 23")
+        return Court(nome=nome, establishment_id=establishment_id, valor_hora=valor_hora,
+                     horarios_funcionamento=horarios, ativo=bool(item.get("ativo", True)))
+
+    def import_items(self, items: List[dict]) -> dict:
+        report = {
+            "estabelecimentos": {"inseridos": 0, "atualizados": 0},
+            "quadras": {"inseridos": 0, "atualizados": 0},
+            "erros": []
+        }
+        for start in range(0, len(items), self.batch_size):
+            self._import_batch(items[start:start + self.batch_size], report)
+        if report["estabelecimentos"]["inseridos"] or report["estabelecimentos"]["atualizados"] \
+                or report["quadras"]["inseridos"] or report["quadras"]["atualizados"]:
+            report["versao_catalogo"] = catalog_cache.bump()
+        logger.info(f"[IMPORTACAO] Estabelecimentos {report['estabelecimentos']}, quadras {report['quadras']}, "
+                    f"{len(report['erros'])} erros")
+        return report
+
+    def _import_batch(self, items: List[dict], report: dict):
+        # 1) valida estabelecimentos
+        valid = []
+        for item in items:
+            try:
+                valid.append((item, self._build_establishment(item)))
+            except ValueError as e:
+                report["erros"].append({"linha": item.get("linha"), "erro": str(e)})
+
+        # 2) grava estabelecimentos e resolve seus _id
+        ids, counts, errors = establishment_repo.bulk_upsert([establishment for _, establishment in valid])
+        self._merge(report["estabelecimentos"], counts)
+        for error in errors:
+            report["erros"].append({"linha": valid[error["indice"]][0].get("linha"), "erro": error["erro"]})
+
+        # 3) valida e grava as quadras do lote
+        courts, court_lines = [], []
+        for index, (item, _) in enumerate(valid):
+            if index not in ids:
+                continue
+            for court_item in item.get("quadras") or []:
+                linha = court_item.get("linha", item.get("linha"))
+                try:
+                    courts.append(self._build_court(court_item, ids[index]))
+                    court_lines.append(linha)
+                except ValueError as e:
+                    report["erros"].append({"linha": linha, "erro": str(e)})
+        counts, errors = court_repo.bulk_upsert(courts)
+        self._merge(report["quadras"], counts)
+        for error in errors:
+            report["erros"].append({"linha": court_lines[error["indice"]], "erro": error["erro"]})
+
+    @staticmethod
+    def _merge(total: dict, counts: dict):
+        for key, value in counts.items():
+            total[key] = total.get(key, 0) + value
+
+catalog_importer = CatalogImporter(settings.IMPORT_BATCH_SIZE)
+
+SAMPLE_CATALOG = [
+    {
+        "nome": "Arena Exemplo Beach Tennis",
+        "endereco": {"logradouro": "Rua das Flores, 123", "bairro": "Centro", "cidade": "São Paulo"},
+        "telefone": "+5511999990000",
+        "latitude": -23.5489,
+        "longitude": -46.6388,
+        "quadras": [
+            {"nome": "Quadra 1", "valor_hora": 80.0, "horarios_funcionamento": list(range(8, 22))},
+            {"nome": "Quadra 2", "valor_hora": 60.0, "horarios_funcionamento": list(range(8, 22))}
+        ]
+    }
+]
+
+# ===== BUSCA POR LOCALIZAÇÃO =====
+class GeoGridIndex:
+    """
+    Índice espacial em memória: grade de células de ~cell_km de lado (em graus de latitude).
+
+    A busca percorre anéis de células a partir da célula do ponto e para quando os k mais
+    próximos encontrados estão dentro da distância já coberta pelos anéis (ou ao passar de
+    max_km). É construído a partir do catálogo em cache e refeito a cada nova versão.
+    """
+    EARTH_RADIUS_KM = 6371.0
+    KM_PER_DEGREE = 111.32
+
+    def __init__(self, points: List[Tuple[float, float, object]], cell_km: float):
+        self.cell_km = cell_km
+        self.cell_deg = cell_km / self.KM_PER_DEGREE
+        self.size = len(points)
+        self._cells = {}
+        for lat, lng, value in points:
+            self._cells.setdefault(self._cell(lat, lng), []).append((lat, lng, value))
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg)
+
+    @classmethod
+    def distance_km(cls, lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+        """Distância de haversine"""
+        phi1, phi2 = math.radians(lat1), math.radians(lat2)
+        dphi, dlambda = phi2 - phi1, math.radians(lng2 - lng1)
+        a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+        return 2 * cls.EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+    @staticmethod
+    def _ring(ci: int, cj: int, ring: int):
+        if ring == 0:
+            yield ci, cj
+            return
+        for j in range(cj - ring, cj + ring + 1):
+            yield ci - ring, j
+            yield ci + ring, j
+        for i in range(ci - ring + 1, ci + ring):
+            yield i, cj - ring
+            yield i, cj + ring
+
+    def nearest(self, lat: float, lng: float, k: int, max_km: float) -> List[Tuple[float, object]]:
+        """Até k itens mais próximos a no máximo max_km, como (distância em km, item)"""
+        if not self._cells:
+            return []
+        ci, cj = self._cell(lat, lng)
+        # Longitude encolhe com a latitude: cada anel cobre ao menos cell_km * cos(lat) em qualquer direção
+        ring_km = self.cell_km * max(math.cos(math.radians(lat)), 0.01)
+        found = []
+        for ring in range(int(max_km / ring_km) + 2):
+            for cell in self._ring(ci, cj, ring):
+                for plat, plng, value in self._cells.get(cell, ()):
+                    distance = self.distance_km(lat, lng, plat, plng)
+                    if distance <= max_km:
+                        found.append((distance, value))
+            found.sort(key=lambda item: item[0])
+            if len(found) >= k and found[k - 1][0] <= ring * ring_km:
+                break
+        return found[:k]
+
+def geo_index() -> GeoGridIndex:
+    """Índice dos estabelecimentos com coordenadas, em cache até a próxima versão do catálogo"""
+    def build():
+        points = [(e.latitude, e.longitude, e) for e in catalog_cache.get_establishments() if e.localizacao]
+        return GeoGridIndex(points, settings.GEO_CELL_KM)
+    return catalog_cache.get_cached("geo_index", build)
+
+def nearest_venues_with_slots(latitude: float, longitude: float, limit: int, max_km: float) -> List[dict]:
+    """
+    Estabelecimentos mais próximos que têm alguma hora livre no período do resumo de
+    disponibilidade: [{"estabelecimento", "distancia_km", "livres": {Court: {dia: [horas]}}}].
+    A disponibilidade das quadras candidatas vem de uma única consulta (ou do cache).
+    """
+    candidates = geo_index().nearest(latitude, longitude, limit * 3, max_km)
+    if not candidates:
+        return []
+    candidate_ids = {establishment._id for _, establishment in candidates}
+    courts_by_establishment = {}
+    for court in catalog_cache.get_courts():
+        if court.establishment_id in candidate_ids:
+            courts_by_establishment.setdefault(court.establishment_id, []).append(court)
+    free = availability_digest.free_hours([c for courts in courts_by_establishment.values() for c in courts])
+    venues = []
+    for distance, establishment in candidates:
+        livres = {court: free[court._id] for court in courts_by_establishment.get(establishment._id, [])}
+        if any(hours for days in livres.values() for hours in days.values()):
+            venues.append({"estabelecimento": establishment, "distancia_km": distance, "livres": livres})
+        if len(venues) == limit:
+            break
+    return venues
+
+def handle_location(phone: str, latitude: float, longitude: float) -> str:
+    """Resposta a uma localização compartilhada: locais mais próximos com horários livres"""
+    # A busca considera o catálogo inteiro, não só a partição do estabelecimento atual
+    with partition_scope(None):
+        venues = nearest_venues_with_slots(latitude, longitude, settings.GEO_NEAREST_LIMIT, settings.GEO_MAX_DISTANCE_KM)
+    metrics.inc("location_searches_total", found=str(bool(venues)).lower())
+    if not venues:
+        return (f"Não encontrei quadras com horários livres a até {settings.GEO_MAX_DISTANCE_KM:.0f} km de você. "
+                "Envie o nome da cidade ou do estabelecimento que eu procuro para você.")
+    lines = ["📍 Quadras perto de você:"]
+    for index, venue in enumerate(venues, start=1):
+        establishment = venue["estabelecimento"]
+        endereco = establishment.endereco or {}
+        local = ", ".join(p for p in (endereco.get("logradouro"), endereco.get("bairro")) if p)
+        distance = f"{venue['distancia_km']:.1f}".replace(".", ",")
+        lines.append(f"{index}. {establishment.nome} ({distance} km){' - ' + local if local else ''}")
+        # Primeiro dia com horário livre, com as faixas de cada quadra
+        day_key = min(day for days in venue["livres"].values() for day, hours in days.items() if hours)
+        slots = [f"{court.nome} {hour_ranges(days[day_key])}" for court, days in venue["livres"].items() if days.get(day_key)]
+        lines.append(f"   {availability_digest.day_label(day_key).capitalize()}: {'; '.join(slots[:3])}")
+    lines.append("Para reservar, envie por exemplo: 'reservar Quadra 1 amanhã às 19h'.")
+    return "\n".join(lines)
+
+def process_location(phone: str, latitude: float, longitude: float) -> str:
+    """Turno de localização: responde localmente e registra o par de mensagens no histórico"""
+    response = handle_location(phone, latitude, longitude)
+    metrics.inc("turns_total", source="LOCALIZACAO")
+    history_repo.add_message(phone, ConversationMessage(role="user", content=f"[localização: {latitude:.5f}, {longitude:.5f}]"))
+    history_repo.add_message(phone, ConversationMessage(role="assistant", content=response))
+    logger.info(f"[LOCALIZACAO] Usuário {phone}: ({latitude:.4f}, {longitude:.4f}) -> {response[:50]}...")
+    return response
+
 # ===== NLU E HELPERS =====
 HOURS_PATTERN = re.compile(r"(\d{1,2})(?:h|:\d{2})?", re.IGNORECASE)
+EXPLICIT_HOUR_PATTERN = re.compile(r"(?:\b[àa]s\s+(\d{1,2})\b|\b(\d{1,2})(?:h\b|:\d{2}))", re.IGNORECASE)
 DATE_PATTERN = re.compile(r"(hoje|amanh[aã]|\d{1,2}/\d{1,2}|\d{4}-\d{2}-\d{2})", re.IGNORECASE)
-HOURS_QTY_PATTERN = re.compile(r"(\d{1,2})\s*(h|horas?)", re.IGNORECASE)
+HOURS_QTY_PATTERN = re.compile(r"(?:(?:por|durante)\s+(\d{1,2})\s*h\b|(\d{1,2})\s*horas?\b)", re.IGNORECASE)
+WEEKDAYS = ["segunda", "terca", "quarta", "quinta", "sexta", "sabado", "domingo"]
+WEEKLY_PATTERN = re.compile(r"\btod[ao]s?\s+(?:as\s+|os\s+)?(segunda|terca|quarta|quinta|sexta|sabado|domingo)")
+DAILY_PATTERN = re.compile(r"\btodos\s+os\s+dias\b")
+DATE_RANGE_PATTERN = re.compile(r"\bde\s+(\d{1,2}/\d{1,2})\s+(?:a|ate)\s+(\d{1,2}/\d{1,2})\b")
+OCCURRENCES_PATTERN = re.compile(r"(\d{1,2})\s+(semanas|dias|vezes)")
 
 def parse_date(text: str) -> Optional[datetime]:
     text = text.lower()
@@ -740,48 +2998,74 @@ def parse_date(text: str) -> Optional[datetime]:
     return None
 
 def parse_time(text: str) -> Optional[int]:
-    match = HOURS_PATTERN.search(text)
+    # Prefere horas explícitas ("19h", "19:00", "às 19") a qualquer número solto
+    match = EXPLICIT_HOUR_PATTERN.search(text)
     if match:
+        hour = int(match.group(1) or match.group(2))
+    else:
+        match = HOURS_PATTERN.search(text)
+        if not match:
+            return None
         hour = int(match.group(1))
-        if 0 <= hour <= 23:
-            return hour
+    if 0 <= hour <= 23:
+        return hour
     return None
 
 def parse_hours_qty(text: str) -> int:
     m = HOURS_QTY_PATTERN.search(text)
     if m:
-        return max(1, min(6, int(m.group(1))))
+        return max(1, min(settings.MAX_BOOKING_HOURS, int(m.group(1) or m.group(2))))
     return 1
 
+def parse_recurrence(text: str) -> Optional[dict]:
+    """
+    Detecta reservas recorrentes/multi-dia, ex.: "toda terça 19h pelas próximas 8 semanas",
+    "todos os dias por 5 dias" ou "de 10/03 a 14/03 às 19h".
+
+    Returns:
+        dict: {"frequencia": "semanal"|"diaria", "ocorrencias": int, "inicio": Optional[datetime]}
+    """
+    t = normalize_text(text)
+    count_match = OCCURRENCES_PATTERN.search(t)
+    count = int(count_match.group(1)) if count_match else None
+    now = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    weekly = WEEKLY_PATTERN.search(t)
+    if weekly:
+        weekday = WEEKDAYS.index(weekly.group(1))
+        # A data citada ("a partir de amanhã") é o limite inferior: a série começa no
+        # primeiro dia da semana pedido a partir dela
+        base = parse_date(text) or now
+        start = base + timedelta(days=(weekday - base.weekday()) % 7)
+        return {"frequencia": "semanal", "ocorrencias": count or 4, "inicio": start}
+
+    date_range = DATE_RANGE_PATTERN.search(t)
+    if date_range:
+        first, last = parse_date(date_range.group(1)), parse_date(date_range.group(2))
+        if first and last and last >= first:
+            return {"frequencia": "diaria", "ocorrencias": (last - first).days + 1, "inicio": first}
+
+    if DAILY_PATTERN.search(t):
+        return {"frequencia": "diaria", "ocorrencias": count or 7, "inicio": parse_date(text) or now}
+    return None
+
+def build_occurrences(start_dt: datetime, frequencia: str, ocorrencias: int) -> List[datetime]:
+    """Gera as datas da série (limitadas a RECURRENCE_MAX_OCCURRENCES)"""
+    step = timedelta(weeks=1) if frequencia == "semanal" else timedelta(days=1)
+    total = max(1, min(settings.RECURRENCE_MAX_OCCURRENCES, ocorrencias))
+    return [start_dt + step * i for i in range(total)]
+
 def find_court_by_hint(text: str) -> Optional[Court]:
     hint = text.lower()
-    courts = court_repo.get_all()
+    courts = catalog_cache.get_courts()
     for c in courts:
         if c.nome.lower() in hint or c.tipo.lower() in hint:
             return c
     return courts[0] if courts else None
 
-def get_consecutive_slots(base: datetime, hours: int) -> List[str]:
-    slots = []
-    for i in range(hours):
-        slot_dt = base + timedelta(hours=i)
-        slots.append(slot_dt.isoformat())
-    return slots
-
-def check_availability(court: Court, base: datetime, hours: int) -> bool:
-    needed = set(get_consecutive_slots(base, hours))
-    available = set([h if isinstance(h, str) else (h.isoformat() if isinstance(h, datetime) else str(h)) for h in court.horarios_disponiveis])
-    return needed.issubset(available)
-
-def block_slots(court: Court, base: datetime, hours: int):
-    needed = set(get_consecutive_slots(base, hours))
-    court.horarios_disponiveis = [h for h in [hh if isinstance(hh, str) else (hh.isoformat() if isinstance(hh, datetime) else str(hh)) for hh in court.horarios_disponiveis] if h not in needed]
-    # persist change
-    mongodb.get_collection("quadras").update_one({"_id": ObjectId(court._id)}, {"$set": {"horarios_disponiveis": court.horarios_disponiveis}})
-
 def extract_establishment_from_text(text: str) -> Optional[str]:
     """Extrai nome do estabelecimento mencionado no texto"""
-    establishments = establishment_repo.get_all()
+    establishments = catalog_cache.get_establishments()
     
     text_lower = text.lower()
     
@@ -800,31 +3084,245 @@ def extract_establishment_from_text(text: str) -> Optional[str]:
     
     return None
 
-def intent_from_text(text: str, pending_state: Optional[dict]) -> str:
+# ===== CLASSIFICADOR DE INTENÇÕES =====
+def normalize_text(text: str) -> str:
+    """Minúsculas, sem acentos e com espaços colapsados"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(text.split())
+
+def char_ngrams(text: str, n_min: int = 2, n_max: int = 4) -> Dict[str, int]:
+    """Conta n-gramas de caracteres (com bordas de palavra) do texto normalizado"""
+    padded = f" {normalize_text(text)} "
+    return Counter(padded[i:i + n] for n in range(n_min, n_max + 1) for i in range(len(padded) - n + 1))
+
+def tfidf_vector(text: str, idf: Dict[str, float]) -> Dict[str, float]:
+    """Vetor TF-IDF esparso (normalizado L2) considerando apenas n-gramas do vocabulário"""
+    vector = {}
+    for gram, count in char_ngrams(text).items():
+        weight = idf.get(gram)
+        if weight is not None:
+            vector[gram] = (1.0 + math.log(count)) * weight
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    if norm:
+        for gram in vector:
+            vector[gram] /= norm
+    return vector
+
+class IntentClassifier:
+    """
+    Classificador de intenções local: TF-IDF de n-gramas de caracteres + regressão logística
+    multinomial. Vetores e pesos são esparsos (dicionários), o que mantém a classificação de
+    uma mensagem curta em dezenas de microssegundos sem dependências extras.
+    """
+
+    def __init__(self, labels: List[str], idf: Dict[str, float],
+                 weights: Dict[str, List[float]], bias: List[float]):
+        self.labels = labels
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+
+    def predict_proba(self, text: str) -> List[float]:
+        scores = list(self.bias)
+        for gram, value in tfidf_vector(text, self.idf).items():
+            row = self.weights.get(gram)
+            if row:
+                scores = [score + w * value for score, w in zip(scores, row)]
+        top = max(scores)
+        exps = [math.exp(score - top) for score in scores]
+        total = sum(exps)
+        return [e / total for e in exps]
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """Retorna (intenção, confiança)"""
+        probs = self.predict_proba(text)
+        best = max(range(len(probs)), key=probs.__getitem__)
+        return self.labels[best], probs[best]
+
+    @classmethod
+    def train(cls, samples: List[Tuple[str, str]], epochs: int = 40, learning_rate: float = 0.5,
+              l2: float = 1e-4, seed: int = 42) -> "IntentClassifier":
+        """Treina com SGD sobre pares (texto, intenção)"""
+        labels = sorted({label for _, label in samples})
+        label_index = {label: i for i, label in enumerate(labels)}
+
+        document_frequency = {}
+        for text, _ in samples:
+            for gram in char_ngrams(text):
+                document_frequency[gram] = document_frequency.get(gram, 0) + 1
+        total_docs = len(samples)
+        idf = {gram: math.log((1 + total_docs) / (1 + df)) + 1.0 for gram, df in document_frequency.items()}
+
+        data = [(tfidf_vector(text, idf), label_index[label]) for text, label in samples]
+        weights = {gram: [0.0] * len(labels) for gram in idf}
+        bias = [0.0] * len(labels)
+        model = cls(labels, idf, weights, bias)
+        rng = random.Random(seed)
+        for epoch in range(epochs):
+            rng.shuffle(data)
+            rate = learning_rate / (1 + epoch * 0.1)
+            for vector, target in data:
+                scores = list(bias)
+                for gram, value in vector.items():
+                    for k, w in enumerate(weights[gram]):
+                        scores[k] += w * value
+                top = max(scores)
+                exps = [math.exp(score - top) for score in scores]
+                total = sum(exps)
+                for k in range(len(labels)):
+                    gradient = exps[k] / total - (1.0 if k == target else 0.0)
+                    bias[k] -= rate * gradient
+                    for gram, value in vector.items():
+                        row = weights[gram]
+                        row[k] -= rate * (gradient * value + l2 * row[k])
+        return model
+
+    def save(self, path: str):
+        """Serializa em JSON compactado, descartando pesos desprezíveis"""
+        weights = {gram: [round(w, 4) for w in row] for gram, row in self.weights.items()
+                   if any(abs(w) >= 1e-3 for w in row)}
+        payload = {
+            "labels": self.labels,
+            "idf": {gram: round(self.idf[gram], 4) for gram in weights},
+            "weights": weights,
+            "bias": [round(b, 4) for b in self.bias]
+        }
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: str) -> "IntentClassifier":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            payload = json.load(f)
+        return cls(payload["labels"], payload["idf"], payload["weights"], payload["bias"])
+
+# Exemplos iniciais de treino; o histórico rotulado (conversation_history) complementa este conjunto
+INTENT_SEED_SAMPLES = [
+    ("oi", "saudacao"), ("olá", "saudacao"), ("ola tudo bem", "saudacao"), ("bom dia", "saudacao"),
+    ("boa tarde", "saudacao"), ("boa noite", "saudacao"), ("e aí", "saudacao"), ("oi, tudo bom?", "saudacao"),
+    ("opa", "saudacao"), ("olá, boa tarde", "saudacao"),
+    ("tchau", "despedida"), ("até logo", "despedida"), ("até mais", "despedida"), ("obrigado", "despedida"),
+    ("obrigada pela ajuda", "despedida"), ("valeu", "despedida"), ("falou", "despedida"), ("bye", "despedida"),
+    ("até breve", "despedida"), ("valeu, até mais", "despedida"), ("muito obrigado, tchau", "despedida"),
+    ("sim", "confirmar"), ("confirmo", "confirmar"), ("pode confirmar", "confirmar"), ("ok", "confirmar"),
+    ("isso mesmo", "confirmar"), ("fechado", "confirmar"), ("sim, pode reservar", "confirmar"),
+    ("confirmar", "confirmar"), ("beleza, confirma", "confirmar"), ("perfeito, sim", "confirmar"),
+    ("não", "cancelar"), ("nao", "cancelar"), ("cancelar", "cancelar"), ("cancela", "cancelar"),
+    ("quero cancelar minha reserva", "cancelar"), ("cancelar reserva de amanhã", "cancelar"),
+    ("desisto", "cancelar"), ("não quero mais", "cancelar"), ("pode cancelar", "cancelar"),
+    ("cancelamento da reserva", "cancelar"),
+    ("ajuda", "ajuda"), ("menu", "ajuda"), ("opções", "ajuda"), ("help", "ajuda"), ("como funciona?", "ajuda"),
+    ("o que você faz?", "ajuda"), ("como usar", "ajuda"), ("preciso de ajuda", "ajuda"),
+    ("quais as opções?", "ajuda"), ("o que posso fazer aqui", "ajuda"),
+    ("minhas reservas", "consultar"), ("consultar reservas", "consultar"), ("ver reservas", "consultar"),
+    ("quais são minhas reservas?", "consultar"), ("mostrar minhas reservas", "consultar"),
+    ("tenho alguma reserva?", "consultar"), ("qual meu horário marcado", "consultar"),
+    ("listar reservas", "consultar"), ("consultar", "consultar"), ("quando é minha reserva?", "consultar"),
+    ("quero reservar", "reservar"), ("reservar amanhã 19h", "reservar"), ("agendar quadra hoje 18h", "reservar"),
+    ("quero uma quadra amanhã às 20h por 2 horas", "reservar"), ("reserva para sábado 10h", "reservar"),
+    ("tem horário hoje às 19h?", "reservar"), ("pode ser até amanhã 19h", "reservar"),
+    ("minhas amigas querem jogar amanhã 18h", "reservar"), ("marcar beach tennis dia 15/03 às 9h", "reservar"),
+    ("quero jogar hoje à noite", "reservar"), ("reservar quadra 1 por 3 horas", "reservar"),
+    ("tem quadra livre amanhã de manhã?", "reservar"),
+    ("quanto custa a hora?", "outro"), ("onde fica a arena?", "outro"), ("qual o endereço?", "outro"),
+    ("aceita pix?", "outro"), ("tem estacionamento?", "outro"), ("vocês alugam raquete?", "outro"),
+    ("qual o valor da quadra", "outro"), ("que horas abre?", "outro"), ("e amanhã?", "outro"),
+    ("quais quadras vocês têm?", "outro"),
+]
+
+def collect_intent_samples(limit_docs: int = 5000) -> List[Tuple[str, str]]:
+    """Exemplos rotulados do histórico: mensagens do usuário cuja intenção foi confirmada pelo fluxo"""
+    samples = []
+    cursor = history_repo.get_collection().find(
+        {"messages.intent": {"$exists": True}}, {"messages": 1}
+    ).limit(limit_docs)
+    for doc in cursor:
+        for msg in doc.get("messages", []):
+            if msg.get("role") == "user" and msg.get("intent") and msg.get("intent_origem") != "modelo":
+                samples.append((msg.get("content", ""), msg["intent"]))
+    return samples
+
+def load_intent_classifier(path: str) -> Optional[IntentClassifier]:
+    """Carrega o modelo serializado; sem arquivo, treina com o conjunto inicial"""
+    try:
+        if os.path.exists(path):
+            model = IntentClassifier.load(path)
+            logger.info(f"Classificador de intenções carregado de {path} ({len(model.weights)} n-gramas)")
+            return model
+        model = IntentClassifier.train(INTENT_SEED_SAMPLES)
+        logger.info("Classificador de intenções treinado com o conjunto inicial")
+        return model
+    except Exception as e:
+        logger.error(f"Erro ao carregar classificador de intenções: {e}")
+        return None
+
+intent_classifier = load_intent_classifier(settings.INTENT_MODEL_PATH)
+
+GREETINGS = {"oi", "olá", "ola", "bom dia", "boa tarde", "boa noite"}
+FAREWELL_PATTERN = re.compile(r"\b(tchau|at[eé] (logo|mais|breve)|obrigad[oa]|valeu|bye|falou)\b")
+CONFIRM_PATTERN = re.compile(r"\b(confirmo|confirmar|confirma|sim|ok)\b")
+DENY_PATTERN = re.compile(r"\b(cancelar|cancela|n[aã]o)\b")
+HELP_PATTERN = re.compile(r"\b(ajuda|menu|op[cç][oõ]es|help)\b")
+CONSULT_PATTERN = re.compile(r"\b(minhas reservas|consultar|ver reservas)\b")
+CANCEL_PATTERN = re.compile(r"\b(cancelar|cancelamento)\b")
+BOOK_PATTERN = re.compile(r"\b(reservar|reserva|agendar)\b")
+
+def carries_request(text: str) -> bool:
+    """Mensagem com pedido embutido (data, hora, reserva ou pergunta), ex.: 'obrigado, e amanhã às 19h?'"""
     t = text.lower()
-    
-    # Detecção de despedida (fim de sessão)
-    farewell_words = ["tchau", "até logo", "até mais", "obrigado", "obrigada", "valeu", "bye", "até", "falou"]
-    if any(word in t for word in farewell_words):
-        return "despedida"
-    
-    # Saudações diretas
-    if t.strip() in ["oi", "olá", "ola", "bom dia", "boa tarde", "boa noite"]:
-        return "saudacao"
-    if pending_state and pending_state.get("awaiting") == "confirmation":
-        if any(w in t for w in ["confirmo", "confirmar", "sim", "ok"]):
-            return "confirmar"
-        if any(w in t for w in ["cancelar", "cancela", "não", "nao"]):
-            return "cancelar"
-    if any(w in t for w in ["ajuda", "menu", "opcoes", "opções", "help"]):
-        return "ajuda"
-    if any(w in t for w in ["minhas reservas", "minhas", "consultar", "minhas reservas", "ver reservas"]):
-        return "consultar"
-    if any(w in t for w in ["cancelar reserva", "cancelar", "cancelamento"]):
-        return "cancelar"
-    if any(w in t for w in ["reservar", "reserva", "agendar", "quero reservar"]):
-        return "reservar"
-    return "desconhecido"
+    return "?" in t or bool(BOOK_PATTERN.search(t)) or parse_time(text) is not None or parse_date(text) is not None
+
+def awaiting_reply(pending_state: Optional[dict]) -> bool:
+    """Há uma pergunta de sim/não pendente (confirmação de reserva ou lista de espera)"""
+    return bool(pending_state and pending_state.get("awaiting") in ("confirmation", "waitlist"))
+
+def classify_intent(text: str, pending_state: Optional[dict]) -> Tuple[str, float, str]:
+    """
+    Classifica a intenção retornando (intenção, confiança, origem).
+
+    Saudações exatas e sim/não com reserva pendente são resolvidos por regra; o resto
+    pelo classificador local. Abaixo do limiar de confiança valem as regras de palavras-chave,
+    mantendo a confiança baixa para que o fluxo encaminhe a mensagem ao LLM. Agradecimentos
+    que trazem um pedido junto não viram despedida por regra (a despedida limpa o estado pendente).
+    """
+    t = text.lower().strip()
+    awaiting_confirmation = awaiting_reply(pending_state)
+    if t in GREETINGS:
+        return "saudacao", 1.0, "regra"
+    if awaiting_confirmation:
+        if CONFIRM_PATTERN.search(t):
+            return "confirmar", 1.0, "regra"
+        if DENY_PATTERN.search(t):
+            return "cancelar", 1.0, "regra"
+
+    model_intent, confidence = ("desconhecido", 0.0)
+    if intent_classifier is not None:
+        start = time.perf_counter()
+        model_intent, confidence = intent_classifier.predict(text)
+        metrics.observe("intent_classify_seconds", time.perf_counter() - start)
+        if model_intent == "outro":
+            model_intent = "desconhecido"
+        # Confirmação só faz sentido com uma reserva aguardando
+        if model_intent == "confirmar" and not awaiting_confirmation:
+            model_intent = "desconhecido"
+        if confidence >= settings.INTENT_CONFIDENCE_THRESHOLD:
+            return model_intent, confidence, "modelo"
+
+    if FAREWELL_PATTERN.search(t) and not carries_request(text):
+        return "despedida", confidence, "regra"
+    if HELP_PATTERN.search(t):
+        return "ajuda", confidence, "regra"
+    if CONSULT_PATTERN.search(t):
+        return "consultar", confidence, "regra"
+    if CANCEL_PATTERN.search(t):
+        return "cancelar", confidence, "regra"
+    if BOOK_PATTERN.search(t):
+        return "reservar", confidence, "regra"
+    return "desconhecido", confidence, "regra"
+
+def intent_from_text(text: str, pending_state: Optional[dict]) -> str:
+    return classify_intent(text, pending_state)[0]
 
 def handle_help() -> str:
     return (
@@ -836,14 +3334,17 @@ def handle_consulta(phone: str) -> str:
     reservas = reservation_repo.get_by_user_phone(phone)
     if not reservas:
         return "Você não possui reservas."
+    courts = {c._id: c for c in catalog_cache.get_courts()}
     lines = []
     for r in reservas:
         dt = datetime.fromisoformat(r.get("data_reserva"))
-        qid = r.get("quadra_id")
-        court_doc = mongodb.get_collection("quadras").find_one({"_id": ObjectId(qid)})
-        nome = court_doc.get("nome") if court_doc else "Quadra"
+        court = courts.get(r.get("court_id"))
+        nome = court.nome if court else "Quadra"
         horas = r.get("quantidade_horas", 1)
         lines.append(f"- {nome} em {dt.strftime('%d/%m %H:%M')} por {horas}h (status: {r.get('status')})")
+    link = calendar_feeds.user_link(phone)
+    if link:
+        lines.append(f"\n📅 Adicione ao seu calendário: {link}")
     return "Suas reservas:\n" + "\n".join(lines)
 
 def handle_reserva_flow(user: User, text: str, phone: str) -> str:
@@ -853,11 +3354,35 @@ def handle_reserva_flow(user: User, text: str, phone: str) -> str:
     court = find_court_by_hint(text)
     if not court:
         return "Não encontrei quadras cadastradas."
+    recurrence = parse_recurrence(text)
+    if recurrence and recurrence.get("inicio") and hour is not None:
+        start_dt = recurrence["inicio"].replace(hour=hour, minute=0, second=0, microsecond=0)
+        if start_dt < datetime.now():
+            # Horário de hoje já passou: a série começa na próxima ocorrência
+            start_dt += timedelta(weeks=1) if recurrence["frequencia"] == "semanal" else timedelta(days=1)
+        return start_recurring_reservation(phone, court, start_dt, hours_qty,
+                                           recurrence["frequencia"], recurrence["ocorrencias"])
     if date is None or hour is None:
         return "Informe data e hora. Ex.: 'reservar amanhã 19h por 2 horas'."
     start_dt = date.replace(hour=hour, minute=0, second=0, microsecond=0)
-    if not check_availability(court, start_dt, hours_qty):
-        return "Não há disponibilidade para esse horário/intervalo. Tente outro horário."
+    return start_reservation(phone, court, start_dt, hours_qty)
+
+def start_reservation(phone: str, court: Court, start_dt: datetime, hours_qty: int) -> str:
+    """Valida a disponibilidade e deixa a reserva aguardando confirmação do usuário"""
+    availability_check = validate_court_availability(court._id, start_dt, hours_qty)
+    if not availability_check["disponivel"]:
+        if availability_check.get("horarios_ocupados"):
+            # Horário ocupado: oferece a lista de espera em vez de pedir novas tentativas
+            state_repo.set_state(phone, {
+                "awaiting": "waitlist",
+                "court_id": court._id,
+                "court_nome": court.nome,
+                "start_iso": start_dt.isoformat(),
+                "hours_qty": hours_qty
+            })
+            return (f"{availability_check['mensagem']} Quer entrar na lista de espera de {court.nome} em "
+                    f"{start_dt.strftime('%d/%m %H:%M')}? Aviso aqui se liberar. Responda 'sim'.")
+        return f"Não há disponibilidade para esse horário/intervalo. {availability_check['mensagem']} Tente outro horário."
     total = court.valor_hora * hours_qty
     # salva estado aguardando confirmação
     state_repo.set_state(phone, {
@@ -872,13 +3397,69 @@ def handle_reserva_flow(user: User, text: str, phone: str) -> str:
     return (f"{court.nome} disponível em {start_dt.strftime('%d/%m %H:%M')} por {hours_qty}h. "
             f"Preço R${court.valor_hora:.2f}/h, total R${total:.2f}. Confirmar?")
 
+def start_recurring_reservation(phone: str, court: Court, start_dt: datetime, hours_qty: int,
+                                frequencia: str, ocorrencias: int) -> str:
+    """Valida todas as datas da série de uma vez e deixa as livres aguardando confirmação"""
+    occurrences = build_occurrences(start_dt, frequencia, ocorrencias)
+    availability = validate_series_availability(court, occurrences, hours_qty)
+    livres = availability["disponiveis"]
+    if not livres:
+        return f"Nenhuma data da série está disponível. {availability['mensagem']}"
+    total = court.valor_hora * hours_qty * len(livres)
+    state_repo.set_state(phone, {
+        "awaiting": "confirmation",
+        "court_id": court._id,
+        "court_nome": court.nome,
+        "start_iso": livres[0].isoformat(),
+        "series": [dt.isoformat() for dt in livres],
+        "frequencia": frequencia,
+        "hours_qty": hours_qty,
+        "preco_hora": court.valor_hora,
+        "total": total
+    })
+    datas = ", ".join(dt.strftime("%d/%m") for dt in livres)
+    conflitos = f" {availability['mensagem']}" if availability["conflitos"] else ""
+    return (f"{court.nome} às {start_dt.strftime('%H:%M')} por {hours_qty}h em {len(livres)} datas: {datas}.{conflitos} "
+            f"Total R${total:.2f}. Confirmar?")
+
+def confirm_series(phone: str, user: User, state: dict, court: Court, establishment_id: str) -> str:
+    """Revalida a série em lote e insere todas as ocorrências de uma vez"""
+    hours_qty = int(state["hours_qty"])
+    occurrences = [datetime.fromisoformat(iso) for iso in state["series"]]
+    availability = validate_series_availability(court, occurrences, hours_qty)
+    if availability["conflitos"]:
+        state_repo.clear_state(phone)
+        return f"Algumas datas ficaram indisponíveis. {availability['mensagem']} Nada foi reservado; quer tentar de novo?"
+    serie_id = str(ObjectId())
+    reservas = [
+        Reservation(
+            usuario=user,
+            establishment_id=establishment_id,
+            court_id=court._id,
+            data_reserva=occurrence,
+            quantidade_horas=hours_qty,
+            status="confirmada",
+            valor_hora=state.get("preco_hora", court.valor_hora),
+            recorrencia={"serie_id": serie_id, "frequencia": state.get("frequencia", "semanal"),
+                         "ocorrencias": len(occurrences), "indice": i}
+        )
+        for i, occurrence in enumerate(occurrences)
+    ]
+    reservation_repo.create_many(reservas)
+    state_repo.clear_state(phone)
+    return (f"Série confirmada! Código {serie_id}. {court.nome} às {occurrences[0].strftime('%H:%M')} "
+            f"em {len(occurrences)} datas, de {occurrences[0].strftime('%d/%m')} a {occurrences[-1].strftime('%d/%m')}.")
+
 def handle_confirm(phone: str, user: User) -> str:
     state = state_repo.get_state(phone)
+    if state and state.get("awaiting") == "waitlist":
+        return waitlist_service.join(phone, state)
     if not state or state.get("awaiting") != "confirmation":
         return "Não há reserva pendente para confirmar."
+    if state.get("hold_id"):
+        return confirm_waitlist_hold(phone, state)
     
     court_id = state["court_id"]
-    establishment_id = state.get("establishment_id", "")
     start_dt = datetime.fromisoformat(state["start_iso"])
     hours_qty = int(state["hours_qty"])
     
@@ -887,6 +3468,9 @@ def handle_confirm(phone: str, user: User) -> str:
     if not court:
         state_repo.clear_state(phone)
         return "Quadra não encontrada."
+    establishment_id = state.get("establishment_id") or court.establishment_id
+    if state.get("series"):
+        return confirm_series(phone, user, state, court, establishment_id)
     
     # Valida disponibilidade real usando a nova função
     availability_check = validate_court_availability(court_id, start_dt, hours_qty)
@@ -905,7 +3489,8 @@ def handle_confirm(phone: str, user: User) -> str:
         court_id=court_id, 
         data_reserva=start_dt, 
         quantidade_horas=hours_qty, 
-        status="confirmada"
+        status="confirmada",
+        valor_hora=state.get("preco_hora", court.valor_hora)
     )
     
     res_id = reservation_repo.create(reserva)
@@ -914,6 +3499,16 @@ def handle_confirm(phone: str, user: User) -> str:
     return (f"Reserva confirmada! Código {res_id}. {court.nome} em {start_dt.strftime('%d/%m %H:%M')} "
             f"por {hours_qty}h. Precisando, é só chamar!")
 
+def confirm_waitlist_hold(phone: str, state: dict) -> str:
+    """Confirma o horário retido para o usuário da lista de espera"""
+    state_repo.clear_state(phone)
+    doc = reservation_repo.confirm_hold(state["hold_id"])
+    if not doc:
+        return "O prazo para confirmar esse horário expirou e ele foi oferecido ao próximo da lista."
+    start_dt = datetime.fromisoformat(doc["data_reserva"])
+    return (f"Reserva confirmada! Código {doc['_id']}. {state.get('court_nome', 'Quadra')} em "
+            f"{start_dt.strftime('%d/%m %H:%M')} por {doc.get('quantidade_horas', 1)}h.")
+
 def handle_cancel(phone: str) -> str:
     state_repo.clear_state(phone)
     return "Ok, cancelado. Se quiser, posso buscar outro horário."
@@ -938,52 +3533,232 @@ def handle_farewell(phone: str) -> str:
         logger.error(f"Erro ao processar despedida: {e}")
         return "Até logo! Foi um prazer ajudar!"
 
-def process_message(phone: str, text: str) -> str:
-    # Salva mensagem do usuário no histórico
-    user_message = ConversationMessage(role="user", content=text)
-    history_repo.add_message(phone, user_message)
-    
+# Intenções respondidas localmente quando o classificador tem confiança suficiente
+LOCAL_INTENTS = {"saudacao", "ajuda", "consultar"}
+
+def prepare_turn(phone: str, text: str, degraded: bool = False) -> dict:
+    """
+    Classifica o turno e, quando ele pode ser resolvido localmente (NLU, FAQ ou modo
+    degradado), já calcula a resposta. Turnos que dependem do LLM voltam com response=None
+    para serem concluídos por finish_turn (na faixa do LLM, quando habilitada).
+    """
     user = user_repo.find_or_create_by_phone(phone)
     pending = state_repo.get_state(phone)
-    intent = intent_from_text(text, pending)
+    intent, confidence, intent_source = classify_intent(text, pending)
+    metrics.inc("intent_predictions_total", intent=intent, source=intent_source)
+    turn = {
+        "phone": phone, "text": text, "user": user, "intent": intent, "intent_source": intent_source,
+        "user_message": ConversationMessage(role="user", content=text),
+        "response": None, "response_source": "NLU"
+    }
     
-    # Processa apenas ações críticas com NLU tradicional
-    response_source = "NLU"
+    # Processa ações críticas e intenções de alta confiança com NLU local
     if intent == "confirmar":
-        response = handle_confirm(phone, user)
-        logger.info(f"[NLU-CONFIRMAR] Usuário {phone}: '{text}' -> Resposta: '{response[:50]}...'")
-    elif intent == "cancelar" and pending and pending.get("awaiting") == "confirmation":
-        response = handle_cancel(phone)
-        logger.info(f"[NLU-CANCELAR] Usuário {phone}: '{text}' -> Resposta: '{response[:50]}...'")
+        turn["response"] = handle_confirm(phone, user)
+        logger.info(f"[NLU-CONFIRMAR] Usuário {phone}: '{text}' -> Resposta: '{turn['response'][:50]}...'")
+    elif intent == "cancelar" and awaiting_reply(pending):
+        turn["response"] = handle_cancel(phone)
+        logger.info(f"[NLU-CANCELAR] Usuário {phone}: '{text}' -> Resposta: '{turn['response'][:50]}...'")
     elif intent == "despedida":
-        response = handle_farewell(phone)
-        logger.info(f"[NLU-DESPEDIDA] Usuário {phone}: '{text}' -> Resposta: '{response[:50]}...'")
+        turn["response"] = handle_farewell(phone)
+        logger.info(f"[NLU-DESPEDIDA] Usuário {phone}: '{text}' -> Resposta: '{turn['response'][:50]}...'")
+    elif intent in LOCAL_INTENTS and confidence >= settings.INTENT_CONFIDENCE_THRESHOLD:
+        turn["response"] = nlu_fallback_response(phone, text, intent)
+        logger.info(f"[NLU-{intent.upper()}] Usuário {phone}: '{text}' ({confidence:.2f}) -> Resposta: '{turn['response'][:50]}...'")
+    elif intent == "desconhecido" and not awaiting_reply(pending) and (faq := faq_lookup(phone, text)):
+        # Pergunta sobre o catálogo (preço, endereço, horários): resposta pronta, sem LLM
+        turn["response_source"] = "FAQ"
+        turn["response"] = faq
+    elif degraded or not rate_limiter.allow(phone, PhoneRateLimiter.LLM):
+        # Sobrecarga (ou telefone sem orçamento de LLM): responde só com os handlers locais
+        degrade_turn(turn)
     else:
         # Tudo mais é processado pela IA com contexto completo
-        response_source = "LLM"
-        response = generate_llm_response(phone, text)
-        logger.info(f"[LLM-CONVERSA] Usuário {phone}: '{text}' -> Resposta: '{response[:50]}...'")
+        turn["response_source"] = "LLM"
+    return turn
+
+def degrade_turn(turn: dict):
+    """Resolve o turno só com os handlers locais (sobrecarga ou sem orçamento de LLM)"""
+    phone, text, intent = turn["phone"], turn["text"], turn["intent"]
+    turn["response_source"] = "DEGRADADO"
+    if intent in LOCAL_INTENTS or intent == "reservar":
+        turn["response"] = nlu_fallback_response(phone, text, intent)
+    else:
+        turn["response"] = ("Estou com muita demanda agora e só consigo atender pedidos diretos, como "
+                            "'reservar amanhã às 19h', 'minhas reservas' ou 'ajuda'.")
+    logger.info(f"[NLU-DEGRADADO] Usuário {phone}: '{text}' -> Resposta: '{turn['response'][:50]}...'")
+
+def finish_turn(turn: dict) -> str:
+    """Gera a resposta do LLM se o turno precisar e grava o par de mensagens no histórico"""
+    phone, text = turn["phone"], turn["text"]
+    user_message = turn["user_message"]
+    if turn["response"] is None:
+        turn["response"] = generate_llm_response(phone, text, user_message)
+        logger.info(f"[LLM-CONVERSA] Usuário {phone}: '{text}' -> Resposta: '{turn['response'][:50]}...'")
+    response = turn["response"]
+    metrics.inc("turns_total", source=turn["response_source"])
+    
+    # Salva mensagem do usuário no histórico (com a intenção quando tratada localmente)
+    if turn["response_source"] == "NLU":
+        user_message.intent = turn["intent"]
+        user_message.intent_origem = turn["intent_source"]
+    history_repo.add_message(phone, user_message)
     
-    # Salva resposta do assistente no histórico
+    # Salva resposta do assistente no histórico (gravação adiada; a retenção de 24h é aplicada no flush)
     assistant_message = ConversationMessage(role="assistant", content=response)
     history_repo.add_message(phone, assistant_message)
     
-    # Limpa mensagens antigas (mais de 24h)
-    history_repo.clear_old_messages(phone, hours=24)
-    
     return response
 
-def generate_llm_response(phone: str, text: str) -> str:
-    """Gera resposta usando LLM com contexto da conversa"""
-    if not groq_client:
-        logger.warning(f"[LLM-DESABILITADO] Usuário {phone}: '{text}' -> Fallback para resposta padrão")
-        return "Não entendi. Envie 'ajuda' para ver exemplos."
+def process_message(phone: str, text: str, degraded: bool = False) -> str:
+    return finish_turn(prepare_turn(phone, text, degraded))
+
+def nlu_fallback_response(phone: str, text: str, intent: Optional[str] = None) -> str:
+    """Resposta apenas com NLU local (intenções de alta confiança ou LLM indisponível)"""
+    intent = intent or intent_from_text(text, state_repo.get_state(phone))
+    if intent == "ajuda":
+        return handle_help()
+    if intent == "saudacao":
+        return "Olá! " + handle_help()
+    if intent == "consultar":
+        return handle_consulta(phone)
+    if intent == "reservar":
+        return handle_reserva_flow(user_repo.find_or_create_by_phone(phone), text, phone)
+    return "Não entendi. Envie 'ajuda' para ver exemplos."
+
+# ===== FERRAMENTAS DO LLM =====
+def _tool_reservation_args(properties_extra: Optional[dict] = None) -> dict:
+    properties = {
+        "court_id": {"type": "string", "description": "ID da quadra (campo id da lista de quadras)"},
+        "date": {"type": "string", "description": "Data no formato AAAA-MM-DD"},
+        "hour": {"type": "integer", "minimum": 0, "maximum": 23, "description": "Hora de início (0-23)"},
+        "hours_qty": {"type": "integer", "minimum": 1, "maximum": settings.MAX_BOOKING_HOURS, "description": "Quantidade de horas"}
+    }
+    properties.update(properties_extra or {})
+    return {"type": "object", "properties": properties, "required": ["court_id", "date", "hour"]}
+
+LLM_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "check_availability",
+            "description": "Verifica se uma quadra está livre em uma data/hora e lista os horários livres do dia.",
+            "parameters": _tool_reservation_args()
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "start_reservation",
+            "description": "Inicia uma reserva (única ou recorrente): valida a disponibilidade de todas as datas e pede a confirmação do usuário. Use quando quadra, data e hora estiverem definidas.",
+            "parameters": _tool_reservation_args({
+                "repeat": {"type": "string", "enum": ["semanal", "diaria"], "description": "Repetição, para reservas recorrentes ou de vários dias"},
+                "occurrences": {"type": "integer", "minimum": 1, "maximum": settings.RECURRENCE_MAX_OCCURRENCES, "description": "Número de datas da série (com repeat)"}
+            })
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "list_reservations",
+            "description": "Lista as reservas do usuário atual, com seus IDs.",
+            "parameters": {"type": "object", "properties": {}}
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "cancel_reservation",
+            "description": "Cancela uma reserva do usuário atual pelo ID (obtenha o ID com list_reservations).",
+            "parameters": {
+                "type": "object",
+                "properties": {"reservation_id": {"type": "string", "description": "ID da reserva"}},
+                "required": ["reservation_id"]
+            }
+        }
+    }
+]
+
+# Intenção confirmada pela execução de cada ferramenta (rótulo para o classificador)
+TOOL_INTENTS = {
+    "check_availability": "reservar",
+    "start_reservation": "reservar",
+    "list_reservations": "consultar",
+    "cancel_reservation": "cancelar"
+}
+
+def _parse_tool_datetime(args: dict) -> datetime:
+    date_obj = datetime.fromisoformat(str(args["date"]))
+    return date_obj.replace(hour=int(args["hour"]), minute=0, second=0, microsecond=0)
+
+def execute_tool(phone: str, name: str, args: dict) -> dict:
+    """
+    Executa uma ferramenta chamada pelo LLM contra os repositórios.
+
+    Retorna um dicionário serializável; quando contém "resposta_final", a mensagem já pode
+    ser enviada ao usuário sem uma nova chamada ao LLM.
+    """
+    try:
+        if name in ("check_availability", "start_reservation"):
+            court_id = str(args["court_id"])
+            court = court_repo.get_by_id(court_id) if ObjectId.is_valid(court_id) else None
+            if not court:
+                return {"erro": "Quadra não encontrada. Use um id da lista de quadras."}
+            start_dt = _parse_tool_datetime(args)
+            hours_qty = max(1, min(settings.MAX_BOOKING_HOURS, int(args.get("hours_qty") or 1)))
+            if name == "start_reservation":
+                if args.get("repeat") in ("semanal", "diaria"):
+                    return {"resposta_final": start_recurring_reservation(
+                        phone, court, start_dt, hours_qty, args["repeat"], int(args.get("occurrences") or 4)
+                    )}
+                return {"resposta_final": start_reservation(phone, court, start_dt, hours_qty)}
+            availability = validate_court_availability(court._id, start_dt, hours_qty)
+            return {
+                "quadra": court.nome,
+                "disponivel": availability["disponivel"],
+                "horarios_livres_no_dia": availability["horarios_disponiveis"],
+                "mensagem": availability["mensagem"]
+            }
+        if name == "list_reservations":
+            reservas = reservation_repo.get_by_user_phone(phone)
+            courts = {c._id: c.nome for c in catalog_cache.get_courts()}
+            return {"reservas": [
+                {
+                    "id": str(r["_id"]),
+                    "quadra": courts.get(r.get("court_id"), "Quadra"),
+                    "inicio": r.get("data_reserva"),
+                    "horas": r.get("quantidade_horas", 1),
+                    "status": r.get("status")
+                }
+                for r in reservas if r.get("status") != "cancelada"
+            ]}
+        if name == "cancel_reservation":
+            reservation_id = str(args["reservation_id"])
+            if not ObjectId.is_valid(reservation_id):
+                return {"erro": "Reserva não encontrada para este usuário."}
+            own_ids = {str(r["_id"]) for r in reservation_repo.get_by_user_phone(phone)}
+            if reservation_id not in own_ids:
+                return {"erro": "Reserva não encontrada para este usuário."}
+            if reservation_repo.cancel_by_id(reservation_id):
+                return {"resposta_final": f"Reserva {reservation_id} cancelada. Se quiser, posso buscar outro horário."}
+            return {"resposta_final": "Essa reserva já estava cancelada."}
+        return {"erro": f"Ferramenta desconhecida: {name}"}
+    except (KeyError, ValueError, TypeError, InvalidId) as e:
+        # Argumentos malformados do modelo voltam como resultado da ferramenta, para ele corrigir
+        return {"erro": f"Argumentos inválidos: {e}"}
+
+def generate_llm_response(phone: str, text: str, user_message: Optional[ConversationMessage] = None) -> str:
+    """Gera resposta usando LLM com contexto da conversa e chamadas de ferramentas"""
+    if not llm_gateway.available:
+        logger.warning(f"[LLM-INDISPONIVEL] Usuário {phone}: '{text}' -> Fallback para NLU")
+        return nlu_fallback_response(phone, text)
     
     try:
         logger.info(f"[LLM-INICIANDO] Usuário {phone}: '{text}' -> Gerando resposta com contexto")
         # Contexto das quadras e estabelecimentos
-        establishments = establishment_repo.get_all()
-        courts = court_repo.get_all()
+        establishments = catalog_cache.get_establishments()
+        courts = catalog_cache.get_courts()
+        establishment_names = {e._id: e.nome for e in establishments}
         
         establishments_context = ""
         if establishments:
@@ -991,14 +3766,23 @@ def generate_llm_response(phone: str, text: str) -> str:
         
         courts_context = ""
         if courts:
-            courts_context = "QUADRAS DISPONÍVEIS:\n" + "\n".join([f"- {c.nome} (Beach Tennis) - R${c.valor_hora:.2f}/h" for c in courts][:10])
+            courts_context = "QUADRAS DISPONÍVEIS:\n" + "\n".join([f"- {c.nome} [id: {c._id}] ({establishment_names.get(c.establishment_id, 'Beach Tennis')}) - R${c.valor_hora:.2f}/h" for c in courts][:10])
         
         if not establishments_context and not courts_context:
             establishments_context = "(sem estabelecimentos cadastrados)"
             courts_context = "(sem quadras cadastradas)"
         
-        # Contexto da conversa (últimas 10 mensagens)
-        conversation_context = history_repo.get_conversation_context(phone, max_messages=10)
+        # Horas livres por quadra nos próximos dias (em cache, dentro de um orçamento de tokens)
+        availability_context = ""
+        if courts:
+            digest = availability_digest.render(courts, settings.AVAILABILITY_DIGEST_MAX_TOKENS)
+            metrics.observe("llm_context_tokens", estimate_tokens(digest), kind="disponibilidade")
+            availability_context = "HORÁRIOS LIVRES (faixas livres por dia; fora delas a quadra está ocupada ou fechada):\n" + digest
+        
+        # Contexto da conversa (resumo + últimas mensagens); agenda novo resumo se a sessão cresceu
+        conversation_context, unsummarized = history_repo.get_context_window(phone, max_messages=10)
+        if unsummarized >= settings.SUMMARY_TRIGGER_MESSAGES:
+            conversation_summarizer.request(phone)
         
         # Estado atual (se houver)
         pending = state_repo.get_state(phone)
@@ -1006,14 +3790,24 @@ def generate_llm_response(phone: str, text: str) -> str:
         if pending and pending.get("awaiting") == "confirmation":
             state_context = f"\nEstado atual: Aguardando confirmação de reserva - {pending.get('court_nome')} em {pending.get('start_iso')} por {pending.get('hours_qty')}h - Total: R${pending.get('total', 0):.2f}"
         
+        # Modelo, max_tokens e temperatura conforme a complexidade do turno
+        route = model_router.route(text, pending, unsummarized)
+        logger.info(f"[LLM-ROTA] Usuário {phone}: rota {route['route']} ({route['model']}, pontuação {route['score']:.0f})")
+        
+        now = datetime.now()
+        weekdays = ["segunda", "terça", "quarta", "quinta", "sexta", "sábado", "domingo"]
+        
         # Monta prompt com contexto completo
         prompt = f"""Você é um assistente inteligente de reservas de quadras de Beach Tennis via WhatsApp. 
 Aja de forma natural, amigável e objetiva em português do Brasil.
+Hoje é {now.strftime('%Y-%m-%d')} ({weekdays[now.weekday()]}), {now.strftime('%H:%M')}.
 
 {establishments_context}
 
 {courts_context}
 
+{availability_context}
+
 HISTÓRICO DA CONVERSA (últimas mensagens):
 {conversation_context if conversation_context else "Primeira mensagem da conversa"}
 
@@ -1021,95 +3815,1084 @@ HISTÓRICO DA CONVERSA (últimas mensagens):
 
 MENSAGEM ATUAL DO USUÁRIO: {text}
 
-FUNCIONALIDADES QUE VOCÊ PODE REALIZAR:
-1. SAUDAÇÕES: Apenas na primeira mensagem ou após longa pausa
-2. CONSULTAR DISPONIBILIDADE: Liste estabelecimentos e quadras disponíveis
-3. RESERVAR QUADRAS: Processe solicitações de reserva (estabelecimento, data, hora, quantidade de horas)
-4. CONSULTAR RESERVAS: Mostre reservas do usuário
-5. CANCELAR RESERVAS: Ajude a cancelar reservas existentes
-6. AJUDA: Explique como usar o sistema
+FERRAMENTAS:
+- check_availability: verificar se uma quadra está livre e ver os horários livres do dia
+- start_reservation: iniciar a reserva assim que quadra, data e hora estiverem claras (o sistema pede a confirmação)
+- list_reservations / cancel_reservation: consultar e cancelar reservas do usuário
 
 INSTRUÇÕES IMPORTANTES:
 - Use o histórico para entender o contexto da conversa
 - NÃO cumprimente a cada mensagem - seja direto e objetivo
-- Para reservas, sempre confirme: estabelecimento, quadra, data, hora e quantidade de horas
-- Calcule o preço total (valor_hora × quantidade_horas)
-- Horários disponíveis: 06h às 23h (uma hora por vez)
-- Seja natural e mantenha continuidade na conversa
+- Chame start_reservation diretamente quando tiver quadra, data e hora; não peça confirmação antes
+- Se faltar quadra, data ou hora, pergunte apenas o que falta
+- Sugira apenas horários que aparecem em HORÁRIOS LIVRES; para outras datas use check_availability. Nunca invente disponibilidade
 - Respostas devem ser curtas e diretas (máximo 200 caracteres)
-- Se precisar de mais informações, peça de forma amigável
-- Para reservas complexas, quebre em etapas simples
 - Evite repetir informações já dadas na conversa"""
 
-        chat = groq_client.chat.completions.create(
-            model=settings.GROQ_MODEL,
-            messages=[
-                {"role": "system", "content": "Você é um assistente especializado em reservas de quadras esportivas. Seja direto e objetivo. Não repita saudações desnecessariamente."},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0.5,  # Reduzido para ser mais consistente
-            max_tokens=200,
-        )
-        
-        response = chat.choices[0].message.content.strip()
-        
-        # Verifica se a IA sugeriu uma ação específica que precisa ser executada
-        if "RESERVAR:" in response:
-            # Extrai dados da reserva sugerida pela IA
-            try:
-                # Parse da resposta da IA para extrair dados da reserva
-                lines = response.split('\n')
-                for line in lines:
-                    if "RESERVAR:" in line:
-                        # Formato: RESERVAR: quadra_id, data, hora, horas_qty
-                        parts = line.split("RESERVAR:")[1].strip().split(",")
-                        if len(parts) >= 4:
-                            court_id = parts[0].strip()
-                            date_str = parts[1].strip()
-                            hour = int(parts[2].strip())
-                            hours_qty = int(parts[3].strip())
-                            
-                            # Executa a reserva
-                            court_doc = mongodb.get_collection("quadras").find_one({"_id": ObjectId(court_id)})
-                            if court_doc:
-                                court = Court.from_dict(court_doc)
-                                date_obj = datetime.fromisoformat(date_str)
-                                start_dt = date_obj.replace(hour=hour, minute=0, second=0, microsecond=0)
-                                
-                                if check_availability(court, start_dt, hours_qty):
-                                    total = court.valor_hora * hours_qty
-                                    state_repo.set_state(phone, {
-                                        "awaiting": "confirmation",
-                                        "court_id": court_id,
-                                        "court_nome": court.nome,
-                                        "start_iso": start_dt.isoformat(),
-                                        "hours_qty": hours_qty,
-                                        "preco_hora": court.valor_hora,
-                                        "total": total
-                                    })
-                                    response = f"{court.nome} disponível em {start_dt.strftime('%d/%m %H:%M')} por {hours_qty}h. Preço R${court.valor_hora:.2f}/h, total R${total:.2f}. Confirmar?"
-                                else:
-                                    response = "Infelizmente esse horário não está mais disponível. Tente outro horário."
-            except Exception as e:
-                logger.error(f"Erro ao processar ação da IA: {e}")
+        messages = [
+            {"role": "system", "content": "Você é um assistente especializado em reservas de quadras esportivas. Seja direto e objetivo. Não repita saudações desnecessariamente."},
+            {"role": "user", "content": prompt},
+        ]
+        response = ""
+        for round_number in range(1, settings.LLM_MAX_TOOL_ROUNDS + 1):
+            # Na última rodada o modelo precisa responder em texto
+            last_round = round_number == settings.LLM_MAX_TOOL_ROUNDS
+            chat = llm_gateway.chat(
+                model=route["model"],
+                messages=messages,
+                tools=LLM_TOOLS,
+                tool_choice="none" if last_round else "auto",
+                temperature=route["temperature"],
+                max_tokens=route["max_tokens"],
+            )
+            message = chat.choices[0].message
+            if not message.tool_calls:
+                response = (message.content or "").strip()
+                break
+            
+            messages.append({
+                "role": "assistant",
+                "content": message.content or "",
+                "tool_calls": [
+                    {"id": call.id, "type": "function",
+                     "function": {"name": call.function.name, "arguments": call.function.arguments}}
+                    for call in message.tool_calls
+                ]
+            })
+            final_answers = []
+            for call in message.tool_calls:
+                try:
+                    args = json.loads(call.function.arguments or "{}")
+                except ValueError:
+                    args = {}
+                result = execute_tool(phone, call.function.name, args)
+                metrics.inc("llm_tool_calls_total", tool=call.function.name, ok=str("erro" not in result).lower())
+                logger.info(f"[LLM-FERRAMENTA] Usuário {phone}: {call.function.name}({args}) -> {str(result)[:100]}")
+                if user_message is not None and "erro" not in result and call.function.name in TOOL_INTENTS:
+                    user_message.intent = TOOL_INTENTS[call.function.name]
+                    user_message.intent_origem = "llm"
+                if "resposta_final" in result:
+                    final_answers.append(result["resposta_final"])
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": call.id,
+                    "content": json.dumps(result, ensure_ascii=False)
+                })
+            if final_answers:
+                # Resultado determinístico: responde sem outra ida ao LLM
+                response = "\n".join(final_answers)
+                break
+        metrics.observe("llm_rounds_per_turn", round_number)
         
+        if not response:
+            response = "Não entendi. Envie 'ajuda' para ver exemplos."
         logger.info(f"[LLM-SUCESSO] Usuário {phone}: '{text}' -> Resposta gerada: '{response[:100]}...'")
         return response
         
+    except LLMUnavailableError as e:
+        logger.warning(f"[LLM-INDISPONIVEL] Usuário {phone}: '{text}' -> {e}; fallback para NLU")
+        return nlu_fallback_response(phone, text)
     except Exception as e:
         logger.error(f"[LLM-ERRO] Usuário {phone}: '{text}' -> Erro: {e}")
         return "Não entendi. Envie 'ajuda' para ver exemplos."
 
-# ===== ROTAS =====
-@app.route("/")
-def root():
-    """Endpoint raiz para verificar se a API está funcionando"""
-    return jsonify({
-        "message": "Genia Quadras - Agente WhatsApp",
-        "status": "online",
-        "version": "1.0.0",
-        "database": "connected" if mongodb.db is not None else "disconnected"
-    })
+# ===== RESUMO DA CONVERSA =====
+class ConversationSummarizer:
+    """
+    Condensa as mensagens antigas da sessão em um resumo curto, fora do caminho da resposta.
+
+    Quando a sessão passa de SUMMARY_TRIGGER_MESSAGES mensagens não resumidas, um trabalho vai
+    para um pool próprio (SUMMARY_WORKERS threads), para que uma chamada lenta ao Groq não
+    atrase lembretes e retenções do TimerService; ele resume tudo exceto as últimas SUMMARY_KEEP_RAW_MESSAGES
+    (com o LLM se disponível e sem sobrecarga, senão de forma extrativa) e grava em
+    `resumo`/`resumo_ate` no documento do histórico.
+    """
+
+    def __init__(self, keep_raw: int, max_chars: int, workers: int):
+        self.keep_raw = keep_raw
+        self.max_chars = max_chars
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="summarizer")
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def request(self, phone: str):
+        with self._lock:
+            if phone in self._pending:
+                return
+            self._pending.add(phone)
+        self._executor.submit(self._run, phone)
+
+    def _run(self, phone: str):
+        try:
+            self.summarize(phone)
+        except Exception as e:
+            logger.error(f"Erro ao resumir conversa de {phone}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(phone)
+
+    def summarize(self, phone: str) -> Optional[str]:
+        history_repo.buffer.flush()
+        user_doc = history_repo.get_collection().find_one({"phone": phone})
+        if not user_doc:
+            return None
+        previous = user_doc.get("resumo") or ""
+        summarized_until = user_doc.get("resumo_ate") or ""
+        pending = [ConversationMessage.from_dict(d) for d in user_doc.get("messages", [])
+                   if d.get("timestamp", "") > summarized_until]
+        to_summarize = pending[:-self.keep_raw] if self.keep_raw else pending
+        if not to_summarize:
+            return None
+
+        started = time.perf_counter()
+        summary = None
+        if llm_gateway.available and admission.mode() == AdmissionController.NORMAL:
+            summary = self._summarize_with_llm(previous, to_summarize)
+        source = "llm" if summary else "extrativo"
+        summary = (summary or self._summarize_extractive(previous, to_summarize))[:self.max_chars]
+
+        saved = history_repo.save_summary(phone, user_doc.get("session_start"), summary,
+                                          to_summarize[-1].timestamp.isoformat())
+        metrics.inc("conversation_summaries_total", source=source, saved=str(saved).lower())
+        logger.info(f"[RESUMO] Usuário {phone}: {len(to_summarize)} mensagens resumidas ({source}) "
+                    f"em {time.perf_counter() - started:.2f}s")
+        return summary
+
+    def _summarize_with_llm(self, previous: str, messages: List[ConversationMessage]) -> Optional[str]:
+        prompt = (
+            "Atualize o resumo de uma conversa de reserva de quadras de Beach Tennis. "
+            "Mantenha apenas fatos úteis para continuar o atendimento: quadra, estabelecimento, datas, "
+            f"horários, quantidade de horas, preferências e pendências. No máximo {self.max_chars} caracteres.\n\n"
+            f"Resumo atual: {previous or '(vazio)'}\n\nNovas mensagens:\n"
+            + ConversationHistoryRepository._format_lines(messages)
+        )
+        try:
+            chat = llm_gateway.chat(
+                model=model_router.routes[ModelRouter.FAST]["model"],
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.2,
+                max_tokens=200,
+            )
+            return (chat.choices[0].message.content or "").strip() or None
+        except LLMUnavailableError as e:
+            logger.warning(f"[RESUMO] LLM indisponível, usando resumo extrativo: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"[RESUMO] Falha no resumo com LLM, usando resumo extrativo: {e}")
+            return None
+
+    def _summarize_extractive(self, previous: str, messages: List[ConversationMessage]) -> str:
+        # Sem LLM: mantém os pedidos do usuário (mais recentes têm prioridade se estourar o limite)
+        requests = "; ".join(m.content.strip()[:80] for m in messages if m.role == "user")
+        summary = f"{previous} Usuário pediu: {requests}." if previous else f"Usuário pediu: {requests}."
+        return summary[-self.max_chars:]
+
+conversation_summarizer = ConversationSummarizer(settings.SUMMARY_KEEP_RAW_MESSAGES, settings.SUMMARY_MAX_CHARS,
+                                                 settings.SUMMARY_WORKERS)
+
+# ===== FAQ LOCAL =====
+FAQ_STOPWORDS = {
+    "a", "o", "as", "os", "da", "de", "do", "das", "dos", "e", "em", "na", "no", "nas", "nos", "um", "uma",
+    "qual", "quais", "que", "pra", "para", "por", "com", "me", "voce", "voces", "vcs", "tem", "ter", "eh",
+    "ai", "la", "ola", "oi", "bom", "dia", "boa", "tarde", "noite", "gostaria", "saber", "queria", "favor"
+}
+
+FAQ_STATIC_ENTRIES = [
+    ("como faço para reservar uma quadra agendar marcar horário",
+     "Para reservar, envie quadra, dia e hora. Ex.: 'reservar quadra 1 amanhã às 19h por 2 horas'."),
+    ("como cancelar desmarcar uma reserva",
+     "Para cancelar, envie 'minhas reservas' e depois 'cancelar' com o código da reserva."),
+    ("reserva recorrente toda semana fixo mensal horário fixo",
+     "Dá para reservar um horário fixo: 'reservar toda terça 19h pelas próximas 8 semanas'."),
+    ("lista de espera horário ocupado lotado avisar quando liberar",
+     "Se o horário estiver ocupado, ofereço a lista de espera e aviso aqui assim que liberar."),
+]
+
+def faq_tokens(text: str) -> List[str]:
+    """Palavras normalizadas (sem acento, sem stopwords, singular aproximado)"""
+    tokens = []
+    for word in re.findall(r"[a-z0-9]+", normalize_text(text)):
+        if word in FAQ_STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+class FaqIndex:
+    """
+    Índice BM25 em Python puro sobre perguntas frequentes (geradas do catálogo + fixas).
+
+    A confiança de um resultado é o score BM25 dividido pela soma dos IDFs das palavras da
+    pergunta (palavras fora do índice contam com o IDF máximo e a reduzem). Se a segunda
+    melhor entrada ficar a menos de 10% da primeira, a pergunta é ambígua e a confiança cai
+    pela metade.
+    """
+    K1 = 1.5
+    B = 0.75
+    AMBIGUITY_RATIO = 0.9
+
+    def __init__(self, entries: List[Tuple[str, str]]):
+        self.answers = [answer for _, answer in entries]
+        self.docs = [Counter(faq_tokens(question)) for question, _ in entries]
+        self.doc_lengths = [sum(doc.values()) for doc in self.docs]
+        self.avg_length = (sum(self.doc_lengths) / len(self.docs)) if self.docs else 1.0
+        df = Counter(token for doc in self.docs for token in doc)
+        total = len(self.docs)
+        self.idf = {token: math.log(1 + (total - n + 0.5) / (n + 0.5)) for token, n in df.items()}
+        self.max_idf = math.log(1 + (total + 0.5) / 0.5) if total else 1.0
+        self.postings = {}
+        for index, doc in enumerate(self.docs):
+            for token, count in doc.items():
+                self.postings.setdefault(token, []).append((index, count))
+
+    def search(self, text: str) -> Tuple[Optional[str], float]:
+        """Retorna (resposta, confiança entre 0 e 1) da melhor entrada"""
+        query = set(faq_tokens(text))
+        if not query or not self.docs:
+            return None, 0.0
+        scores = {}
+        for token in query:
+            idf = self.idf.get(token)
+            if idf is None:
+                continue
+            for index, count in self.postings[token]:
+                norm = self.K1 * (1 - self.B + self.B * self.doc_lengths[index] / self.avg_length)
+                scores[index] = scores.get(index, 0.0) + idf * count * (self.K1 + 1) / (count + norm)
+        if not scores:
+            return None, 0.0
+        ranked = sorted(scores, key=scores.__getitem__, reverse=True)
+        best = ranked[0]
+        ceiling = sum(self.idf.get(token, self.max_idf) for token in query)
+        confidence = min(1.0, scores[best] / ceiling)
+        if len(ranked) > 1 and scores[ranked[1]] >= self.AMBIGUITY_RATIO * scores[best]:
+            confidence /= 2
+        return self.answers[best], confidence
+
+    @classmethod
+    def from_catalog(cls, establishments: List[Establishment], courts: List[Court]) -> "FaqIndex":
+        entries = list(FAQ_STATIC_ENTRIES)
+        courts_by_establishment = {}
+        for court in courts:
+            courts_by_establishment.setdefault(court.establishment_id, []).append(court)
+
+        def hours(court: Court) -> str:
+            return f"das {min(court.horarios_funcionamento):02d}h às {max(court.horarios_funcionamento) + 1:02d}h"
+
+        for e in establishments:
+            endereco = ", ".join(v for v in (e.endereco.get("logradouro"), e.endereco.get("bairro"), e.endereco.get("cidade")) if v)
+            e_courts = courts_by_establishment.get(e._id, [])
+            entries.append((f"endereço onde fica localização como chegar {e.nome} {e.endereco.get('cidade', '')}",
+                            f"{e.nome} fica em {endereco or 'endereço não informado'}."))
+            if e.telefone:
+                entries.append((f"telefone contato whatsapp {e.nome}", f"O contato de {e.nome} é {e.telefone}."))
+            if e_courts:
+                entries.append((f"quadras disponíveis quantas quadras {e.nome}",
+                                f"{e.nome} tem: " + "; ".join(f"{c.nome} (R${c.valor_hora:.2f}/h)" for c in e_courts) + "."))
+                entries.append((f"horário funcionamento abre fecha {e.nome}",
+                                f"{e.nome}: " + "; ".join(f"{c.nome} {hours(c)}" for c in e_courts) + "."))
+            for c in e_courts:
+                entries.append((f"preço valor quanto custa hora {c.nome} {e.nome}",
+                                f"{c.nome} ({e.nome}) custa R${c.valor_hora:.2f} por hora."))
+                entries.append((f"horário funcionamento abre fecha {c.nome} {e.nome}",
+                                f"{c.nome} ({e.nome}) funciona {hours(c)}."))
+        if establishments:
+            entries.append(("estabelecimentos arenas unidades onde vocês atendem lugares",
+                            "Atendemos em: " + "; ".join(f"{e.nome} ({e.endereco.get('cidade', '')})" for e in establishments) + "."))
+        if courts:
+            entries.append(("preço valor quanto custa hora quadra",
+                            "Valores por hora: " + "; ".join(f"{c.nome} R${c.valor_hora:.2f}" for c in courts[:10]) + "."))
+        return cls(entries)
+
+def build_faq_index() -> FaqIndex:
+    started = time.perf_counter()
+    index = FaqIndex.from_catalog(catalog_cache.get_establishments(), catalog_cache.get_courts())
+    logger.info(f"[FAQ] Índice reconstruído com {len(index.docs)} entradas em {time.perf_counter() - started:.3f}s")
+    return index
+
+def faq_lookup(phone: str, text: str) -> Optional[str]:
+    """Resposta do FAQ local se a confiança passar de FAQ_MIN_SCORE (índice refeito a cada versão do catálogo)"""
+    try:
+        answer, score = catalog_cache.get_cached(("faq_index",), build_faq_index).search(text)
+    except Exception as e:
+        logger.error(f"Erro ao consultar FAQ local: {e}")
+        return None
+    hit = answer is not None and score >= settings.FAQ_MIN_SCORE
+    metrics.inc("faq_lookups_total", outcome="hit" if hit else "miss")
+    metrics.observe("faq_score", score)
+    hits = metrics.get("faq_lookups_total", outcome="hit")
+    total = hits + metrics.get("faq_lookups_total", outcome="miss")
+    logger.info(f"[FAQ] Usuário {phone}: '{text}' score={score:.2f} {'respondido localmente' if hit else 'enviado ao LLM'} "
+                f"(taxa sem LLM {hits / total:.0%})")
+    return answer if hit else None
+
+# ===== ENVIO ATIVO E LEMBRETES =====
+class TokenBucket:
+    """Token bucket thread-safe para limitar a taxa de operações"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Consome tokens se houver saldo; não bloqueia"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1.0):
+        """Bloqueia até haver tokens suficientes"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+class TwilioOutboundSender:
+    """Envia mensagens ativas pela API REST do Twilio"""
+
+    def __init__(self):
+        self._client = None
+
+    def send(self, to: str, body: str) -> Optional[str]:
+        if self._client is None:
+            from twilio.rest import Client
+            self._client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+        if not to.startswith("whatsapp:"):
+            to = f"whatsapp:{to}"
+        message = self._client.messages.create(from_=settings.TWILIO_WHATSAPP_FROM, to=to, body=body)
+        return message.sid
+
+class LocalOutboundSender:
+    """Sender local que apenas registra as mensagens (desenvolvimento e testes)"""
+
+    def __init__(self):
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, to: str, body: str) -> Optional[str]:
+        with self._lock:
+            self.sent.append({"to": to, "body": body, "enviado_em": datetime.now().isoformat()})
+            sid = f"local-{len(self.sent)}"
+        logger.info(f"[ENVIO-LOCAL] Para {to}: '{body[:50]}...'")
+        return sid
+
+class OutboundQueue:
+    """Fila de envio ativo: despacha em lotes respeitando um token bucket"""
+
+    def __init__(self, sender, rate_per_second: float, burst: int, batch_size: int):
+        self.sender = sender
+        self.bucket = TokenBucket(rate_per_second, burst)
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="outbound-queue", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, to: str, body: str):
+        self.start()
+        self._queue.put((to, body))
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Aguarda o esvaziamento da fila (usado em testes e no desligamento)"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return not self._queue.unfinished_tasks
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            sent = 0
+            for to, body in batch:
+                self.bucket.acquire()
+                try:
+                    self.sender.send(to, body)
+                    sent += 1
+                except Exception as e:
+                    logger.error(f"[ENVIO-ERRO] Falha ao enviar mensagem para {to}: {e}")
+                finally:
+                    self._queue.task_done()
+            logger.info(f"[ENVIO-LOTE] {sent}/{len(batch)} mensagens enviadas")
+
+class TimerService:
+    """Agenda callbacks em um heap de prazos, disparados por uma única thread"""
+
+    def __init__(self):
+        self._heap = []
+        self._cancelled = set()
+        self._counter = itertools.count(1)
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="timer-service", daemon=True)
+                self._thread.start()
+
+    def schedule(self, when: datetime, callback, *args) -> int:
+        """Agenda callback(*args) para o instante `when`; retorna o id do timer"""
+        with self._cond:
+            timer_id = next(self._counter)
+            heapq.heappush(self._heap, (when.timestamp(), timer_id, callback, args))
+            self._cond.notify()
+            return timer_id
+
+    def cancel(self, timer_id: int):
+        with self._cond:
+            self._cancelled.add(timer_id)
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._heap) - len(self._cancelled)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - time.time()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+                    _, timer_id, callback, args = heapq.heappop(self._heap)
+                    if timer_id in self._cancelled:
+                        self._cancelled.discard(timer_id)
+                        continue
+                    break
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.error(f"[TIMER-ERRO] Falha ao executar timer {timer_id}: {e}")
+
+class ReservationReminderScheduler:
+    """
+    Agenda lembretes de reservas confirmadas.
+
+    As reservas são carregadas incrementalmente em janelas (até REMINDER_HOURS_BEFORE +
+    REMINDER_LOOKAHEAD_HOURS à frente) para o heap do TimerService. Após um reinício a carga
+    recomeça do instante atual: reservas futuras ainda sem `lembrete_enviado` voltam ao heap e o
+    claim atômico em `_fire` evita lembretes duplicados.
+    """
+    def __init__(self, timer: TimerService, outbox: OutboundQueue, hours_before: int,
+                 lookahead_hours: int, load_interval_seconds: int):
+        self.timer = timer
+        self.outbox = outbox
+        self.hours_before = hours_before
+        self.lookahead_hours = lookahead_hours
+        self.load_interval_seconds = load_interval_seconds
+        self.loaded_until: Optional[str] = None
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Agenda a primeira carga a partir de agora (o flag lembrete_enviado deduplica)"""
+        self.loaded_until = datetime.now().replace(microsecond=0).isoformat()
+        reservation_events.subscribe("created", self._on_created)
+        reservation_events.subscribe("cancelled", self._on_cancelled)
+        self.timer.start()
+        self.load_next_window()
+        logger.info(f"[LEMBRETES] Agendador iniciado a partir de {self.loaded_until}")
+
+    def load_next_window(self):
+        """Carrega a próxima janela de reservas e reagenda a si mesmo"""
+        try:
+            horizon = datetime.now() + timedelta(hours=self.hours_before + self.lookahead_hours)
+            horizon_iso = horizon.replace(microsecond=0).isoformat()
+            if horizon_iso > self.loaded_until:
+                docs = reservation_repo.get_pending_reminders(
+                    self.loaded_until, horizon_iso, establishment_ids=settings.OWNED_ESTABLISHMENTS or None
+                )
+                for doc in docs:
+                    self._schedule(str(doc["_id"]), doc["data_reserva"])
+                self.loaded_until = horizon_iso
+                if docs:
+                    logger.info(f"[LEMBRETES] {len(docs)} lembretes carregados até {horizon_iso}")
+        except Exception as e:
+            logger.error(f"[LEMBRETES] Erro ao carregar reservas: {e}")
+        finally:
+            self.timer.schedule(datetime.now() + timedelta(seconds=self.load_interval_seconds), self.load_next_window)
+
+    def _schedule(self, reservation_id: str, data_reserva_iso: str):
+        fire_at = datetime.fromisoformat(data_reserva_iso) - timedelta(hours=self.hours_before)
+        with self._lock:
+            if reservation_id in self._timers:
+                return
+            self._timers[reservation_id] = self.timer.schedule(fire_at, self._fire, reservation_id)
+
+    def _on_created(self, reservation: dict):
+        # Reservas além da janela carregada entram na próxima carga incremental
+        if reservation.get("status") != "confirmada" or self.loaded_until is None:
+            return
+        if not partition_router.owns(reservation.get("establishment_id")):
+            return
+        data_reserva = reservation.get("data_reserva", "")
+        if data_reserva <= self.loaded_until and data_reserva > datetime.now().isoformat():
+            self._schedule(str(reservation["_id"]), data_reserva)
+
+    def _on_cancelled(self, reservation: dict):
+        with self._lock:
+            timer_id = self._timers.pop(str(reservation.get("_id")), None)
+        if timer_id:
+            self.timer.cancel(timer_id)
+
+    def _fire(self, reservation_id: str):
+        with self._lock:
+            self._timers.pop(reservation_id, None)
+        doc = reservation_repo.claim_reminder(reservation_id)
+        if not doc:
+            return
+        start_dt = datetime.fromisoformat(doc["data_reserva"])
+        court = court_repo.get_by_id(doc.get("court_id")) if doc.get("court_id") else None
+        court_nome = court.nome if court else "sua quadra"
+        horas = doc.get("quantidade_horas", 1)
+        body = (f"Lembrete: sua reserva em {court_nome} é {start_dt.strftime('%d/%m')} às "
+                f"{start_dt.strftime('%H:%M')} por {horas}h. Bom jogo! 🎾")
+        self.outbox.enqueue(doc.get("usuario", {}).get("telefone", ""), body)
+        logger.info(f"[LEMBRETES] Lembrete da reserva {reservation_id} enfileirado")
+
+class PartitionRouter:
+    """
+    Mapeia mensagens recebidas para a partição (estabelecimento) que as atende.
+
+    Ordem de resolução: estabelecimento explícito na rota, número de destino (To)
+    configurado em PARTITION_ROUTES, nome do estabelecimento mencionado no texto e, por fim,
+    a última escolha do usuário. Citar outro estabelecimento troca a partição da conversa.
+    """
+
+    def __init__(self, routes: str, owned: List[str]):
+        self.routes = {}
+        for item in routes.split(","):
+            if "=" in item:
+                number, establishment_id = item.split("=", 1)
+                self.routes[number.strip()] = establishment_id.strip()
+        self.owned = set(owned)
+        self._choices = PartitionedCache(settings.PARTITION_CACHE_SIZE)
+
+    def enabled(self) -> bool:
+        return settings.PARTITION_MODE == "establishment"
+
+    def owns(self, establishment_id: Optional[str]) -> bool:
+        """Indica se este worker atende a partição (sem lista configurada, atende todas)"""
+        return not self.owned or not establishment_id or establishment_id in self.owned
+
+    def resolve(self, phone: str, text: str, inbound_number: str = "",
+                establishment_id: Optional[str] = None) -> Optional[str]:
+        if not self.enabled():
+            return None
+        resolved = establishment_id or self.routes.get(inbound_number)
+        if not resolved:
+            resolved = extract_establishment_from_text(text) or self._choices.get(None, phone)
+        if resolved:
+            self._choices.set(None, phone, resolved)
+            if not self.owns(resolved):
+                logger.warning(f"[PARTICAO-FORA] Estabelecimento {resolved} não pertence a este worker")
+        return resolved
+
+    def stats(self) -> dict:
+        return {
+            "mode": settings.PARTITION_MODE,
+            "owned": sorted(self.owned),
+            "routes": self.routes,
+            "catalog": catalog_cache.stats()
+        }
+
+partition_router = PartitionRouter(settings.PARTITION_ROUTES, settings.OWNED_ESTABLISHMENTS)
+
+outbound_sender = TwilioOutboundSender() if settings.OUTBOUND_SENDER == "twilio" else LocalOutboundSender()
+outbound_queue = OutboundQueue(
+    outbound_sender,
+    rate_per_second=settings.OUTBOUND_RATE_PER_SECOND,
+    burst=settings.OUTBOUND_BURST,
+    batch_size=settings.OUTBOUND_BATCH_SIZE
+)
+timer_service = TimerService()
+reminder_scheduler = ReservationReminderScheduler(
+    timer_service,
+    outbound_queue,
+    hours_before=settings.REMINDER_HOURS_BEFORE,
+    lookahead_hours=settings.REMINDER_LOOKAHEAD_HOURS,
+    load_interval_seconds=settings.REMINDER_LOAD_INTERVAL_SECONDS
+)
+
+# ===== LISTA DE ESPERA =====
+class WaitlistService:
+    """
+    Lista de espera por (quadra, dia, hora) na coleção `lista_espera`.
+
+    Não há varredura periódica: cancelamentos (e retenções expiradas) publicam um evento,
+    e o próximo da fila (FIFO por criado_em) recebe uma retenção curta e um aviso ativo.
+    A expiração da retenção é agendada no TimerService; como o heap é só em memória,
+    start() reagenda (ou expira na hora) as retenções que ficaram "retida" no banco.
+    """
+
+    def __init__(self, timer: TimerService, outbox: OutboundQueue, hold_minutes: int):
+        self.timer = timer
+        self.outbox = outbox
+        self.hold_minutes = hold_minutes
+
+    def get_collection(self):
+        return mongodb.get_collection("lista_espera", MongoDBConnection.RESERVATIONS)
+
+    def start(self):
+        reservation_events.subscribe("cancelled", self._on_slot_freed)
+        self.timer.start()
+        self.resume_holds()
+
+    def resume_holds(self):
+        """Reagenda a expiração das retenções abertas; as já vencidas expiram imediatamente"""
+        try:
+            holds = reservation_repo.get_open_holds(settings.OWNED_ESTABLISHMENTS or None)
+        except Exception as e:
+            logger.error(f"[LISTA-ESPERA] Erro ao retomar retenções: {e}")
+            return
+        now = datetime.now()
+        for hold in holds:
+            expires_at = hold.get("hold_expira_em")
+            fire_at = max(now, datetime.fromisoformat(expires_at)) if expires_at else now
+            self.timer.schedule(fire_at, self._expire_hold, str(hold["_id"]))
+        if holds:
+            logger.info(f"[LISTA-ESPERA] {len(holds)} retenções reagendadas após reinício")
+
+    def join(self, phone: str, state: dict) -> str:
+        """Inscreve o usuário na lista de espera do horário pedido"""
+        state_repo.clear_state(phone)
+        start_dt = datetime.fromisoformat(state["start_iso"])
+        court = court_repo.get_by_id(state["court_id"])
+        if not court:
+            return "Quadra não encontrada."
+        key = {"court_id": court._id, "data": start_dt.date().isoformat(), "hora": start_dt.hour}
+        collection = self.get_collection()
+        collection.update_one(
+            {**key, "phone": phone, "status": "aguardando"},
+            {"$setOnInsert": {
+                "establishment_id": court.establishment_id,
+                "quantidade_horas": int(state.get("hours_qty", 1)),
+                "criado_em": datetime.now().isoformat()
+            }},
+            upsert=True
+        )
+        posicao = collection.count_documents({**key, "status": "aguardando"})
+        metrics.inc("waitlist_joined_total")
+        return (f"Pronto! Você é o {posicao}º na lista de espera de {court.nome} em "
+                f"{start_dt.strftime('%d/%m %H:%M')}. Aviso aqui assim que liberar.")
+
+    def _on_slot_freed(self, reservation: dict):
+        if reservation.get("status_anterior") not in ("confirmada", "retida"):
+            return
+        # Fora do caminho da requisição: a oferta roda na thread do TimerService
+        self.timer.schedule(datetime.now(), self.offer_freed_slot, reservation)
+
+    def offer_freed_slot(self, reservation: dict):
+        """Oferece as horas liberadas aos próximos da fila, em ordem de chegada"""
+        start_dt = datetime.fromisoformat(reservation["data_reserva"])
+        if start_dt < datetime.now():
+            return
+        court = court_repo.get_by_id(reservation["court_id"])
+        if not court:
+            return
+        horas = list(range(start_dt.hour, start_dt.hour + reservation.get("quantidade_horas", 1)))
+        candidates = self.get_collection().find(
+            {"court_id": court._id, "data": start_dt.date().isoformat(), "hora": {"$in": horas}, "status": "aguardando"}
+        ).sort("criado_em", 1)
+        for entry in candidates:
+            slot_dt = start_dt.replace(hour=entry["hora"])
+            hours_qty = entry.get("quantidade_horas", 1)
+            if not validate_court_availability(court._id, slot_dt, hours_qty)["disponivel"]:
+                continue
+            claimed = self.get_collection().find_one_and_update(
+                {"_id": entry["_id"], "status": "aguardando"},
+                {"$set": {"status": "notificado", "notificado_em": datetime.now().isoformat()}}
+            )
+            if claimed:
+                self._place_hold(court, entry, slot_dt, hours_qty)
+
+    def _place_hold(self, court: Court, entry: dict, slot_dt: datetime, hours_qty: int):
+        phone = entry["phone"]
+        expires_at = datetime.now() + timedelta(minutes=self.hold_minutes)
+        hold = Reservation(
+            usuario=user_repo.find_or_create_by_phone(phone),
+            establishment_id=court.establishment_id,
+            court_id=court._id,
+            data_reserva=slot_dt,
+            quantidade_horas=hours_qty,
+            valor_hora=court.valor_hora
+        )
+        hold_id = reservation_repo.create_hold(hold, expires_at)
+        with partition_scope(court.establishment_id):
+            state_repo.set_state(phone, {
+                "awaiting": "confirmation",
+                "hold_id": hold_id,
+                "court_id": court._id,
+                "court_nome": court.nome,
+                "start_iso": slot_dt.isoformat(),
+                "hours_qty": hours_qty,
+                "preco_hora": court.valor_hora,
+                "total": court.valor_hora * hours_qty
+            })
+        self.timer.schedule(expires_at, self._expire_hold, hold_id)
+        self.outbox.enqueue(phone, (
+            f"Boa notícia! {court.nome} liberou em {slot_dt.strftime('%d/%m %H:%M')}. "
+            f"Segurei o horário por {self.hold_minutes} min: responda 'sim' para confirmar."
+        ))
+        metrics.inc("waitlist_offers_total")
+        logger.info(f"[LISTA-ESPERA] Horário {slot_dt.isoformat()} da quadra {court._id} retido para {phone}")
+
+    def _expire_hold(self, hold_id: str):
+        doc = reservation_repo.expire_hold(hold_id)
+        if doc:
+            metrics.inc("waitlist_holds_expired_total")
+            logger.info(f"[LISTA-ESPERA] Retenção {hold_id} expirou; oferecendo ao próximo da fila")
+
+waitlist_service = WaitlistService(timer_service, outbound_queue, settings.WAITLIST_HOLD_MINUTES)
+
+# ===== CONTROLE DE ADMISSÃO =====
+class AdmissionController:
+    """
+    Decide como cada turno do webhook é atendido a partir da carga atual:
+    - normal: fluxo completo (NLU + LLM);
+    - degraded: só NLU local, quando há muitos turnos em andamento, fila no gateway do LLM
+      ou latência recente do LLM acima do limite;
+    - shedding: acima do limite rígido de turnos simultâneos, responde com mensagem padrão.
+
+    Turnos em andamento incluem os que esperam ou executam na faixa do LLM (lanes): o webhook
+    libera a vaga ao enfileirar, mas o turno continua ocupando o Groq até terminar.
+    """
+    NORMAL = "normal"
+    DEGRADED = "degraded"
+    SHEDDING = "shedding"
+    SHED_REPLY = ("Estamos recebendo muitas mensagens agora. "
+                  "Por favor, tente novamente em alguns minutos.")
+
+    def __init__(self, gateway: LLMGateway, degrade_in_flight: int, shed_in_flight: int,
+                 degrade_queue: int, degrade_latency_seconds: float, latency_window_seconds: float):
+        self.gateway = gateway
+        self.degrade_in_flight = degrade_in_flight
+        self.shed_in_flight = shed_in_flight
+        self.degrade_queue = degrade_queue
+        self.degrade_latency_seconds = degrade_latency_seconds
+        self.latency_window_seconds = latency_window_seconds
+        self.in_flight = 0
+        self.lanes = None  # TurnLanes, ligado depois de criado
+        self._lock = threading.Lock()
+
+    def load(self) -> int:
+        """Turnos no webhook mais os turnos na fila/em execução na faixa do LLM"""
+        return self.in_flight + (self.lanes.backlog() if self.lanes else 0)
+
+    def _recent_latency(self) -> float:
+        # Sem chamadas recentes (ex.: durante o modo degradado) a latência antiga deixa de valer
+        if time.monotonic() - self.gateway.latency_updated_at > self.latency_window_seconds:
+            return 0.0
+        return self.gateway.latency_ewma
+
+    def mode(self) -> str:
+        load = self.load()
+        if load >= self.shed_in_flight:
+            return self.SHEDDING
+        if (load >= self.degrade_in_flight
+                or self.gateway.waiting >= self.degrade_queue
+                or self._recent_latency() >= self.degrade_latency_seconds):
+            return self.DEGRADED
+        return self.NORMAL
+
+    @contextmanager
+    def admit(self):
+        """Reserva uma vaga para o turno e entrega o modo em que ele deve ser atendido"""
+        with self._lock:
+            mode = self.mode()
+            self.in_flight += 1
+            metrics.set_gauge("admission_in_flight", self.in_flight)
+        metrics.inc("admission_turns_total", mode=mode)
+        try:
+            yield mode
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                metrics.set_gauge("admission_in_flight", self.in_flight)
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode(),
+            "in_flight": self.in_flight,
+            "lane_backlog": self.lanes.backlog() if self.lanes else 0,
+            "llm_queue": self.gateway.waiting,
+            "llm_latency_seconds": round(self._recent_latency(), 3)
+        }
+
+admission = AdmissionController(
+    llm_gateway,
+    degrade_in_flight=settings.ADMISSION_DEGRADE_IN_FLIGHT,
+    shed_in_flight=settings.ADMISSION_SHED_IN_FLIGHT,
+    degrade_queue=settings.ADMISSION_DEGRADE_QUEUE,
+    degrade_latency_seconds=settings.ADMISSION_DEGRADE_LATENCY_SECONDS,
+    latency_window_seconds=settings.ADMISSION_LATENCY_WINDOW_SECONDS
+)
+
+class PhoneRateLimiter:
+    """
+    Limite de taxa por telefone com dois orçamentos: mensagens (todo turno) e turnos com LLM.
+
+    O caminho rápido é um token bucket em memória por (orçamento, telefone). Com
+    RATE_LIMIT_SHARED, quem passa localmente também incrementa um contador por janela de
+    1 minuto na coleção `limites_telefone` (com TTL), compartilhado entre os workers.
+    """
+    MESSAGES = "mensagens"
+    LLM = "llm"
+    THROTTLED_REPLY = "Você enviou muitas mensagens seguidas. Aguarde um instante e tente novamente."
+
+    def __init__(self, budgets: Dict[str, Tuple[int, int]], shared: bool, max_tracked_phones: int = 10000):
+        self.budgets = budgets  # orçamento -> (por minuto, rajada)
+        self.shared = shared
+        self.max_tracked_phones = max_tracked_phones
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_collection(self):
+        return mongodb.get_collection("limites_telefone")
+
+    def _bucket(self, budget: str, phone: str) -> TokenBucket:
+        key = (budget, phone)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                per_minute, burst = self.budgets[budget]
+                bucket = self._buckets[key] = TokenBucket(per_minute / 60.0, burst)
+                while len(self._buckets) > self.max_tracked_phones:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket
+
+    def _allow_shared(self, budget: str, phone: str) -> bool:
+        window = int(time.time() // 60)
+        try:
+            doc = self.get_collection().find_one_and_update(
+                {"_id": f"{budget}|{phone}|{window}"},
+                {"$inc": {"count": 1}, "$setOnInsert": {"expira_em": datetime.now() + timedelta(minutes=2)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return doc["count"] <= self.budgets[budget][0]
+        except Exception as e:
+            # Falha no contador compartilhado não bloqueia o usuário: vale o limite local
+            logger.error(f"Erro no limite compartilhado de {phone}: {e}")
+            return True
+
+    def allow(self, phone: str, budget: str) -> bool:
+        allowed = self._bucket(budget, phone).try_acquire()
+        if allowed and self.shared:
+            allowed = self._allow_shared(budget, phone)
+        if not allowed:
+            metrics.inc("rate_limited_total", budget=budget)
+            logger.warning(f"[LIMITE] Telefone {phone} excedeu o orçamento de {budget}")
+        return allowed
+
+rate_limiter = PhoneRateLimiter(
+    {
+        PhoneRateLimiter.MESSAGES: (settings.RATE_LIMIT_MESSAGES_PER_MINUTE, settings.RATE_LIMIT_MESSAGES_BURST),
+        PhoneRateLimiter.LLM: (settings.RATE_LIMIT_LLM_PER_MINUTE, settings.RATE_LIMIT_LLM_BURST)
+    },
+    shared=settings.RATE_LIMIT_SHARED
+)
+
+# ===== FAIXAS DE EXECUÇÃO =====
+class TurnLanes:
+    """
+    Duas faixas de execução para os turnos do webhook, para que um "sim" não espere atrás
+    de turnos presos no Groq:
+    - rápida: turnos resolvidos localmente (confirmar, cancelar, despedida, consultar, FAQ)
+      respondem na própria requisição, em milissegundos;
+    - LLM: turnos que dependem do LLM vão para um pool de LLM_LANE_WORKERS threads com fila
+      limitada (LLM_LANE_QUEUE_MAX); o webhook devolve TwiML vazio na hora e a resposta
+      segue pela API do Twilio, sem ocupar um worker do Flask durante a chamada ao Groq.
+
+    Turnos do mesmo telefone são executados em ordem: enquanto ele tiver turno na faixa do
+    LLM, as mensagens seguintes entram na mesma fila. Com a fila cheia, o turno é degradado.
+    """
+    FAST = "rapida"
+    LLM = "llm"
+
+    def __init__(self, sender, workers: int, queue_max: int):
+        self.sender = sender
+        self.workers = workers
+        self.queue_max = queue_max
+        self._pending = {}  # telefone -> deque de (contexto, função, enfileirado_em)
+        self._ready = queue.Queue()
+        self._queued = 0
+        self._in_flight = {self.FAST: 0, self.LLM: 0}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f"llm-lane-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def busy(self, phone: str) -> bool:
+        with self._lock:
+            return phone in self._pending
+
+    def backlog(self) -> int:
+        """Turnos enfileirados mais os em execução na faixa do LLM"""
+        with self._lock:
+            return self._queued + self._in_flight[self.LLM]
+
+    def _set_gauges(self):
+        metrics.set_gauge("lane_queue_depth", self._queued, lane=self.LLM)
+        for lane, count in self._in_flight.items():
+            metrics.set_gauge("lane_in_flight", count, lane=lane)
+
+    @contextmanager
+    def fast(self):
+        """Marca um turno em execução na faixa rápida (na thread da requisição)"""
+        started = time.perf_counter()
+        with self._lock:
+            self._in_flight[self.FAST] += 1
+            self._set_gauges()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight[self.FAST] -= 1
+                self._set_gauges()
+            metrics.observe("lane_turn_seconds", time.perf_counter() - started, lane=self.FAST)
+
+    def submit(self, phone: str, func) -> bool:
+        """Enfileira func na faixa do LLM (com o contexto atual: partição e rastreamento); False se a fila estiver cheia"""
+        self.start()
+        with self._lock:
+            if self._queued >= self.queue_max:
+                metrics.inc("lane_rejected_total", lane=self.LLM)
+                return False
+            self._queued += 1
+            entries = self._pending.get(phone)
+            if entries is None:
+                entries = self._pending[phone] = deque()
+                self._ready.put(phone)
+            entries.append((copy_context(), func, time.perf_counter()))
+            self._set_gauges()
+        return True
+
+    def _run(self):
+        while True:
+            phone = self._ready.get()
+            while True:
+                with self._lock:
+                    entries = self._pending[phone]
+                    if not entries:
+                        del self._pending[phone]
+                        break
+                    context, func, enqueued_at = entries.popleft()
+                    self._queued -= 1
+                    self._in_flight[self.LLM] += 1
+                    self._set_gauges()
+                started = time.perf_counter()
+                metrics.observe("lane_wait_seconds", started - enqueued_at, lane=self.LLM)
+                try:
+                    reply = context.run(func)
+                    if reply:
+                        self.sender.send(phone, reply)
+                except Exception as e:
+                    logger.error(f"[FAIXA-LLM] Erro ao processar turno de {phone}: {e}")
+                finally:
+                    with self._lock:
+                        self._in_flight[self.LLM] -= 1
+                        self._set_gauges()
+                    metrics.observe("lane_turn_seconds", time.perf_counter() - started, lane=self.LLM)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"enabled": settings.TURN_LANES_ENABLED, "llm_queue": self._queued,
+                    "in_flight": dict(self._in_flight), "workers": self.workers}
+
+turn_lanes = TurnLanes(outbound_sender, settings.LLM_LANE_WORKERS, settings.LLM_LANE_QUEUE_MAX)
+admission.lanes = turn_lanes
+
+def lane_degraded() -> bool:
+    """Reavalia a carga quando o turno sai da fila: o modo da admissão pode ter mudado na espera"""
+    return admission.mode() != AdmissionController.NORMAL
+
+def finish_lane_turn(turn: dict) -> str:
+    if lane_degraded():
+        degrade_turn(turn)
+    return finish_turn(turn)
+
+def dispatch_turn(phone: str, text: str, degraded: bool = False) -> Optional[str]:
+    """
+    Atende um turno do webhook pela faixa adequada. Retorna a resposta para o TwiML ou
+    None quando o turno foi para a faixa do LLM (a resposta será enviada depois).
+    """
+    if not settings.TURN_LANES_ENABLED:
+        return process_message(phone, text, degraded)
+    if turn_lanes.busy(phone):
+        # Mantém a ordem das mensagens do telefone: entra atrás do turno que já está na fila
+        if turn_lanes.submit(phone, lambda: process_message(phone, text, degraded or lane_degraded())):
+            return None
+        degraded = True
+    with turn_lanes.fast():
+        turn = prepare_turn(phone, text, degraded)
+        if turn["response"] is None and turn_lanes.submit(phone, lambda: finish_lane_turn(turn)):
+            return None
+        if turn["response"] is None:
+            degrade_turn(turn)
+        return finish_turn(turn)
+
+# ===== ROTAS =====
+@app.before_request
+def start_request_trace():
+    """Gera o ID da requisição usado para marcar os comandos enviados ao MongoDB"""
+    g.request_id = request.headers.get("X-Request-Id") or request.form.get("MessageSid") or uuid.uuid4().hex[:16]
+    g.request_started = time.perf_counter()
+    g.request_token = current_request_id.set(g.request_id)
+    mongo_tracer.start_request(g.request_id, request.path)
+
+@app.teardown_request
+def end_request_trace(error=None):
+    request_id = g.pop("request_id", None)
+    if request_id is None:
+        return
+    mongo_tracer.end_request(request_id, (time.perf_counter() - g.pop("request_started")) * 1000)
+    current_request_id.reset(g.pop("request_token"))
+
+@app.route("/")
+def root():
+    """Endpoint raiz para verificar se a API está funcionando"""
+    return jsonify({
+        "message": "Genia Quadras - Agente WhatsApp",
+        "status": "online",
+        "version": "1.0.0",
+        "database": "connected" if mongodb.db is not None else "disconnected"
+    })
 
 @app.route("/health")
 def health_check():
@@ -1117,22 +4900,36 @@ def health_check():
     return jsonify({
         "status": "healthy", 
         "service": "genia-quadras",
-        "database": "connected" if mongodb.db is not None else "disconnected"
+        "database": "connected" if mongodb.db is not None else "disconnected",
+        "admission": admission.stats(),
+        "lanes": turn_lanes.stats()
     })
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """Métricas no formato texto do Prometheus"""
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/webhook", methods=["POST"])
-def whatsapp_webhook():
+@app.route("/webhook/<establishment_id>", methods=["POST"])
+def whatsapp_webhook(establishment_id: Optional[str] = None):
     """
     Webhook para receber mensagens do Twilio WhatsApp
+    
+    No modo particionado, cada número do Twilio pode apontar para /webhook/<establishment_id>
+    para que o balanceador encaminhe a mensagem ao worker dono da partição.
     """
     try:
         # Extrai dados do formulário enviado pelo Twilio (x-www-form-urlencoded)
         form = request.form or {}
         from_number = form.get("From", "")
+        to_number = (form.get("To") or "").strip()
         message_body = form.get("Body", "")
         wa_id = form.get("WaId")  # apenas números, ex: 5511999999999
         profile_name = form.get("ProfileName")
         channel_metadata = form.get("ChannelMetadata")
+        # Localização compartilhada no WhatsApp (o Body pode vir vazio)
+        latitude, longitude = form.get("Latitude"), form.get("Longitude")
         # Fallback: se não veio From, monta a partir do WaId
         if (not from_number) and wa_id:
             from_number = f"whatsapp:+{wa_id}"
@@ -1144,13 +4941,44 @@ def whatsapp_webhook():
         logger.debug(f"Payload Twilio: form={dict(form)}")
         
         # Valida se tem dados necessários
-        if not from_number or not message_body:
+        if not from_number or not (message_body or (latitude and longitude)):
             logger.warning("Mensagem sem dados necessários")
             return "OK"
         
-        # Processa a mensagem com a lógica do agente
-        reply_text = process_message(from_number, message_body)
+        # Identidade canônica (E.164) usada por usuário, estado, histórico e reservas
+        phone = normalize_phone(from_number)
+        
+        # Telefone acima do orçamento de mensagens: responde sem processar
+        if not rate_limiter.allow(phone, PhoneRateLimiter.MESSAGES):
+            resp = MessagingResponse()
+            resp.message(PhoneRateLimiter.THROTTLED_REPLY)
+            return str(resp)
+        
+        # Localização: busca local dos estabelecimentos mais próximos, sem LLM
+        if latitude and longitude:
+            try:
+                reply_text = process_location(phone, float(latitude), float(longitude))
+            except ValueError:
+                reply_text = "Não consegui ler a localização enviada. Tente compartilhar de novo."
+            resp = MessagingResponse()
+            resp.message(reply_text)
+            return str(resp)
+        
+        # Processa a mensagem com a lógica do agente, na partição do estabelecimento,
+        # no modo definido pelo controle de admissão
+        with admission.admit() as mode:
+            if mode == AdmissionController.SHEDDING:
+                logger.warning(f"[SOBRECARGA] Mensagem de {phone} descartada com resposta padrão")
+                reply_text = AdmissionController.SHED_REPLY
+            else:
+                partition = partition_router.resolve(phone, message_body, to_number, establishment_id)
+                with partition_scope(partition):
+                    reply_text = dispatch_turn(phone, message_body, degraded=mode == AdmissionController.DEGRADED)
         resp = MessagingResponse()
+        if reply_text is None:
+            # Turno na faixa do LLM: a resposta vai pela API do Twilio quando ficar pronta
+            logger.info(f"Turno de {from_number} encaminhado à faixa do LLM")
+            return str(resp)
         resp.message(reply_text)
         logger.info(f"Resposta enviada para {from_number}")
         return str(resp)
@@ -1166,13 +4994,19 @@ def test_message():
     """
     try:
         data = request.get_json()
-        phone = data.get("phone", "whatsapp:+5511999999999")
+        phone = normalize_phone(data.get("phone", "whatsapp:+5511999999999"))
         message = data.get("message", "Oi")
         
         logger.info(f"Teste - Mensagem de {phone}: {message}")
         
+        if data.get("latitude") is not None and data.get("longitude") is not None:
+            reply_text = process_location(phone, float(data["latitude"]), float(data["longitude"]))
+            return jsonify({"phone": phone, "message": message, "reply": reply_text})
+        
         # Usa a mesma lógica do webhook (NLU + fluxo de reserva)
-        reply_text = process_message(phone, message)
+        partition = partition_router.resolve(phone, message, data.get("to", ""), data.get("establishment_id"))
+        with partition_scope(partition):
+            reply_text = process_message(phone, message)
         
         return jsonify({
             "phone": phone,
@@ -1184,97 +5018,381 @@ def test_message():
         logger.error(f"Erro no teste: {e}")
         return jsonify({"error": str(e)}), 500
 
+COURTS_PAGE_MAX = 500
+GZIP_MIN_BYTES = 1024
+
 @app.route("/courts", methods=["GET"])
 def list_courts():
-    """Lista todas as quadras cadastradas"""
+    """
+    Lista as quadras ativas com paginação por cursor
+
+    Parâmetros: establishment_id, limit (até 500) e cursor (next_cursor da página anterior).
+    O ETag deriva da versão do catálogo, então consultas repetidas sem mudanças recebem 304
+    sem acessar o MongoDB; a resposta serializada fica em cache até o catálogo mudar.
+    """
     try:
-        courts = court_repo.get_all()
-        courts_data = [court.to_dict() for court in courts]
-        return jsonify({
-            "courts": courts_data,
-            "count": len(courts_data)
-        })
+        try:
+            limit = min(max(int(request.args.get("limit", 100)), 1), COURTS_PAGE_MAX)
+        except ValueError:
+            return jsonify({"error": "limit deve ser inteiro"}), 400
+        cursor = request.args.get("cursor") or None
+        if cursor and not ObjectId.is_valid(cursor):
+            return jsonify({"error": "cursor inválido"}), 400
+        establishment_id = request.args.get("establishment_id") or current_scope()
+
+        etag = f"courts-{catalog_cache.version()}-{establishment_id or 'all'}-{cursor or '0'}-{limit}"
+        headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+
+        def build():
+            repo = court_repo.scoped(establishment_id) if establishment_id else court_repo
+            courts, next_cursor = repo.get_page(cursor, limit)
+            courts_data = [court.to_dict() for court in courts]
+            body = json.dumps({"courts": courts_data, "count": len(courts_data), "next_cursor": next_cursor},
+                              ensure_ascii=False).encode("utf-8")
+            return body, gzip.compress(body) if len(body) >= GZIP_MIN_BYTES else None
+
+        with partition_scope(establishment_id):
+            body, compressed = catalog_cache.get_cached(("courts_page", establishment_id, cursor, limit), build)
+        if compressed is not None and "gzip" in request.headers.get("Accept-Encoding", ""):
+            body = compressed
+            headers["Content-Encoding"] = "gzip"
+        return Response(body, mimetype="application/json", headers=headers)
     except Exception as e:
         logger.error(f"Erro ao listar quadras: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/stats", methods=["GET"])
+def occupancy_stats():
+    """
+    Ocupação e receita a partir dos agregados incrementais
+
+    Parâmetros: establishment_id, court_id, inicio/fim (AAAA-MM-DD, padrão últimos 30 dias)
+    e agrupar=court|day|hour.
+    """
+    try:
+        today = datetime.now().date()
+        start_day = request.args.get("inicio", (today - timedelta(days=29)).isoformat())
+        end_day = request.args.get("fim", today.isoformat())
+        group_by = request.args.get("agrupar", "court")
+        if group_by not in OccupancyRollups.GROUP_FIELDS:
+            return jsonify({"error": "agrupar deve ser court, day ou hour"}), 400
+        try:
+            datetime.fromisoformat(start_day), datetime.fromisoformat(end_day)
+        except ValueError:
+            return jsonify({"error": "inicio/fim devem estar no formato AAAA-MM-DD"}), 400
+        establishment_id = request.args.get("establishment_id") or current_scope()
+        return jsonify(occupancy_rollups.query(
+            start_day, end_day, group_by, establishment_id, request.args.get("court_id")
+        ))
+    except Exception as e:
+        logger.error(f"Erro ao consultar estatísticas: {e}")
+        return jsonify({"error": str(e)}), 500
+
+EXPORT_COLUMNS = ["id", "establishment_id", "court_id", "data_reserva", "quantidade_horas",
+                  "status", "usuario_nome", "usuario_telefone", "criado_em"]
+
+def export_row(doc: dict) -> list:
+    usuario = doc.get("usuario", {})
+    return [str(doc["_id"]), doc.get("establishment_id", ""), doc.get("court_id", ""), doc.get("data_reserva", ""),
+            doc.get("quantidade_horas", 1), doc.get("status", ""), usuario.get("nome", ""),
+            usuario.get("telefone", ""), doc.get("criado_em", "")]
+
+def export_chunks(cursor, fmt: str, rows_per_chunk: int = 500):
+    """Serializa o cursor em blocos de texto (CSV ou NDJSON) sem acumular o resultado"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(EXPORT_COLUMNS)
+    pending = 0
+    for doc in cursor:
+        row = export_row(doc)
+        if fmt == "csv":
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n")
+        pending += 1
+        if pending >= rows_per_chunk:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+def gzip_chunks(chunks):
+    """Compacta um fluxo de blocos em gzip de forma incremental"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route("/reservations/export", methods=["GET"])
+def export_reservations():
+    """
+    Exporta reservas em CSV ou NDJSON por streaming (memória constante)
+
+    Parâmetros: establishment_id, court_id, inicio/fim (AAAA-MM-DD), formato=csv|ndjson
+    e gzip=1 (ou Accept-Encoding: gzip) para compactar. Contém nome e telefone dos clientes:
+    exige o cabeçalho `Authorization: Bearer <EXPORT_TOKEN>` e fica desativada sem o token.
+    """
+    if not settings.EXPORT_TOKEN:
+        return jsonify({"error": "Exportação desativada (defina EXPORT_TOKEN)"}), 403
+    provided = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(provided.encode("utf-8"), settings.EXPORT_TOKEN.encode("utf-8")):
+        logger.warning(f"[EXPORT] Tentativa de exportação sem token válido de {request.remote_addr}")
+        return jsonify({"error": "Não autorizado"}), 401
+    fmt = request.args.get("formato", "csv")
+    if fmt not in ("csv", "ndjson"):
+        return jsonify({"error": "formato deve ser csv ou ndjson"}), 400
+    start_day = request.args.get("inicio")
+    end_day = request.args.get("fim")
+    try:
+        start_iso = datetime.fromisoformat(start_day).isoformat() if start_day else None
+        end_iso = (datetime.fromisoformat(end_day) + timedelta(days=1) - timedelta(seconds=1)).isoformat() if end_day else None
+    except ValueError:
+        return jsonify({"error": "inicio/fim devem estar no formato AAAA-MM-DD"}), 400
+
+    cursor = reservation_repo.iter_for_export(
+        request.args.get("establishment_id"), request.args.get("court_id"),
+        start_iso, end_iso, settings.EXPORT_BATCH_SIZE
+    )
+    chunks = export_chunks(cursor, fmt)
+    headers = {"Content-Disposition": f"attachment; filename=reservas.{fmt}"}
+    compress = request.args.get("gzip") == "1" or "gzip" in request.headers.get("Accept-Encoding", "")
+    if compress:
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    logger.info(f"[EXPORT] Exportando reservas em {fmt}{' (gzip)' if compress else ''}")
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
+def calendar_response(feed: Optional[Tuple[str, bytes]]):
+    if feed is None:
+        return Response("Calendário não encontrado", status=404, mimetype="text/plain")
+    etag, body = feed
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype="text/calendar", headers=headers)
+
+@app.route("/calendar/court/<court_id>.ics", methods=["GET"])
+def court_calendar(court_id: str):
+    """Feed iCalendar das reservas confirmadas da quadra (suporta If-None-Match)"""
+    try:
+        if not ObjectId.is_valid(court_id):
+            return calendar_response(None)
+        return calendar_response(calendar_feeds.court_feed(court_id))
+    except Exception as e:
+        logger.error(f"Erro ao gerar calendário da quadra: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/calendar/user/<token>.ics", methods=["GET"])
+def user_calendar(token: str):
+    """Feed iCalendar das reservas do usuário, endereçado pelo token enviado em 'minhas reservas'"""
+    try:
+        return calendar_response(calendar_feeds.user_feed(token))
+    except Exception as e:
+        logger.error(f"Erro ao gerar calendário do usuário: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/establishments/near", methods=["GET"])
+def establishments_near():
+    """
+    Estabelecimentos mais próximos de um ponto, consultados no MongoDB pelo índice 2dsphere
+
+    Parâmetros: lat, lng, raio_km (padrão GEO_MAX_DISTANCE_KM) e limit (até 50).
+    """
+    try:
+        try:
+            latitude, longitude = float(request.args["lat"]), float(request.args["lng"])
+            max_km = float(request.args.get("raio_km", settings.GEO_MAX_DISTANCE_KM))
+            limit = min(max(int(request.args.get("limit", 10)), 1), 50)
+            geo_point(latitude, longitude)
+        except (KeyError, ValueError):
+            return jsonify({"error": "lat e lng são obrigatórios e devem ser coordenadas válidas"}), 400
+        items = [
+            dict(establishment.to_dict(), _id=establishment._id, distancia_km=round(distance, 2))
+            for establishment, distance in establishment_repo.find_near(latitude, longitude, max_km, limit)
+        ]
+        return jsonify({"establishments": items, "count": len(items)})
+    except Exception as e:
+        logger.error(f"Erro na busca por proximidade: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/debug/db", methods=["GET"])
+def debug_db():
+    """Últimos rastros de comandos do MongoDB por requisição e consultas lentas"""
+    return jsonify(mongo_tracer.stats())
+
+@app.route("/partitions", methods=["GET"])
+def list_partitions():
+    """Mostra o modo de particionamento, as partições deste worker e o uso dos caches"""
+    return jsonify(partition_router.stats())
+
+@app.route("/catalog/import", methods=["POST"])
+def import_catalog():
+    """
+    Importa estabelecimentos e quadras em lote
+
+    Aceita JSON ({"establishments": [...]}) ou CSV (Content-Type text/csv ou arquivo no campo
+    "arquivo" de um formulário). Responde com as contagens e os erros por linha.
+    """
+    try:
+        upload = request.files.get("arquivo")
+        if upload is not None:
+            text = upload.read().decode("utf-8-sig")
+            is_csv = not upload.filename.lower().endswith(".json")
+            items = CatalogImporter.parse_csv(text) if is_csv else CatalogImporter.parse_json(json.loads(text))
+        elif request.mimetype == "text/csv":
+            items = CatalogImporter.parse_csv(request.get_data(as_text=True))
+        else:
+            items = CatalogImporter.parse_json(request.get_json(force=True))
+    except ValueError as e:
+        return jsonify({"error": f"Arquivo inválido: {e}"}), 400
+    try:
+        report = catalog_importer.import_items(items)
+        return jsonify(report), 207 if report["erros"] else 200
+    except Exception as e:
+        logger.error(f"Erro ao importar catálogo: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/populate", methods=["POST"])
 def populate_database():
-    """Popula o banco com dados de exemplo"""
+    """Popula o banco com dados de exemplo (via importação em lote)"""
     try:
-        # Cria algumas quadras de exemplo
-        courts_data = [
-            {
-                "nome": "Quadra 1 - Futebol Society",
-                "tipo": "Futebol Society",
-                "endereco": {
-                    "logradouro": "Rua das Flores, 123",
-                    "bairro": "Centro",
-                    "cidade": "São Paulo"
-                },
-                "valor_hora": 80.0,
-                "horarios_disponiveis": []
-            },
-            {
-                "nome": "Quadra 2 - Futsal",
-                "tipo": "Futsal",
-                "endereco": {
-                    "logradouro": "Av. Paulista, 456",
-                    "bairro": "Bela Vista",
-                    "cidade": "São Paulo"
-                },
-                "valor_hora": 60.0,
-                "horarios_disponiveis": []
-            }
-        ]
-        
-        # Gera horários disponíveis para os próximos 7 dias
-        base_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        available_hours = list(range(8, 22))  # Horários de 8h às 21h
-        
-        created_courts = []
-        for court_data in courts_data:
-            # Gera horários para os próximos 7 dias
-            horarios = []
-            for day in range(7):
-                for hour in available_hours:
-                    horario = base_date + timedelta(days=day, hours=hour)
-                    horarios.append(horario)
-            
-            court_data["horarios_disponiveis"] = horarios
-            
-            # Cria a quadra
-            court = Court(
-                nome=court_data["nome"],
-                tipo=court_data["tipo"],
-                endereco=court_data["endereco"],
-                valor_hora=court_data["valor_hora"],
-                horarios_disponiveis=court_data["horarios_disponiveis"]
-            )
-            
-            court_id = court_repo.create(court)
-            court._id = court_id
-            created_courts.append(court.to_dict())
-        
-        return jsonify({
-            "message": "Banco populado com sucesso!",
-            "courts_created": len(created_courts),
-            "courts": created_courts
-        })
-        
+        report = catalog_importer.import_items(CatalogImporter.parse_json(SAMPLE_CATALOG))
+        return jsonify({"message": "Banco populado com sucesso!", **report})
     except Exception as e:
         logger.error(f"Erro ao popular banco: {e}")
         return jsonify({"error": str(e)}), 500
 
+# ===== CLI =====
+def command_train_intent(args) -> int:
+    """Treina o classificador de intenções com o conjunto inicial + histórico rotulado"""
+    samples = list(INTENT_SEED_SAMPLES)
+    if not args.seed_only:
+        history_samples = collect_intent_samples()
+        logger.info(f"{len(history_samples)} exemplos rotulados encontrados no histórico")
+        samples.extend(history_samples)
+    model = IntentClassifier.train(samples, epochs=args.epochs)
+    model.save(args.output)
+    correct = sum(1 for text, label in samples if model.predict(text)[0] == label)
+    print(f"Modelo salvo em {args.output}: {len(samples)} exemplos, {len(model.labels)} intenções, "
+          f"acurácia de treino {correct / len(samples):.1%}")
+    return 0
+
+def command_backfill_stats(args) -> int:
+    """Recalcula os agregados de ocupação a partir do histórico de reservas"""
+    started = time.perf_counter()
+    count = occupancy_rollups.backfill(args.establishment_id)
+    print(f"{count} agregados (quadra, dia, hora) recalculados em {time.perf_counter() - started:.1f}s")
+    return 0
+
+def command_import_catalog(args) -> int:
+    """Importa estabelecimentos e quadras de um arquivo JSON ou CSV"""
+    with open(args.path, encoding="utf-8-sig") as f:
+        text = f.read()
+    fmt = args.format or ("json" if args.path.lower().endswith(".json") else "csv")
+    items = CatalogImporter.parse_json(json.loads(text)) if fmt == "json" else CatalogImporter.parse_csv(text)
+    report = catalog_importer.import_items(items)
+    print(f"Estabelecimentos: {report['estabelecimentos']} | Quadras: {report['quadras']}")
+    for error in report["erros"]:
+        print(f"  linha {error['linha']}: {error['erro']}")
+    return 1 if report["erros"] else 0
+
+def command_dedup_users(args) -> int:
+    """Unifica usuários duplicados e normaliza telefones para E.164"""
+    report = user_repo.dedup()
+    print(json.dumps(report, ensure_ascii=False))
+    return 0
+
+def build_cli():
+    import argparse
+    parser = argparse.ArgumentParser(description="Comandos de manutenção do Genia Quadras")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train = commands.add_parser("train-intent", help="Treina o classificador de intenções")
+    train.add_argument("--output", default=settings.INTENT_MODEL_PATH)
+    train.add_argument("--epochs", type=int, default=40)
+    train.add_argument("--seed-only", action="store_true", help="Ignora o histórico de conversas")
+    train.set_defaults(handler=command_train_intent)
+
+    backfill = commands.add_parser("backfill-stats", help="Recalcula os agregados de ocupação e receita")
+    backfill.add_argument("--establishment-id", help="Restringe a um estabelecimento")
+    backfill.set_defaults(handler=command_backfill_stats)
+
+    catalog = commands.add_parser("import-catalog", help="Importa estabelecimentos e quadras (JSON ou CSV)")
+    catalog.add_argument("path")
+    catalog.add_argument("--format", choices=["json", "csv"], help="Padrão: pela extensão do arquivo")
+    catalog.set_defaults(handler=command_import_catalog)
+
+    dedup = commands.add_parser("dedup-users", help="Unifica usuários duplicados pelo telefone canônico (com o tráfego parado)")
+    dedup.set_defaults(handler=command_dedup_users)
+    return parser
+
+def running_cli() -> bool:
+    """Execução como comando de manutenção (não sobe serviços em segundo plano)"""
+    return __name__ == "__main__" and len(sys.argv) > 1
+
+def reloader_monitor() -> bool:
+    """Processo vigia do reloader do Flask em modo debug: quem atende é o filho (WERKZEUG_RUN_MAIN)"""
+    return __name__ == "__main__" and settings.DEBUG and os.environ.get("WERKZEUG_RUN_MAIN") != "true"
+
 # ===== INICIALIZAÇÃO =====
+INDEX_SPECS = [
+    ("reservas", [("status", 1), ("data_reserva", 1)], {}),
+    ("reservas", [("establishment_id", 1), ("usuario.telefone", 1)], {}),
+    ("reservas", [("court_id", 1), ("status", 1), ("data_reserva", 1)], {}),
+    ("reservas", [("recorrencia.serie_id", 1)], {"sparse": True}),
+    ("reservas", [("establishment_id", 1), ("data_reserva", 1)], {}),
+    ("lista_espera", [("court_id", 1), ("data", 1), ("hora", 1), ("status", 1), ("criado_em", 1)], {}),
+    ("ocupacao_horaria", [("court_id", 1), ("data", 1), ("hora", 1)], {"unique": True}),
+    ("ocupacao_horaria", [("establishment_id", 1), ("data", 1)], {}),
+    ("courts", [("establishment_id", 1), ("ativo", 1)], {}),
+    ("estados_conversa", [("phone", 1), ("establishment_id", 1)], {}),
+    ("limites_telefone", "expira_em", {"expireAfterSeconds": 0}),
+    ("usuarios", "calendar_token", {"sparse": True}),
+    ("usuarios", "calendar_tokens_anteriores", {"sparse": True}),
+    ("conversation_history", "phone", {"unique": True}),
+    ("establishments", [("localizacao", "2dsphere")], {}),
+    # Chaves naturais (falham se já houver duplicatas; para usuários rode `dedup-users`)
+    ("usuarios", "telefone", {"unique": True}),
+    ("courts", [("establishment_id", 1), ("nome", 1)], {"unique": True}),
+    ("establishments", [("nome", 1), ("endereco.cidade", 1)], {"unique": True}),
+]
+
+def ensure_indexes():
+    """Cria os índices usados pelas consultas do agente (idempotente; um índice que falha não impede os demais)"""
+    for collection_name, keys, options in INDEX_SPECS:
+        try:
+            mongodb.get_collection(collection_name).create_index(keys, **options)
+        except Exception as e:
+            logger.error(f"Erro ao criar índice {keys} em {collection_name}: {e}")
+
 # Inicializar MongoDB
 try:
     mongodb.connect_sync()
     logger.info("MongoDB conectado com sucesso!")
+    ensure_indexes()
+    atexit.register(history_repo.buffer.flush)
+    if not running_cli() and not reloader_monitor():
+        occupancy_rollups.start()
+        waitlist_service.start()
+        calendar_feeds.start()
+        availability_digest.start()
+        if settings.REMINDER_ENABLED:
+            reminder_scheduler.start()
 except Exception as e:
     logger.error(f"Erro ao conectar MongoDB: {e}")
 
 if __name__ == "__main__":
+    if running_cli():
+        cli_args = build_cli().parse_args()
+        sys.exit(cli_args.handler(cli_args))
     # Execução direta da aplicação (para desenvolvimento)
     port = int(os.getenv("PORT", 8000))
     app.run(
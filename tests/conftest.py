@@ -0,0 +1,28 @@
+"""
+Configuração comum dos testes: importa o app sem MongoDB real e oferece um banco mongomock
+
+Uso: python -m pytest tests/
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("MONGODB_URI", "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=50")
+os.environ.setdefault("GROQ_API_KEY", "")
+os.environ.setdefault("REMINDER_ENABLED", "false")
+sys.path.insert(0, ROOT)
+
+import main_flask_single as app  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    """Banco mongomock novo por teste (pip install mongomock), sem os índices do app"""
+    mongomock = pytest.importorskip("mongomock")
+    app.mongodb.client = mongomock.MongoClient()
+    app.mongodb.db = app.mongodb.client["genia_test"]
+    yield app.mongodb.db
+    app.mongodb.client = app.mongodb.db = None
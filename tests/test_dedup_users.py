@@ -0,0 +1,72 @@
+"""
+Testes da migração dedup-users (UserRepository.dedup)
+
+Uso: python -m pytest tests/
+"""
+
+from bson import ObjectId
+
+import main_flask_single as app
+
+
+def test_dedup_merges_users_reservations_tokens_and_history(db):
+    keeper_id, named_id, other_id = ObjectId(), ObjectId(), ObjectId()
+    db.usuarios.insert_many([
+        {"_id": named_id, "telefone": "+55 (11) 99999-9999", "nome": "Ana", "criado_em": "2024-02-01T10:00:00",
+         "calendar_token": "token-ana"},
+        {"_id": keeper_id, "telefone": "whatsapp:+5511999999999", "nome": "Usuário", "criado_em": "2024-01-01T10:00:00"},
+        {"_id": other_id, "telefone": "+5511888888888", "nome": "Bia", "criado_em": "2024-01-05T10:00:00"},
+    ])
+    db.reservas.insert_many([
+        {"usuario": {"_id": str(named_id), "telefone": "+55 (11) 99999-9999", "nome": "Ana"}, "status": "confirmada"},
+        {"usuario": {"_id": str(keeper_id), "telefone": "whatsapp:+5511999999999", "nome": "Usuário"}, "status": "confirmada"},
+        {"usuario": {"_id": str(other_id), "telefone": "+5511888888888", "nome": "Bia"}, "status": "confirmada"},
+    ])
+    db.conversation_history.insert_many([
+        {"phone": "whatsapp:+5511999999999", "last_activity": "2024-03-01T10:00:00",
+         "messages": [{"role": "user", "content": "b", "timestamp": "2024-03-01T10:00:00"}]},
+        {"phone": "+5511999999999", "last_activity": "2024-03-02T10:00:00",
+         "messages": [{"role": "user", "content": "a", "timestamp": "2024-02-01T10:00:00"},
+                      {"role": "user", "content": "c", "timestamp": "2024-03-02T10:00:00"}]},
+    ])
+
+    report = app.user_repo.dedup()
+
+    # Agrupa pelo telefone canônico; fica o mais antigo, com o primeiro nome real do grupo
+    users = {doc["telefone"]: doc for doc in db.usuarios.find()}
+    assert set(users) == {"+5511999999999", "+5511888888888"}
+    keeper = users["+5511999999999"]
+    assert keeper["_id"] == keeper_id
+    assert keeper["nome"] == "Ana"
+    assert report["usuarios_removidos"] == 1
+
+    # Reservas do removido apontam para o sobrevivente; o token de calendário dele continua valendo
+    assert {r["usuario"]["_id"] for r in db.reservas.find({"usuario.telefone": "+5511999999999"})} == {str(keeper_id)}
+    assert db.reservas.count_documents({"usuario._id": str(other_id)}) == 1
+    assert app.user_repo.get_phone_by_calendar_token("token-ana") == "+5511999999999"
+
+    # Histórico fundido no documento mais recente, com as mensagens em ordem de horário
+    histories = list(db.conversation_history.find())
+    assert len(histories) == 1
+    assert histories[0]["phone"] == "+5511999999999"
+    assert [m["content"] for m in histories[0]["messages"]] == ["a", "b", "c"]
+
+    # O índice único fica criado ao final
+    unique = [index for index in db.usuarios.index_information().values() if index.get("unique")]
+    assert [index["key"] for index in unique] == [[("telefone", 1)]]
+
+
+def test_dedup_keeps_keeper_token_and_is_idempotent(db):
+    db.usuarios.insert_many([
+        {"telefone": "+5511999999999", "nome": "Ana", "criado_em": "2024-01-01T10:00:00", "calendar_token": "novo"},
+        {"telefone": "5511999999999", "nome": "Ana", "criado_em": "2024-02-01T10:00:00", "calendar_token": "antigo"},
+    ])
+    app.user_repo.dedup()
+    keeper = db.usuarios.find_one()
+    assert keeper["calendar_token"] == "novo"
+    assert keeper["calendar_tokens_anteriores"] == ["antigo"]
+
+    report = app.user_repo.dedup()
+    assert report["usuarios_removidos"] == 0
+    assert report["usuarios_normalizados"] == 0
+    assert db.usuarios.count_documents({}) == 1
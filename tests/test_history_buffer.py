@@ -0,0 +1,122 @@
+"""
+Testes do buffer write-behind do histórico (HistoryWriteBuffer) e da leitura com o buffer
+
+Uso: python -m pytest tests/
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+import main_flask_single as app
+
+
+def message(content, minutes_ago=0):
+    timestamp = datetime.now() - timedelta(minutes=minutes_ago)
+    return {"role": "user", "content": content, "timestamp": timestamp.isoformat()}
+
+
+class FailingCollection:
+    """Coleção que grava o lote mas falha nos índices pedidos (ou no lote todo, depois de gravar)"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.fail_indexes = set()
+        self.fail_after_write = False
+
+    def bulk_write(self, operations, ordered=True):
+        kept = [op for index, op in enumerate(operations) if index not in self.fail_indexes]
+        if kept:
+            self.collection.bulk_write(kept, ordered=ordered)
+        if self.fail_indexes:
+            errors = [{"index": index, "code": 91, "errmsg": "falha simulada"} for index in sorted(self.fail_indexes)]
+            self.fail_indexes = set()
+            raise BulkWriteError({"writeErrors": errors, "nInserted": 0, "nUpserted": len(kept)})
+        if self.fail_after_write:
+            self.fail_after_write = False
+            raise ConnectionError("conexão perdida depois de gravar")
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+@pytest.fixture
+def repo(db):
+    repo = app.ConversationHistoryRepository()
+    failing = FailingCollection(db.conversation_history)
+    # Intervalo longo: só os flush() explícitos do teste gravam
+    repo.buffer = app.HistoryWriteBuffer(lambda: failing, flush_interval_seconds=3600, max_batch=10 ** 6,
+                                         session_timeout_minutes=repo.session_timeout_minutes)
+    repo.failing = failing
+    return repo
+
+
+def contents(doc):
+    return [m["content"] for m in doc["messages"]]
+
+
+def test_reads_see_buffered_messages_before_and_after_flush(repo, db):
+    repo.buffer.append("+5511999999999", message("oi", minutes_ago=2))
+    repo.buffer.append("+5511999999999", message("quero reservar", minutes_ago=1))
+    assert db.conversation_history.count_documents({}) == 0
+    assert contents(repo._load("+5511999999999")) == ["oi", "quero reservar"]
+
+    assert repo.buffer.flush() == 2
+    repo.buffer.append("+5511999999999", message("amanhã"))
+    assert contents(repo._load("+5511999999999")) == ["oi", "quero reservar", "amanhã"]
+
+    repo.buffer.flush()
+    assert contents(db.conversation_history.find_one({"phone": "+5511999999999"})) == ["oi", "quero reservar", "amanhã"]
+    assert repo.buffer.flush() == 0
+
+
+def test_partial_failure_requeues_only_failed_phones_in_order(repo, db):
+    repo.buffer.append("+5511111111111", message("a1", minutes_ago=3))
+    repo.buffer.append("+5522222222222", message("b1", minutes_ago=3))
+    repo.failing.fail_indexes = {1}
+
+    assert repo.buffer.flush() == 1
+    assert contents(db.conversation_history.find_one({"phone": "+5511111111111"})) == ["a1"]
+    assert db.conversation_history.find_one({"phone": "+5522222222222"}) is None
+    assert repo.buffer.pending_for("+5511111111111") == []
+    # O que falhou volta antes das mensagens que chegaram depois
+    repo.buffer.append("+5522222222222", message("b2", minutes_ago=1))
+    assert [m["content"] for m in repo.buffer.pending_for("+5522222222222")] == ["b1", "b2"]
+    assert contents(repo._load("+5522222222222")) == ["b1", "b2"]
+
+    assert repo.buffer.flush() == 2
+    assert contents(db.conversation_history.find_one({"phone": "+5511111111111"})) == ["a1"]
+    assert contents(db.conversation_history.find_one({"phone": "+5522222222222"})) == ["b1", "b2"]
+
+
+def test_retrying_a_written_batch_does_not_duplicate(repo, db):
+    repo.buffer.append("+5511999999999", message("oi", minutes_ago=1))
+    repo.failing.fail_after_write = True
+    assert repo.buffer.flush() == 0
+    assert repo.buffer.pending_for("+5511999999999")
+    # Leitura com o lote gravado e ainda pendente não repete a mensagem
+    assert contents(repo._load("+5511999999999")) == ["oi"]
+
+    assert repo.buffer.flush() == 1
+    assert contents(db.conversation_history.find_one({"phone": "+5511999999999"})) == ["oi"]
+
+
+def test_inactive_session_rolls_over_on_flush(repo, db):
+    old = message("conversa antiga", minutes_ago=120)
+    db.conversation_history.insert_one({
+        "phone": "+5511999999999", "messages": [old], "session_start": old["timestamp"],
+        "last_activity": old["timestamp"], "resumo": "resumo antigo", "resumo_ate": old["timestamp"]
+    })
+    new = message("nova conversa")
+    repo.buffer.append("+5511999999999", new)
+    loaded = repo._load("+5511999999999")
+    assert contents(loaded) == ["nova conversa"]
+    assert loaded["session_start"] == new["timestamp"]
+
+    repo.buffer.flush()
+    doc = db.conversation_history.find_one({"phone": "+5511999999999"})
+    assert contents(doc) == ["nova conversa"]
+    assert doc["session_start"] == new["timestamp"]
+    assert doc["last_activity"] == new["timestamp"]
+    assert doc["resumo"] is None
@@ -0,0 +1,102 @@
+"""
+Testes do gateway LLM (circuit breaker)
+
+Uso: python -m pytest tests/
+"""
+
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import groq
+import httpx
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("MONGODB_URI", "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=50")
+os.environ.setdefault("GROQ_API_KEY", "")
+os.environ.setdefault("REMINDER_ENABLED", "false")
+sys.path.insert(0, ROOT)
+
+import main_flask_single as app  # noqa: E402
+
+
+class FlakyClient:
+    """Imita chat.completions.create: falha de conexão enquanto `failing` for verdadeiro"""
+
+    def __init__(self):
+        self.failing = True
+        self.bad_request = False
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        request = httpx.Request("POST", "https://api.groq.com")
+        if self.bad_request:
+            raise groq.BadRequestError("bad request", response=httpx.Response(400, request=request), body=None)
+        if self.failing:
+            raise groq.APIConnectionError(request=request)
+        return SimpleNamespace(choices=[], usage=None)
+
+
+def test_breaker_recovers_open_half_open_closed():
+    breaker = app.CircuitBreaker(failure_threshold=2, reset_seconds=0.05)
+    client = FlakyClient()
+    gateway = app.LLMGateway(client, max_in_flight=1, queue_timeout_seconds=1, max_retries=0,
+                             retry_base_seconds=0, breaker=breaker)
+
+    for _ in range(2):
+        with pytest.raises(app.LLMUnavailableError):
+            gateway.chat(model="m", messages=[])
+    assert breaker.state == app.CircuitBreaker.OPEN
+    assert not gateway.available
+
+    time.sleep(0.06)
+    # Passado o cooldown o gateway volta a aceitar e a próxima chamada é a sondagem
+    assert gateway.available
+    assert breaker.allow()
+    assert breaker.state == app.CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()  # uma sondagem por vez
+    breaker.release_probe()
+
+    client.failing = False
+    gateway.chat(model="m", messages=[])
+    assert breaker.state == app.CircuitBreaker.CLOSED
+    assert gateway.available
+
+
+def test_failed_probe_reopens_breaker():
+    breaker = app.CircuitBreaker(failure_threshold=1, reset_seconds=0.05)
+    gateway = app.LLMGateway(FlakyClient(), max_in_flight=1, queue_timeout_seconds=1, max_retries=0,
+                             retry_base_seconds=0, breaker=breaker)
+    with pytest.raises(app.LLMUnavailableError):
+        gateway.chat(model="m", messages=[])
+    time.sleep(0.06)
+    assert gateway.available
+    with pytest.raises(app.LLMUnavailableError):
+        gateway.chat(model="m", messages=[])
+    assert breaker.state == app.CircuitBreaker.OPEN
+    assert not gateway.available
+
+
+def test_bad_request_does_not_reset_breaker():
+    breaker = app.CircuitBreaker(failure_threshold=2, reset_seconds=0.05)
+    client = FlakyClient()
+    gateway = app.LLMGateway(client, max_in_flight=1, queue_timeout_seconds=1, max_retries=0,
+                             retry_base_seconds=0, breaker=breaker)
+
+    # 4xx entre falhas do serviço não zera a contagem
+    for bad_request in (False, True, False):
+        client.bad_request = bad_request
+        with pytest.raises(app.LLMUnavailableError):
+            gateway.chat(model="m", messages=[])
+    assert breaker.state == app.CircuitBreaker.OPEN
+
+    # 4xx na sondagem não fecha o circuito, só libera a próxima sondagem
+    time.sleep(0.06)
+    client.bad_request = True
+    with pytest.raises(app.LLMUnavailableError):
+        gateway.chat(model="m", messages=[])
+    assert breaker.state == app.CircuitBreaker.HALF_OPEN
+    assert breaker.failures == 2
+    assert breaker.allow()
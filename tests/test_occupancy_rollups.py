@@ -0,0 +1,115 @@
+"""
+Testes dos agregados de ocupação (OccupancyRollups): $inc por evento x backfill
+
+Uso: python -m pytest tests/
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import main_flask_single as app
+
+USER = app.User(nome="Ana", telefone="+5511999999999")
+DAY = (datetime.now() + timedelta(days=3)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+@pytest.fixture
+def rollups(db, monkeypatch):
+    events = app.ReservationEvents()
+    monkeypatch.setattr(app, "reservation_events", events)
+    rollups = app.OccupancyRollups(settle_seconds=0, control_ttl_seconds=0)
+    rollups.start()
+    return rollups
+
+
+def reserve(hour, hours=1, price=100.0, court_id="quadra-1"):
+    return app.reservation_repo.create(app.Reservation(
+        usuario=USER, establishment_id="est-1", court_id=court_id, data_reserva=DAY + timedelta(hours=hour),
+        quantidade_horas=hours, status="confirmada", valor_hora=price))
+
+
+def hold(hour, price=80.0):
+    return app.reservation_repo.create_hold(app.Reservation(
+        usuario=USER, establishment_id="est-1", court_id="quadra-2", data_reserva=DAY + timedelta(hours=hour),
+        valor_hora=price), datetime.now() + timedelta(minutes=10))
+
+
+def counters(db) -> dict:
+    return {(doc["court_id"], doc["data"], doc["hora"]): (doc["horas_reservadas"], round(doc["receita"], 2))
+            for doc in db.ocupacao_horaria.find() if doc["horas_reservadas"]}
+
+
+def test_events_match_backfill(rollups, db):
+    reserve(18, hours=2)
+    cancelled = reserve(19)
+    reserve(19, price=120.0, court_id="quadra-3")
+    app.reservation_repo.cancel_by_id(cancelled)
+    app.reservation_repo.confirm_hold(hold(20))
+    app.reservation_repo.expire_hold(hold(21))
+
+    incremental = counters(db)
+    day = DAY.date().isoformat()
+    assert incremental == {
+        ("quadra-1", day, 18): (1, 100.0),
+        ("quadra-1", day, 19): (1, 100.0),
+        ("quadra-3", day, 19): (1, 120.0),
+        ("quadra-2", day, 20): (1, 80.0),
+    }
+    assert rollups.backfill() == 4
+    assert counters(db) == incremental
+
+
+def test_events_during_backfill_are_replayed_once(rollups, db, monkeypatch):
+    before = reserve(10)
+    reserve(11)
+    late_hold = hold(12)
+    # Outro processo, com a marca do backfill em cache até depois de ela ser removida
+    other_process = app.OccupancyRollups(settle_seconds=0, control_ttl_seconds=3600)
+    other_events = app.ReservationEvents()
+    other_events.subscribe("created", other_process._on_created)
+    sleeps = []
+
+    def during_backfill(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 1:
+            # Marca criada, varredura ainda não feita: os eventos ficam em ocupacao_pendentes
+            assert other_process._active_backfill() is not None
+            reserve(13)
+            app.reservation_repo.cancel_by_id(before)
+            app.reservation_repo.cancel_by_id(reserve(14))
+            assert db.ocupacao_pendentes.count_documents({}) == 4
+        else:
+            # Marca já removida, mas o outro processo ainda a vê e retém a confirmação da retenção
+            with monkeypatch.context() as patch:
+                patch.setattr(app, "reservation_events", other_events)
+                app.reservation_repo.confirm_hold(late_hold)
+            assert db.ocupacao_pendentes.count_documents({}) == 5
+
+    with monkeypatch.context() as patch:
+        patch.setattr(app.time, "sleep", during_backfill)
+        rollups.backfill()
+
+    assert len(sleeps) == 2
+    assert db.ocupacao_pendentes.count_documents({}) == 0
+    replayed = counters(db)
+    day = DAY.date().isoformat()
+    assert replayed == {
+        ("quadra-1", day, 11): (1, 100.0),
+        ("quadra-1", day, 13): (1, 100.0),
+        ("quadra-2", day, 12): (1, 80.0),
+    }
+    rollups.backfill()
+    assert counters(db) == replayed
+
+
+def test_control_marker_is_read_once_per_ttl(db):
+    rollups = app.OccupancyRollups(control_ttl_seconds=3600)
+    reads = []
+    control = db.ocupacao_controle
+    rollups.get_control_collection = lambda: reads.append(1) or control
+    for hour in range(3):
+        rollups._on_created({"_id": hour, "status": "confirmada", "court_id": "quadra-1", "establishment_id": "est-1",
+                             "data_reserva": (DAY + timedelta(hours=hour)).isoformat(), "valor_hora": 50.0})
+    assert len(reads) == 1
+    assert len(counters(db)) == 3